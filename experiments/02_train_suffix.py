@@ -61,6 +61,8 @@ def add_main_args(parser):
                         help='whether to use a generic query template instead of a task-specific one (harder)')
     parser.add_argument('--float16', type=int, default=0,
                         help='whether to use float16 / low cpu mem')
+    parser.add_argument('--use_suffix_kv_cache', type=int, default=0,
+                        help='boolean 0 or 1: whether to extend cached past_key_values by one token per expanded suffix, instead of re-encoding text + suffix (tokenizes the suffix token by token)')
 
     # training misc args
     parser.add_argument('--seed', type=int, default=1,
@@ -75,6 +77,16 @@ def add_computational_args(parser):
     """
     parser.add_argument('--use_cpu_only', type=int, default=0,
                         help='boolean 0 or 1: whether to force everything onto cpu')
+    parser.add_argument('--suffix_max_rows_per_forward', type=int, default=1024,
+                        help='max number of (suffix, example) rows to put through the model at once when evaluating a level of the suffix search')
+    parser.add_argument('--suffix_kv_cache_max_gb', type=float, default=0,
+                        help='if > 0, max GB of dataset-level past_key_values to keep for the beam frontier when use_suffix_kv_cache (evicted ones are rebuilt)')
+    parser.add_argument('--suffix_accum_dtype', type=str, default='float64', choices=['float32', 'float64'],
+                        help='precision used to accumulate next-token probs over the dataset in the suffix search')
+    parser.add_argument('--suffix_avg_top_k', type=int, default=0,
+                        help='if > 0, only accumulate the top-k next-token probs of each example in the suffix search')
+    parser.add_argument('--vocab_cache_dir', type=str, default=None,
+                        help='directory to cache decoded vocab tables for the suffix search (defaults to ~/.cache/iprompt)')
     parser.add_argument('--use_parallelformers', type=int, default=1,
                         help='boolean 0 or 1: whether to try and use parallelformers')
     parser.add_argument('--use_cache', type=int, default=1,
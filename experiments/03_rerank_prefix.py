@@ -18,6 +18,7 @@ from transformers import AutoTokenizer, AutoModelForCausalLM
 from tqdm import tqdm
 
 import iprompt.data_utils.data as data
+from iprompt.lm_head import get_logits_at_positions
 from model_utils.prefix import get_prefix_from_mlm, compute_log_ppl_loss
 import iprompt.utils as utils
 
@@ -148,13 +149,6 @@ def rerank_prefix_list(
                 dim=1
             ).to(device)
 
-            with torch.no_grad():
-                outputs = lm(
-                    input_ids=input_ids,
-                    attention_mask=attention_mask
-                )
-            assert outputs.logits.shape == input_ids.shape + (len(tokenizer.vocab),)
-
             # actually compute the loss.
             ###########################################################################
             # get index of ID token
@@ -169,7 +163,15 @@ def rerank_prefix_list(
             )
             ###########################################################################
             # next-token-only (few-shot) loss.
-            next_token_logits = outputs.logits[torch.arange(this_batch_size), output_token_ids-1]
+            # (only need logits right before the output token, so skip the rest)
+            with torch.no_grad():
+                next_token_logits = get_logits_at_positions(
+                    lm,
+                    positions=(output_token_ids-1),
+                    input_ids=input_ids,
+                    attention_mask=attention_mask
+                )
+            assert next_token_logits.shape == (this_batch_size, len(tokenizer.vocab))
             total_loss += torch.nn.functional.cross_entropy(
                 input=next_token_logits, target=tokenized_output_ids
             )
@@ -16,10 +16,12 @@ from collections import defaultdict
 from iprompt.prefix import (
     AutoPrompt, iPrompt,
     PrefixLoss, PrefixModel,
-    PromptTunedModel, HotFlip, GumbelPrefixModel
+    PromptTunedModel, HotFlip, GumbelPrefixModel,
+    TokenizedDataset, LengthBucketedBatchSampler
 )
 import pandas as pd
 import iprompt.data as data
+from iprompt.answer_vocab import AnswerVocab
 import logging
 import pickle as pkl
 from torch.utils.data import DataLoader
@@ -59,8 +61,31 @@ def train_model(
     model.train()
 
     model = model.to(device)
-    dataloader = DataLoader(
-        dset, batch_size=args.batch_size, shuffle=True, drop_last=False)
+    # tokenize everything once up front
+    tokenized_dset = TokenizedDataset(
+        dset=dset,
+        tokenizer=tokenizer,
+        prepare_batch=model.prepare_batch,
+        max_length=args.max_length,
+        input_column=('last_input' if ((args.n_shots > 1) and (args.single_shot_loss)) else 'input'),
+        cache_dir=args.tokenized_data_cache_dir,
+        cache_name=f'{args.checkpoint}__{args.task_name}__{args.template_num_task_phrasing}',
+    )
+    if (args.batch_sampler == 'length_bucketed') or (args.max_batch_tokens is not None):
+        # group examples of similar length, to cut down on padding
+        batch_sampler = LengthBucketedBatchSampler(
+            lengths=(tokenized_dset.lengths('x') + tokenized_dset.lengths('y')),
+            batch_size=args.batch_size,
+            max_tokens=args.max_batch_tokens,
+            bucket_size_multiplier=args.length_bucket_size_multiplier,
+            seed=args.seed,
+        )
+        dataloader = DataLoader(
+            tokenized_dset, batch_sampler=batch_sampler, collate_fn=tokenized_dset.collate)
+    else:
+        dataloader = DataLoader(
+            tokenized_dset, batch_size=args.batch_size, shuffle=True, drop_last=False,
+            collate_fn=tokenized_dset.collate)
 
     # optimizer
     optim = torch.optim.AdamW(model.trainable_params, lr=args.lr)
@@ -68,32 +93,18 @@ def train_model(
     assert model.training
 
     # Compute loss only over possible answers to make task easier
-    possible_answer_ids = []
-    for batch in dataloader:
-        y_text = [answer for answer in batch['output']]
-        y_tokenized = tokenizer(y_text, return_tensors='pt', padding='longest')
-        # only test on the single next token
-        true_next_token_ids = y_tokenized['input_ids'][:, 0]
-        possible_answer_ids.extend(true_next_token_ids.tolist())
-
-    possible_answer_ids = torch.tensor(possible_answer_ids)
-    num_unique_answers = len(set(possible_answer_ids.tolist()))
-    assert num_unique_answers > 0, "need multiple answers for multiple choice"
+    # (only test on the single next token)
+    possible_answer_ids = tokenized_dset.first_answer_token_ids
+    vocab_size = len(tokenizer.vocab)
+    answer_vocab = AnswerVocab(possible_answer_ids, vocab_size)
+    num_unique_answers = len(answer_vocab)
     random_acc = 1 / num_unique_answers * 100.0
-    majority_count = (
-        possible_answer_ids[:, None] == possible_answer_ids[None, :]).sum(dim=1).max()
-    majority_acc = majority_count * 100.0 / len(possible_answer_ids)
+    majority_acc = answer_vocab.majority_count * 100.0 / len(possible_answer_ids)
     print(
         f"Training with {num_unique_answers} possible answers / random acc {random_acc:.1f}% / majority acc {majority_acc:.1f}%")
 
-    vocab_size = len(tokenizer.vocab)
-
     if args.mask_possible_answers:
-        possible_answer_mask = (
-            torch.arange(start=0, end=vocab_size)[:, None]
-            ==
-            possible_answer_ids[None, :]
-        ).any(dim=1).to(device)
+        possible_answer_mask = answer_vocab.mask.to(device)
     else:
         possible_answer_mask = None
 
@@ -107,19 +118,17 @@ def train_model(
 
         total_n = 0
         total_n_correct = 0
+        total_n_tokens = 0
+        total_n_padded_tokens = 0
         pbar = tqdm(enumerate(dataloader), total=len(dataloader))
         for idx, batch in pbar:
             total_n_steps += 1
-            if (args.n_shots > 1) and (args.single_shot_loss):
-                batch['input'] = batch['last_input']
-            x_text, y_text = model.prepare_batch(batch=batch)
-
-            tok = functools.partial(
-                model.tokenizer, return_tensors='pt', padding='longest',
-                truncation=True, max_length=args.max_length)
-            x_tokenized = tok(x_text).to(device)
-            y_tokenized = tok(y_text).to(device)
-            full_text_tokenized = tok(batch['text']).to(device)
+            x_tokenized = batch['x_tokenized'].to(device)
+            y_tokenized = batch['y_tokenized'].to(device)
+            full_text_tokenized = batch['text_tokenized'].to(device)
+            # track how much of each batch is padding
+            total_n_tokens += x_tokenized.attention_mask.sum().item()
+            total_n_padded_tokens += x_tokenized.attention_mask.numel()
 
             loss, n_correct = model.compute_loss_and_call_backward(
                 x_tokenized=x_tokenized,
@@ -131,8 +140,8 @@ def train_model(
             r["all_losses"].append(loss)
             r["all_n_correct"].append(n_correct)
 
-            total_n += len(x_text)
-            total_n_datapoints += len(x_text)
+            total_n += len(x_tokenized.input_ids)
+            total_n_datapoints += len(x_tokenized.input_ids)
             total_n_correct += n_correct
 
             all_losses.append(loss)
@@ -155,6 +164,9 @@ def train_model(
             print(f"Ending epoch {epoch} early...")
         avg_loss = sum(all_losses) / len(all_losses)
         print(f"Epoch {epoch}. average loss = {avg_loss:.3f} / {total_n_correct} / {total_n} correct ({total_n_correct/total_n*100:.2f}%)")
+        padding_waste = 1 - (total_n_tokens / max(total_n_padded_tokens, 1))
+        print(f"Epoch {epoch}. padding waste = {padding_waste*100:.1f}% of {total_n_padded_tokens} input tokens")
+        r["padding_waste"].append(padding_waste)
 
         # save stuff
         for key, val in model.compute_metrics().items():
@@ -180,9 +192,10 @@ def train_model(
 
     # Serialize model-specific stuff (prefixes & losses for autoprompt, embeddings for prompt tuning, etc.)
     n_eval = 128
-    eval_dset = datasets.Dataset.from_dict(dset[:n_eval])
+    eval_dset = torch.utils.data.Subset(tokenized_dset, range(min(n_eval, len(tokenized_dset))))
     eval_dataloader = DataLoader(
-        eval_dset, batch_size=args.batch_size, shuffle=True, drop_last=False)
+        eval_dset, batch_size=args.batch_size, shuffle=True, drop_last=False,
+        collate_fn=tokenized_dset.collate)
     r.update(model.serialize(eval_dataloader, possible_answer_mask))
 
     # save whether prefixes fit the template
@@ -198,6 +211,13 @@ def train_model(
     return r
 
 
+def get_eval_tokenizer(args: argparse.Namespace, model: PrefixModel):
+    """Tokenizes eval text the same way for every eval loop (truncated like the train data)."""
+    return functools.partial(
+        model.tokenizer, return_tensors='pt', padding='longest',
+        truncation=True, max_length=args.max_length)
+
+
 def eval_model_with_set_prefix(
     args: argparse.Namespace,
     r: Dict[str, List],
@@ -224,8 +244,7 @@ def eval_model_with_set_prefix(
     for idx, batch in pbar:
         x_text, y_text = model.prepare_batch(batch=batch)
 
-        tok = functools.partial(
-            model.tokenizer, return_tensors='pt', padding='longest')
+        tok = get_eval_tokenizer(args=args, model=model)
         x_tokenized = tok(x_text).to(device)
         y_tokenized = tok(y_text).to(device)
         full_text_tokenized = tok(batch['text']).to(device)
@@ -238,7 +257,8 @@ def eval_model_with_set_prefix(
                 prefix_ids=None,
             )
 
-        total_loss += loss.item()
+        # loss is a mean over the batch, so weight it by batch size to get a per-example mean
+        total_loss += loss.item() * len(x_text)
         total_n += len(x_text)
         total_n_correct += n_correct
 
@@ -268,7 +288,26 @@ def eval_model(
     dataloader = DataLoader(
         dset, batch_size=args.batch_size, shuffle=False, drop_last=False)
 
-    if r["prefixes"]:
+    if r["prefixes"] and args.prefix_eval_mode == 'racing':
+        # race the prefixes, so clearly-worse ones stop getting evaluated early
+        def iter_batches():
+            tok = get_eval_tokenizer(args=args, model=model)
+            for batch in dataloader:
+                x_text, y_text = model.prepare_batch(batch=batch)
+                yield tok(x_text).input_ids.to(device), tok(y_text).input_ids.to(device)
+
+        losses, accs, num_examples = model._race_prefixes(
+            prefix_ids=torch.tensor(r["prefix_ids"]).to(device),
+            batches=tqdm(iter_batches(), total=len(dataloader), desc="racing prefixes"),
+            num_batches=len(dataloader),
+            possible_answer_mask=None,  # TODO: implement eval verbalizer
+        )
+        r["prefix_test_loss"] = losses
+        r["prefix_test_acc"] = accs
+        r["prefix_test_n_examples"] = num_examples
+        r["num_prefixes_used_for_test"] = len(r["prefixes"])
+
+    elif r["prefixes"]:
         # if we specified multiple prefixes (autoprompt or genetic), let's evaluate them all!
         for prefix_ids in tqdm(r["prefix_ids"], desc="evaluating prefixes"):
             model._set_prefix_ids(new_ids=torch.tensor(prefix_ids).to(device))
@@ -352,6 +391,28 @@ if __name__ == '__main__':
                         help='only compute loss over possible answer tokens')
     parser.add_argument('--hotflip_num_candidates', type=int, default=10,
                         help='number of candidates to rerank, for hotflip')
+    parser.add_argument('--hotflip_allowed_tokens', type=str, default='all', choices=('all', 'ascii'),
+                        help='tokens hotflip/autoprompt may swap in; ascii skips special tokens and tokens that are not printable ascii')
+    parser.add_argument('--tokenized_data_cache_dir', type=str, default=None,
+                        help='if set, save tokenized datasets here (keyed by checkpoint, task & template) so later runs can reuse them')
+    parser.add_argument('--batch_sampler', type=str, default='random', choices=('random', 'length_bucketed'),
+                        help='whether to batch examples randomly, or to group examples of similar length (still shuffled) to reduce padding')
+    parser.add_argument('--max_batch_tokens', type=int, default=None,
+                        help='if set, build length-bucketed batches of up to this many (padded) tokens instead of a fixed batch_size')
+    parser.add_argument('--length_bucket_size_multiplier', type=int, default=50,
+                        help='length-bucketed batches are sorted within pools of this many batches')
+    parser.add_argument('--scoring_max_tokens', type=int, default=2**14,
+                        help='max number of tokens per forward pass when scoring many candidate prefixes at once')
+    parser.add_argument('--prefix_scoring_mode', type=str, default='full', choices=('full', 'kv_cache'),
+                        help='whether to recompute every token when scoring prefixes, or to cache past_key_values for the preprefix and each prefix')
+    parser.add_argument('--answer_head', type=str, default='full', choices=('full', 'restricted'),
+                        help='when masking possible answers, whether to compute single-token answer logits for the whole vocab or only for the possible answers')
+    parser.add_argument('--prefix_eval_mode', type=str, default='full', choices=('full', 'racing'),
+                        help='whether to evaluate every final prefix on all the data, or to drop prefixes once they are confidently worse than the best one')
+    parser.add_argument('--prefix_eval_racing_delta', type=float, default=0.05,
+                        help='prob. of dropping the best prefix when prefix_eval_mode is racing')
+    parser.add_argument('--prefix_eval_racing_min_examples', type=int, default=64,
+                        help='number of examples every prefix is scored on before any can be dropped when prefix_eval_mode is racing')
     parser.add_argument('--accum_grad_over_epoch', type=int, default=0, choices=(0, 1),
                         help='should we clear gradients after a batch, or only at the end of the epoch?')
     parser.add_argument('--num_learned_tokens', type=int, default=1,
@@ -365,6 +426,20 @@ if __name__ == '__main__':
     parser.add_argument('--iprompt_num_mutations', type=int, default=4)
     parser.add_argument('--iprompt_num_random_generations',
                         type=int, default=4)
+    parser.add_argument('--iprompt_generation_bucket_length_spread', type=int, default=16,
+                        help='conditionals whose lengths differ by at most this many tokens are generated in one batch')
+    parser.add_argument('--prefix_pool_backend', type=str, default='dict', choices=('dict', 'array'),
+                        help='storage for the pool of prefixes tracked by autoprompt/iprompt')
+    parser.add_argument('--prefix_pool_checkpoint_interval', type=int, default=50,
+                        help='number of steps between compact checkpoints of the logged prefix pool')
+    parser.add_argument('--resume_from', type=str, default=None,
+                        help='save dir of a previous autoprompt/iprompt run to resume the prefix pool from')
+    parser.add_argument('--iprompt_score_cache_size', type=int, default=100_000,
+                        help='max number of (prefix, batch) scores to cache for iprompt (0 disables the cache)')
+    parser.add_argument('--iprompt_generation_cache_size', type=int, default=0,
+                        help='max number of sampled continuations to cache for iprompt (0 disables the cache)')
+    parser.add_argument('--iprompt_generation_cache_reuse_prob', type=float, default=0.5,
+                        help='probability of reusing a cached continuation instead of sampling a new one')
     parser.add_argument('--llm_float16', '--float16', '--parsimonious', type=int, default=0, choices=(0, 1),
                         help='if true, loads LLM in fp16 and at low-ram')
     parser.add_argument('--checkpoint', type=str, default="EleutherAI/gpt-neo-2.7B",
@@ -453,6 +528,9 @@ if __name__ == '__main__':
             tokenizer=tokenizer,
             preprefix=preprefix
         )
+        if args.resume_from is not None:
+            assert isinstance(model, AutoPrompt), 'can only resume autoprompt/iprompt runs'
+            model.resume_from(args.resume_from)
         dset, check_answer_func, description = data.get_data(
             task_name=args.task_name, n_shots=args.n_shots, train_split_frac=args.train_split_frac, max_dset_size=args.max_dset_size,
             template_num_task_phrasing=args.template_num_task_phrasing, max_digit=args.max_digit
@@ -31,6 +31,7 @@ from iprompt.data_utils import neuro
 import pandas as pd
 from datasets import Dataset
 import iprompt.data as data
+from iprompt.answer_vocab import AnswerVocab
 import logging
 import pickle as pkl
 from torch.utils.data import DataLoader
@@ -88,23 +89,16 @@ def train_model(
         possible_answer_ids.extend(true_next_token_ids.tolist())
 
     possible_answer_ids = torch.tensor(possible_answer_ids)
-    num_unique_answers = len(set(possible_answer_ids.tolist()))
-    assert num_unique_answers > 0, "need multiple answers for multiple choice"
+    vocab_size = len(tokenizer.vocab)
+    answer_vocab = AnswerVocab(possible_answer_ids, vocab_size)
+    num_unique_answers = len(answer_vocab)
     random_acc = 1 / num_unique_answers * 100.0
-    majority_count = (
-        possible_answer_ids[:, None] == possible_answer_ids[None, :]).sum(dim=1).max()
-    majority_acc = majority_count * 100.0 / len(possible_answer_ids)
+    majority_acc = answer_vocab.majority_count * 100.0 / len(possible_answer_ids)
     print(
         f"Training with {num_unique_answers} possible answers / random acc {random_acc:.1f}% / majority acc {majority_acc:.1f}%")
 
-    vocab_size = len(tokenizer.vocab)
-
     if args.mask_possible_answers:
-        possible_answer_mask = (
-            torch.arange(start=0, end=vocab_size)[:, None]
-            ==
-            possible_answer_ids[None, :]
-        ).any(dim=1).to(device)
+        possible_answer_mask = answer_vocab.mask.to(device)
     else:
         possible_answer_mask = None
 
@@ -251,8 +251,10 @@ for task_key in task_keys:
                         if task_name_test == 'task107_splash_question_to_sql':
                             batch_size = max(1, batch_size//4)
                         if checkpoint == 'gpt3':
+                            # (reuse the model's client, so responses are cached across the sweep)
                             acc = prompt_classification.test_gpt_model_on_task_with_prefix(
                                 dset=dset_test, prefix=prompt_actual, verbose=True, multi_token=multi_token,
+                                client=model.client,
                             )
                         else:
                             _, acc = prompt_classification.test_model_on_task_with_prefix(
@@ -0,0 +1,43 @@
+"""Compares serial, one-prompt-per-request completions (how Gpt3Model used to query)
+with the batched, concurrent AsyncCompletionClient, against a local mock server.
+
+    python experiments/benchmarks/gpt3_client_throughput.py --num_prompts 200 --latency 0.2
+"""
+import argparse
+import tempfile
+import time
+
+from iprompt.openai_client import AsyncCompletionClient, MockCompletionServer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_prompts', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='seconds the mock server waits before answering each request')
+    parser.add_argument('--max_concurrency', type=int, default=8)
+    parser.add_argument('--max_prompts_per_request', type=int, default=20)
+    args = parser.parse_args()
+
+    prompts = [f'Input: {i} + {i}\nOutput:' for i in range(args.num_prompts)]
+    api_kwargs = {'temperature': 0.0, 'max_tokens': 1, 'logprobs': 5}
+    with MockCompletionServer(latency=args.latency) as server, tempfile.TemporaryDirectory() as cache_dir:
+        clients = {
+            'serial': AsyncCompletionClient(
+                max_concurrency=1, max_prompts_per_request=1,
+                api_base=server.api_base, api_key='mock', cache_dir=''),
+            'async': AsyncCompletionClient(
+                max_concurrency=args.max_concurrency, max_prompts_per_request=args.max_prompts_per_request,
+                api_base=server.api_base, api_key='mock', cache_dir=cache_dir),
+        }
+        results = {}
+        for name, client in clients.items():
+            start_time = time.time()
+            results[name] = client.complete(prompts, **api_kwargs)
+            elapsed = time.time() - start_time
+            print(f'{name:>8}: {elapsed:.2f}s for {len(prompts)} prompts in {client.num_requests} requests')
+
+        start_time = time.time()
+        cached = clients['async'].complete(prompts, **api_kwargs)
+        print(f'  cached: {time.time() - start_time:.2f}s ({clients["async"].num_cache_hits} cache hits)')
+        print(f'same completions: {results["serial"] == results["async"] == cached}')
@@ -0,0 +1,50 @@
+"""Compares memory used per prefix by the dict-backed PrefixPool and the
+array-backed CompactPrefixPool.
+
+    python experiments/benchmarks/prefix_pool_memory.py --num_prefixes 100000
+"""
+import argparse
+import random
+import time
+import tracemalloc
+
+import torch
+
+from iprompt.prefix.utils import CompactPrefixPool, PrefixPool
+
+
+def fill_pool(pool, prefixes, num_updates_per_prefix):
+    for prefix in prefixes:
+        prefix = torch.tensor(prefix)
+        for _ in range(num_updates_per_prefix):
+            pool.update(prefix, torch.tensor(random.random()), torch.tensor(random.random()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_prefixes', type=int, default=100_000)
+    parser.add_argument('--num_tokens', type=int, default=6)
+    parser.add_argument('--num_updates_per_prefix', type=int, default=3)
+    args = parser.parse_args()
+    random.seed(0)
+
+    prefixes = list({
+        tuple(random.randint(0, 50_256) for _ in range(args.num_tokens))
+        for _ in range(args.num_prefixes)
+    })
+    pools = {
+        'dict': lambda: PrefixPool(tokenizer=None, criterion='loss'),
+        'array': lambda: CompactPrefixPool(tokenizer=None, criterion='loss', num_tokens=args.num_tokens),
+    }
+    for name, make_pool in pools.items():
+        tracemalloc.start()
+        start_time = time.time()
+        pool = make_pool()
+        fill_pool(pool, prefixes, args.num_updates_per_prefix)
+        # build the top-k index too, since it's part of what a run keeps around
+        pool.topk_all(k=10)
+        elapsed = time.time() - start_time
+        current, _peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name:>6}: {current / len(pool):8.1f} bytes/prefix over {len(pool)} prefixes ({elapsed:.1f}s to fill)')
+        del pool
@@ -0,0 +1,81 @@
+"""Compares the two prefix-scoring modes of PrefixModel on CPU.
+
+    python experiments/benchmarks/prefix_scoring.py --checkpoint gpt2 --num_candidates 32
+
+'full' recomputes every (preprefix, prefix, data) token for every candidate;
+'kv_cache' encodes the preprefix once, each prefix once, and continues over
+the data tokens with past_key_values.
+"""
+import argparse
+import time
+
+import torch
+import transformers
+
+import iprompt.data as data
+from iprompt.prefix import AutoPrompt, PrefixLoss
+
+
+def time_scoring(model, x_tokenized, y_tokenized, prefix_ids, num_repeats):
+    times = []
+    for _ in range(num_repeats):
+        start_time = time.time()
+        losses, n_correct = model._compute_loss_with_set_prefixes(
+            original_input_ids=x_tokenized.input_ids,
+            next_token_ids=y_tokenized.input_ids[:, 0:1],
+            possible_answer_mask=None,
+            prefix_ids=prefix_ids,
+        )
+        times.append(time.time() - start_time)
+    return min(times), losses, n_correct
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default='gpt2')
+    parser.add_argument('--task_name', type=str, default='add_two')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_candidates', type=int, default=32)
+    parser.add_argument('--num_learned_tokens', type=int, default=6)
+    parser.add_argument('--scoring_max_tokens', type=int, default=2**14)
+    parser.add_argument('--num_repeats', type=int, default=3)
+    args = parser.parse_args()
+    args.hotflip_num_candidates = 10
+    args.autoprompt_init_strategy = 'the'
+    args.early_stopping_steps = -1
+    args.max_length = 128
+    torch.manual_seed(0)
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(args.checkpoint)
+    tokenizer.pad_token = tokenizer.eos_token
+    lm = transformers.AutoModelForCausalLM.from_pretrained(args.checkpoint)
+    lm.eval()
+    dset, _, _ = data.get_data(
+        task_name=args.task_name, n_shots=1, train_split_frac=None, max_dset_size=args.batch_size,
+        template_num_task_phrasing=0, max_digit=10
+    )
+    preprefix = data.get_init_suffix(args.task_name, 0, 0)
+
+    args.prefix_scoring_mode = 'full'
+    model = AutoPrompt(
+        args=args, loss_func=PrefixLoss(gamma=0.0, tokenizer=tokenizer),
+        model=lm, tokenizer=tokenizer, preprefix=preprefix
+    )
+    batch = dset[:args.batch_size]
+    x_text, y_text = model.prepare_batch(batch=batch)
+    x_tokenized = tokenizer(x_text, return_tensors='pt', padding='longest')
+    y_tokenized = tokenizer(y_text, return_tensors='pt', padding='longest')
+    prefix_ids = torch.randint(
+        low=0, high=tokenizer.vocab_size, size=(args.num_candidates, args.num_learned_tokens)
+    )
+
+    results = {}
+    for mode in ['full', 'kv_cache']:
+        model._prefix_scoring_mode = mode
+        results[mode] = time_scoring(model, x_tokenized, y_tokenized, prefix_ids, args.num_repeats)
+        print(f'{mode:>10}: {results[mode][0]:.3f}s for {args.num_candidates} prefixes x {args.batch_size} examples')
+
+    max_loss_diff = (results['full'][1] - results['kv_cache'][1]).abs().max().item()
+    print(f'speedup: {results["full"][0] / results["kv_cache"][0]:.2f}x')
+    print(f'max abs loss difference: {max_loss_diff:.2e}')
+    print(f'n_correct equal: {torch.equal(results["full"][2], results["kv_cache"][2])}')
@@ -0,0 +1,46 @@
+"""Times test_model_on_task_with_prefix on growing slices of a task, to check that
+evaluation time scales linearly with the number of rows.
+
+    python experiments/benchmarks/prompt_classification_eval.py --checkpoint gpt2 --num_rows 1000
+
+Possible answers are computed once per dataset (and cached), so time per row should
+stay roughly flat as the dataset grows. The second eval of each slice reuses the cache.
+"""
+import argparse
+import time
+
+import torch
+
+import iprompt.data as data
+from iprompt import prompt_classification
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default='gpt2')
+    parser.add_argument('--task_name', type=str, default='add_two')
+    parser.add_argument('--num_rows', type=int, default=1000)
+    parser.add_argument('--num_slices', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=32)
+    args = parser.parse_args()
+    torch.manual_seed(0)
+
+    model = prompt_classification.Model(model_name=args.checkpoint, float16=False)
+    dset, _, _ = data.get_data(
+        task_name=args.task_name, n_shots=1, train_split_frac=None, max_dset_size=args.num_rows,
+        template_num_task_phrasing=0, max_digit=10
+    )
+
+    for slice_idx in range(1, args.num_slices + 1):
+        num_rows = len(dset) * slice_idx // args.num_slices
+        dset_slice = dset.select(range(num_rows))
+        times = []
+        for _ in range(2):
+            start_time = time.time()
+            loss, acc = prompt_classification.test_model_on_task_with_prefix(
+                dset=dset_slice, model=model, prefix='',
+                batch_size=args.batch_size, verbose=False,
+            )
+            times.append(time.time() - start_time)
+        print(f'{num_rows:>6} rows: {times[0]:.2f}s ({1000 * times[0] / num_rows:.2f} ms/row), '
+              f'cached answers {times[1]:.2f}s / loss {loss:.3f} / acc {acc:.1f}%')
@@ -1,26 +1,32 @@
 from typing import List, Tuple
 
 import argparse
-import glob
+import json
 import os
-import re
 
 import pandas as pd
 
 
-def get_file_number(filename: str) -> int:
-    return int(re.search(r'prefix_(\d+).p', filename).group(1))
-
-
 def read_dfs(folder_name: str) -> Tuple[List[int], List[pd.DataFrame]]:
+    """Reads the top prefixes at every step, from the `topk.jsonl` that
+    PrefixPool.log_topk writes to <save_dir>/prefix_pool.
+    """
     assert os.path.exists(folder_name)
-    files = glob.glob(os.path.join(folder_name, 'prefix_*.p'))
-    files.sort(key=get_file_number) # sort files numerically
-    assert len(files) > 0, 'no prefix files found with format prefix_\{step\}.p'
-    dfs = []
-    for filename in files:
-        dfs.append(pd.read_pickle(filename))
-    return list(map(get_file_number, files)), dfs
+    topk_file = os.path.join(folder_name, 'prefix_pool', 'topk.jsonl')
+    if not os.path.exists(topk_file):
+        topk_file = os.path.join(folder_name, 'topk.jsonl') # (folder is the prefix_pool dir itself)
+    assert os.path.exists(topk_file), f'no top prefixes found at {topk_file}'
+    steps, dfs = [], []
+    with open(topk_file, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break # partially-written last line
+            steps.append(record['step'])
+            dfs.append(pd.DataFrame({column: record[column] for column in ['prefix', 'loss', 'accuracy']}))
+    assert len(steps) > 0, f'no steps found in {topk_file}'
+    return steps, dfs
 
 def create_prefix_data(folder_name: str):
     """creates output CSV from inputs.
@@ -56,7 +62,7 @@ def create_prefix_data(folder_name: str):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('folder_name', type=str,
-                        help='folder name with prefix outputs')
+                        help='save dir of an iprompt run (or its prefix_pool folder)')
     args = parser.parse_args()
     create_prefix_data(folder_name=args.folder_name)
 
@@ -0,0 +1,50 @@
+import torch
+
+
+class AnswerVocab:
+    """The possible (first-token) answers of a dataset, over a vocab of size `vocab_size`.
+
+    Keeps the sorted unique answer token IDs, so logits can be restricted to possible
+    answers by gathering just those columns. The (vocab_size,) bool mask is built by
+    scattering the unique IDs, rather than comparing every vocab ID to every answer.
+
+    Params
+    ------
+    answer_ids (int torch.Tensor or list): first answer token ID of every example
+    vocab_size (int): number of columns in the model's logits
+    """
+    ids: torch.Tensor
+    counts: torch.Tensor
+    mask: torch.Tensor
+
+    def __init__(self, answer_ids, vocab_size: int):
+        answer_ids = torch.as_tensor(answer_ids, dtype=torch.long).flatten()
+        assert len(answer_ids) > 0, "need multiple answers for multiple choice"
+        self.vocab_size = vocab_size
+        self.ids, self.counts = torch.unique(answer_ids, return_counts=True)
+        self.mask = torch.zeros(vocab_size, dtype=torch.bool)
+        self.mask[self.ids] = True
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def majority_count(self) -> int:
+        """Number of examples with the most common answer."""
+        return self.counts.max().item()
+
+    def to(self, device) -> 'AnswerVocab':
+        self.ids = self.ids.to(device)
+        self.mask = self.mask.to(device)
+        return self
+
+    def gather(self, logits: torch.Tensor) -> torch.Tensor:
+        """Logits of just the possible answers, shape (..., len(self))."""
+        return logits[..., self.ids.to(logits.device)]
+
+    def to_compact(self, token_ids: torch.Tensor) -> torch.Tensor:
+        """Maps token IDs to their column in `gather`ed logits (-100, the
+        default ignore_index for losses, if not a possible answer)."""
+        ids = self.ids.to(token_ids.device)
+        compact_ids = torch.searchsorted(ids, token_ids).clamp(max=len(ids) - 1)
+        return torch.where(ids[compact_ids] == token_ids, compact_ids, torch.full_like(compact_ids, -100))
@@ -0,0 +1,75 @@
+import torch
+
+
+def get_logits_at_positions(model, positions: torch.Tensor, vocab_ids: torch.Tensor = None, **model_kwargs) -> torch.Tensor:
+    """Runs a causal LM and gets next-token logits only at `positions`.
+
+    Rather than projecting every hidden state to the vocab (a (batch_size, seq_len, vocab_size)
+    tensor that's mostly thrown away), this runs the base transformer, gathers the hidden
+    states at `positions` and applies the LM head to just those.
+
+    Params
+    ------
+    model (transformers.PreTrainedModel): causal LM, e.g. from AutoModelForCausalLM
+    positions (int torch.Tensor): positions to get logits at, shape (batch_size,)
+        or (batch_size, num_positions) when we need logits for multi-token labels
+    vocab_ids (int torch.Tensor, optional): only compute logits for these tokens, e.g. the
+        possible answers of a classification task (hidden_state @ W_unembed[vocab_ids])
+    model_kwargs: inputs for the model, e.g. input_ids or inputs_embeds, attention_mask, past_key_values
+
+    Returns:
+        logits (float torch.Tensor): shape (batch_size, vocab_size) or
+            (batch_size, num_positions, vocab_size), matching `positions`
+            (with len(vocab_ids) instead of vocab_size if given)
+    """
+    model_kwargs.setdefault('use_cache', False)
+    single_position = (positions.ndim == 1)
+    if single_position:
+        positions = positions[:, None]
+
+    lm_head = model.get_output_embeddings()
+    if lm_head is None:
+        # no separate LM head, so compute logits at every position
+        states = model(**model_kwargs)['logits']
+    else:
+        # only go through the base transformer
+        states = model.base_model(**model_kwargs)[0]
+
+    # index at correct positions
+    positions = positions.to(states.device)
+    states = states.gather(1, positions[..., None].expand(-1, -1, states.shape[-1]))
+    if lm_head is None:
+        logits = states
+    elif (vocab_ids is not None) and isinstance(lm_head, torch.nn.Linear):
+        vocab_ids = vocab_ids.to(states.device)
+        logits = torch.nn.functional.linear(
+            states, lm_head.weight[vocab_ids],
+            None if lm_head.bias is None else lm_head.bias[vocab_ids])
+        vocab_ids = None
+    else:
+        logits = lm_head(states)
+    if vocab_ids is not None:
+        logits = logits[..., vocab_ids.to(logits.device)]
+    return logits[:, 0] if single_position else logits
+
+
+def get_last_token_positions(attention_mask: torch.Tensor) -> torch.Tensor:
+    """Position of the last real token in each row of a right-padded batch."""
+    return attention_mask.sum(dim=1) - 1
+
+
+def get_last_logits_and_past(model, **model_kwargs):
+    """Gets next-token logits at the final position of every row (e.g. of a left-padded
+    batch), along with the past_key_values so that decoding can continue from there.
+
+    Returns:
+        logits (float torch.Tensor): shape (batch_size, vocab_size)
+        past_key_values: the model's cache after these inputs
+    """
+    model_kwargs['use_cache'] = True
+    lm_head = model.get_output_embeddings()
+    if lm_head is None:
+        outputs = model(**model_kwargs)
+        return outputs['logits'][:, -1], outputs['past_key_values']
+    outputs = model.base_model(**model_kwargs)
+    return lm_head(outputs[0][:, -1]), outputs['past_key_values']
@@ -0,0 +1,286 @@
+"""Async client for the (legacy) OpenAI completions API, plus a local mock server.
+
+Prompts are sent in batches (one request completes many prompts), with at most
+`max_concurrency` requests in flight and optionally at most `requests_per_minute`
+requests started per minute. Failed requests are retried with exponential backoff,
+and every response is cached on disk, keyed by (model, prompt, kwargs), so re-running
+a sweep only pays for prompts it hasn't seen before.
+
+    client = AsyncCompletionClient(model='text-davinci-002')
+    choices = client.complete(prompts, temperature=0.0, max_tokens=1, logprobs=5)
+
+`MockCompletionServer` serves deterministic completions at a local `api_base`, so
+throughput and caching can be tested offline.
+"""
+from typing import Any, Dict, List, Optional
+
+import asyncio
+import hashlib
+import http.server
+import json
+import os
+import random
+import threading
+import time
+
+
+class _RateLimiter:
+    """Spaces out request starts to at most `requests_per_minute` (no limit if <= 0).
+
+    Holds asyncio state, so make a new one for every event loop (e.g. every `acomplete` call).
+    """
+
+    def __init__(self, requests_per_minute: float):
+        self.requests_per_minute = requests_per_minute
+        self._lock = asyncio.Lock()
+        self._next_request_time = time.monotonic()
+
+    async def wait(self) -> None:
+        if self.requests_per_minute <= 0:
+            return
+        async with self._lock:
+            wait_time = self._next_request_time - time.monotonic()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            self._next_request_time = max(time.monotonic(), self._next_request_time) + 60.0 / self.requests_per_minute
+
+
+class AsyncCompletionClient:
+    """Batched, concurrency- and rate-limited completions with retries and an on-disk cache.
+
+    Params
+    ------
+    model (str): completions model to query
+    max_concurrency (int): max number of requests in flight at once
+    max_prompts_per_request (int): max number of prompts to complete in a single request
+    requests_per_minute (float): if > 0, max number of requests to start per minute
+    max_retries (int): number of times to retry a failed request before raising
+    initial_backoff (float): seconds to wait before the first retry (doubles every retry)
+    max_backoff (float): max seconds to wait between retries
+    cache_dir (str): directory for cached responses (defaults to ~/.cache/iprompt/openai),
+        or '' to not cache
+    api_base (str): base URL of the API, e.g. from `MockCompletionServer.api_base`
+    api_key (str): API key (defaults to the OPENAI_API_KEY env variable)
+    """
+
+    def __init__(self, model: str = 'text-davinci-002', max_concurrency: int = 8,
+                 max_prompts_per_request: int = 20, requests_per_minute: float = 0,
+                 max_retries: int = 6, initial_backoff: float = 1.0, max_backoff: float = 60.0,
+                 cache_dir: Optional[str] = None, api_base: Optional[str] = None,
+                 api_key: Optional[str] = None):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_prompts_per_request = max_prompts_per_request
+        self.requests_per_minute = requests_per_minute
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'iprompt', 'openai')
+        self.cache_dir = cache_dir
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.api_base = api_base
+        self.api_key = api_key if (api_key is not None) else os.environ.get('OPENAI_API_KEY')
+        self.num_requests = 0
+        self.num_retries = 0
+        self.num_cache_hits = 0
+
+    def _cache_key(self, prompt: str, kwargs: Dict[str, Any]) -> str:
+        key = json.dumps({'model': self.model, 'prompt': prompt, **kwargs}, sort_keys=True)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _cache_path(self, cache_key: str) -> str:
+        return os.path.join(self.cache_dir, cache_key[:2], cache_key + '.json')
+
+    def _load_cached(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        if not self.cache_dir:
+            return None
+        cache_path = self._cache_path(cache_key)
+        if not os.path.exists(cache_path):
+            return None
+        with open(cache_path) as f:
+            return json.load(f)
+
+    def _save_cached(self, cache_key: str, choice: Dict[str, Any]) -> None:
+        if not self.cache_dir:
+            return
+        cache_path = self._cache_path(cache_key)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # write then rename, so concurrent runs never see a partial file
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(choice, f)
+        os.replace(tmp_path, cache_path)
+
+    async def _create(self, prompts: List[str], kwargs: Dict[str, Any],
+                      semaphore: asyncio.Semaphore, rate_limiter: _RateLimiter) -> List[Dict[str, Any]]:
+        """Completes `prompts` in a single request (retrying on failure), returning one choice per prompt."""
+        import openai
+        retryable_errors = (
+            openai.error.RateLimitError, openai.error.APIError, openai.error.Timeout,
+            openai.error.APIConnectionError, openai.error.ServiceUnavailableError, openai.error.TryAgain,
+        )
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                await rate_limiter.wait()
+                try:
+                    self.num_requests += 1
+                    response = await openai.Completion.acreate(
+                        model=self.model, prompt=prompts,
+                        api_base=self.api_base, api_key=self.api_key, **kwargs
+                    )
+                    break
+                except retryable_errors:
+                    if attempt == self.max_retries:
+                        raise
+            # back off (with jitter) outside the semaphore, so other requests can go
+            self.num_retries += 1
+            backoff = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+            await asyncio.sleep(backoff * (0.5 + random.random() / 2))
+
+        choices = sorted(response.to_dict_recursive()['choices'], key=lambda choice: choice['index'])
+        assert len(choices) == len(prompts), f'expected {len(prompts)} choices, got {len(choices)}'
+        return choices
+
+    async def acomplete(self, prompts: List[str], **kwargs) -> List[Dict[str, Any]]:
+        """Completes every prompt in `prompts`, returning one choice (a dict with 'text',
+        'logprobs', ...) per prompt, in order. `kwargs` go to the API (e.g. max_tokens).
+        """
+        assert kwargs.get('n', 1) == 1, 'only one completion per prompt is supported'
+        # asyncio state belongs to this call's event loop, so it isn't kept on self
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        rate_limiter = _RateLimiter(self.requests_per_minute)
+
+        # check the cache, and only query the (unique) prompts that aren't in it
+        results = [None] * len(prompts)
+        prompt_idxs = {}
+        for i, prompt in enumerate(prompts):
+            cache_key = self._cache_key(prompt, kwargs)
+            cached = self._load_cached(cache_key)
+            if cached is not None:
+                self.num_cache_hits += 1
+                results[i] = cached
+            else:
+                prompt_idxs.setdefault(cache_key, (prompt, []))[1].append(i)
+
+        # query in batches of prompts, concurrently
+        todo = list(prompt_idxs.items())
+        batches = [
+            todo[start_idx: start_idx + self.max_prompts_per_request]
+            for start_idx in range(0, len(todo), self.max_prompts_per_request)
+        ]
+        all_choices = await asyncio.gather(*[
+            self._create([prompt for _, (prompt, _) in batch], kwargs, semaphore, rate_limiter)
+            for batch in batches
+        ])
+        for batch, choices in zip(batches, all_choices):
+            for (cache_key, (_, idxs)), choice in zip(batch, choices):
+                self._save_cached(cache_key, choice)
+                for i in idxs:
+                    results[i] = choice
+        return results
+
+    def complete(self, prompts: List[str], **kwargs) -> List[Dict[str, Any]]:
+        """Blocking version of `acomplete` (can't be called from a running event loop)."""
+        return asyncio.run(self.acomplete(prompts, **kwargs))
+
+
+class MockCompletionServer:
+    """Local stand-in for the completions endpoint, for testing the client offline.
+
+    Completions are deterministic functions of (prompt, max_tokens), built from common
+    single-token words. Every request can be delayed by `latency` seconds, and the
+    first `num_failures` requests get a 429 (rate limit) error.
+
+        with MockCompletionServer(latency=0.1) as server:
+            client = AsyncCompletionClient(api_base=server.api_base, api_key='mock', cache_dir='')
+            choices = client.complete(['1 + 1 ='], max_tokens=1, logprobs=5)
+    """
+    WORDS = [' the', ' a', ' yes', ' no', ' 1', ' 2', ' 3', ' and', ' of', ' to']
+
+    def __init__(self, port: int = 0, latency: float = 0.0, num_failures: int = 0):
+        self.latency = latency
+        self.num_failures = num_failures
+        self.num_requests = 0
+        self.num_prompts = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                status, response = server._handle(request)
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                return
+
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._thread = None
+
+    @property
+    def api_base(self) -> str:
+        return f'http://127.0.0.1:{self._httpd.server_address[1]}/v1'
+
+    def _complete(self, prompt: str, max_tokens: int, num_logprobs: Optional[int]) -> Dict[str, Any]:
+        seed = int(hashlib.sha256(prompt.encode('utf-8')).hexdigest(), 16)
+        tokens = [self.WORDS[(seed // (7 ** i)) % len(self.WORDS)] for i in range(max_tokens)]
+        choice = {'text': ''.join(tokens), 'logprobs': None, 'finish_reason': 'length'}
+        if num_logprobs is not None:
+            top_logprobs = []
+            for token in tokens:
+                others = [w for w in self.WORDS if w != token][:max(num_logprobs - 1, 0)]
+                top_logprobs.append({token: -0.1, **{w: -3.0 - j for j, w in enumerate(others)}})
+            choice['logprobs'] = {
+                'tokens': tokens,
+                'token_logprobs': [-0.1] * len(tokens),
+                'top_logprobs': top_logprobs,
+                'text_offset': [len(prompt) + sum(map(len, tokens[:i])) for i in range(len(tokens))],
+            }
+        return choice
+
+    def _handle(self, request: Dict[str, Any]):
+        with self._lock:
+            self.num_requests += 1
+            fail = self.num_requests <= self.num_failures
+        time.sleep(self.latency)
+        if fail:
+            return 429, {'error': {'message': 'Rate limit reached (mock)', 'type': 'requests', 'code': None}}
+        prompts = request['prompt']
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        with self._lock:
+            self.num_prompts += len(prompts)
+        choices = []
+        for i, prompt in enumerate(prompts):
+            choice = self._complete(prompt, request.get('max_tokens', 16), request.get('logprobs'))
+            choices.append({**choice, 'index': i})
+        return 200, {
+            'id': f'cmpl-mock-{self.num_requests}',
+            'object': 'text_completion',
+            'created': int(time.time()),
+            'model': request.get('model'),
+            'choices': choices,
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        }
+
+    def start(self) -> 'MockCompletionServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> 'MockCompletionServer':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import argparse
 import functools
@@ -12,7 +12,7 @@ import tqdm
 import transformers
 
 from .hotflip import HotFlip
-from .utils import device, PrefixLoss, PrefixModel, PrefixPool
+from .utils import device, create_prefix_pool, PrefixLoss, PrefixModel
 
 
 class AutoPrompt(HotFlip):
@@ -37,45 +37,104 @@ class AutoPrompt(HotFlip):
         # AutoPrompt-specific parameters.
         self._num_candidates_per_prefix_token = 32 # V_cand in autoprompt paper
         # This helps us know which were the best prefixes to return over time
-        self._prefix_pool = PrefixPool(
+        self._prefix_pool = create_prefix_pool(
+            args=args,
             tokenizer=self.tokenizer,
-            criterion='loss'  # in ['loss', 'acc', 'combined']
+            criterion='loss',  # in ['loss', 'acc', 'combined']
+            num_tokens=self._num_tokens,
         )
+        # Log the pool to disk so that runs can be resumed.
+        if getattr(args, 'save_dir_unique', None):
+            self._prefix_pool.open_log(
+                os.path.join(args.save_dir_unique, 'prefix_pool'),
+                checkpoint_interval=getattr(args, 'prefix_pool_checkpoint_interval', 50)
+            )
         self._VERBOSE = False
         self._num_min_occurrences = 1
         # Will rank and save this many prefixes at the end of training.
         self._num_prefixes_to_test = 1024
+
+    def _get_resume_state(self) -> Dict[str, Any]:
+        """State (besides the prefix pool) needed to resume training from this step."""
+        return {
+            'prefix_ids': self.prefix_ids.tolist(),
+            'swap_token_idx': self._swap_token_idx,
+            'steps_since_new_prefix': self._steps_since_new_prefix,
+        }
+
+    def _set_resume_state(self, state: Dict[str, Any]) -> None:
+        if not state: return
+        self._swap_token_idx = state['swap_token_idx']
+        self._set_prefix_ids(torch.tensor(state['prefix_ids']).to(device))
+        self._steps_since_new_prefix = state['steps_since_new_prefix']
+
+    def resume_from(self, save_dir: str) -> None:
+        """Rebuilds the prefix pool and early-stopping state from a previous run
+        that was saved to `save_dir`.
+        """
+        state = self._prefix_pool.load(os.path.join(save_dir, 'prefix_pool'))
+        self._set_resume_state(state)
+        # checkpoint right away so the new run's directory is self-contained,
+        # and the log the old run was writing when it stopped isn't needed.
+        if self._prefix_pool._log_dir is not None:
+            self._prefix_pool.save_checkpoint()
+            self._prefix_pool.remove_loaded_log()
+        print(f'resumed {len(self._prefix_pool)} prefixes from {save_dir} at step {self._prefix_pool.step}')
     
-    def _test_prefixes(self, prefixes: List[Tuple[int]], eval_dataloader: torch.utils.data.DataLoader, possible_answer_mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def _iter_eval_batches(self, eval_dataloader: torch.utils.data.DataLoader) -> Iterable[Tuple[torch.Tensor, torch.Tensor]]:
+        """Tokenizes batches from `eval_dataloader` into (input_ids, next_token_ids) pairs."""
+        tok = functools.partial(
+            self.tokenizer, return_tensors='pt', padding='longest',
+            truncation=True, max_length=self.args.max_length # TODO set max_length on self
+        )
+        for batch in eval_dataloader:
+            if 'x_tokenized' in batch:
+                # batch from a TokenizedDataset, already tokenized
+                x_tokenized = batch['x_tokenized'].to(device)
+                y_tokenized = batch['y_tokenized'].to(device)
+            else:
+                x_text, y_text = self.prepare_batch(batch=batch)
+                x_tokenized = tok(x_text).to(device)
+                y_tokenized = tok(y_text).to(device)
+            yield x_tokenized.input_ids, y_tokenized.input_ids[:, 0:1] # only compute loss over next token
+
+    def _test_prefixes(self, prefixes: List[Tuple[int]], eval_dataloader: torch.utils.data.DataLoader, possible_answer_mask: torch.Tensor) -> Tuple[List[float], List[float], List[int]]:
         """Computes loss & accuracy for each prefix on data in dataloader. Used to rank
-        prefixes at the end of training.
+        prefixes at the end of training. Also returns the number of examples each
+        prefix was scored on, which is less than the full dataset for prefixes
+        that got knocked out early when `self._prefix_eval_mode == 'racing'`.
         """
+        batches = tqdm.tqdm(
+            self._iter_eval_batches(eval_dataloader=eval_dataloader),
+            total=len(eval_dataloader), desc='evaluating prefixes'
+        )
+        if self._prefix_eval_mode == 'racing':
+            return self._race_prefixes(
+                prefix_ids=torch.tensor(prefixes).to(device),
+                batches=batches,
+                num_batches=len(eval_dataloader),
+                possible_answer_mask=possible_answer_mask,
+            )
+
         all_candidate_losses = torch.zeros(len(prefixes), dtype=torch.float32)
         all_candidate_n_correct = torch.zeros(len(prefixes), dtype=torch.float32)
         total_n = 0
-        for batch in tqdm.tqdm(eval_dataloader, desc='evaluating prefixes'):
-            x_text, y_text = self.prepare_batch(batch=batch)
-            total_n += len(x_text)
-            tok = functools.partial(
-                self.tokenizer, return_tensors='pt', padding='longest',
-                truncation=True, max_length=self.args.max_length # TODO set max_length on self
+        for input_ids, next_token_ids in batches:
+            total_n += len(input_ids)
+            cand_losses, cand_n_correct = self._compute_loss_with_set_prefixes(
+                original_input_ids=input_ids,
+                next_token_ids=next_token_ids,
+                possible_answer_mask=possible_answer_mask,
+                prefix_ids=torch.tensor(prefixes).to(device),
             )
-            x_tokenized = tok(x_text).to(device)
-            y_tokenized = tok(y_text).to(device)
-            next_token_ids = y_tokenized.input_ids[:, 0:1] # only compute loss over next token
-            for i in range(len(prefixes)):
-                with torch.no_grad():
-                    _cand_input_ids, cand_loss, cand_n_correct = (
-                        self._compute_loss_with_set_prefix(
-                            original_input_ids=x_tokenized.input_ids,
-                            next_token_ids=next_token_ids,
-                            possible_answer_mask=possible_answer_mask,
-                            prefix_ids=torch.tensor(prefixes[i]).to(device),
-                        )
-                    )
-                all_candidate_losses[i] = cand_loss
-                all_candidate_n_correct[i] = cand_n_correct
-        return all_candidate_losses.cpu().tolist(), (all_candidate_n_correct / total_n).cpu().tolist()
+            all_candidate_losses += cand_losses.cpu() * len(input_ids)
+            all_candidate_n_correct += cand_n_correct.cpu()
+        all_candidate_losses /= total_n
+        return (
+            all_candidate_losses.cpu().tolist(),
+            (all_candidate_n_correct / total_n).cpu().tolist(),
+            [total_n] * len(prefixes)
+        )
     
     def serialize(self, eval_dataloader: torch.utils.data.DataLoader, possible_answer_mask: torch.Tensor) -> Dict[str, Any]:
         """Writes stuff to disk. Saves other stuff to save as full results file.
@@ -87,17 +146,17 @@ class AutoPrompt(HotFlip):
         # pickle.dump(self._prefix_pool, open(os.path.join(save_dir, 'prefix_pool.p'), 'wb'))
 
         all_prefixes = self._prefix_pool.topk_all(k=self._num_prefixes_to_test, min_occurrences=1)
-        all_losses, all_accuracies = self._test_prefixes(
+        all_losses, all_accuracies, all_num_examples = self._test_prefixes(
             prefixes=all_prefixes, eval_dataloader=eval_dataloader, possible_answer_mask=possible_answer_mask
         )
         df = pd.DataFrame(
-            zip(*[all_prefixes, all_losses, all_accuracies]),
-            columns=['prefix', 'loss', 'accuracy']
+            zip(*[all_prefixes, all_losses, all_accuracies, all_num_examples]),
+            columns=['prefix', 'loss', 'accuracy', 'n_eval_examples']
         )
         df = df.sort_values(by=['accuracy', 'loss'], ascending=[False, True]).reset_index()
         # df = df.sort_values(by='loss', ascending=True).reset_index()
         df['prefix_str'] = df['prefix'].map(self.tokenizer.decode)
-        df['n_queries'] = df['prefix'].map(lambda p_ids: len(self._prefix_pool._all_losses[p_ids]))
+        df['n_queries'] = df['prefix'].map(self._prefix_pool.num_occurrences)
 
         print('Final prefixes')
         print(df.head())
@@ -108,6 +167,7 @@ class AutoPrompt(HotFlip):
             "prefix_train_acc": df['accuracy'].tolist(),
             "prefix_train_loss": df['loss'].tolist(),
             "prefix_n_queries": df['n_queries'].tolist(),
+            "prefix_train_n_examples": df['n_eval_examples'].tolist(),
         }
             
 
@@ -149,19 +209,10 @@ class AutoPrompt(HotFlip):
         # 
         # Get top token replacements
         # 
-        token_grads = self._prefix_token_grad
-        assert token_grads.shape == (self._num_tokens, len(self.tokenizer.vocab))
-        top_tokens_per_position = (
-            token_grads.topk(k=self._num_candidates_per_prefix_token, dim=1, largest=False).indices
+        token_ids, token_grads = self._swap_token_grad(token_idx=self._swap_token_idx)
+        top_swap_tokens, _ = self._top_swap_tokens(
+            token_scores=token_grads, token_ids=token_ids, k=self._num_candidates_per_prefix_token
         )
-        assert top_tokens_per_position.shape == (self._num_tokens, self._num_candidates_per_prefix_token)
-
-        top_swap_tokens = top_tokens_per_position[self._swap_token_idx, :]
-        #
-        # Get most likely tokens.
-        #
-        top_swap_tokens = token_grads.argsort(descending=False).flatten()
-        top_swap_tokens = top_swap_tokens[0:self._num_candidates_per_prefix_token]
 
         # rank candidates
         mask = torch.nn.functional.one_hot(
@@ -172,28 +223,19 @@ class AutoPrompt(HotFlip):
         candidate_prefix_ids = candidate_prefix_ids[~is_current_prefix_mask]
 
         # get best prefix
-        num_candidates = len(candidate_prefix_ids)
-        all_candidate_losses = torch.zeros(num_candidates, dtype=float).to(device)
-        all_n_correct = torch.zeros(num_candidates, dtype=int).to(device)
-        for i in range(num_candidates):
-            with torch.no_grad():
-                cand_input_ids, cand_loss, cand_n_correct = (
-                    self._compute_loss_with_set_prefix(
-                        original_input_ids=original_input_ids,
-                        next_token_ids=next_token_ids,
-                        possible_answer_mask=possible_answer_mask,
-                        prefix_ids=candidate_prefix_ids[i],
-                    )
-                )
-            all_candidate_losses[i] = cand_loss
-            all_n_correct[i] = cand_n_correct
-
-            self._VERBOSE: print(f'** \t{self.tokenizer.decode(candidate_prefix_ids[i])}: {cand_loss:.2f}')
+        all_candidate_losses, all_n_correct = self._compute_loss_with_set_prefixes(
+            original_input_ids=original_input_ids,
+            next_token_ids=next_token_ids,
+            possible_answer_mask=possible_answer_mask,
+            prefix_ids=candidate_prefix_ids,
+        )
+        for i in range(len(candidate_prefix_ids)):
+            self._VERBOSE: print(f'** \t{self.tokenizer.decode(candidate_prefix_ids[i])}: {all_candidate_losses[i]:.2f}')
 
             self._prefix_pool.update(
                 prefix=candidate_prefix_ids[i],
-                loss=cand_loss,
-                accuracy=(cand_n_correct / len(original_input_ids))
+                loss=all_candidate_losses[i],
+                accuracy=(all_n_correct[i] / len(original_input_ids))
             )
         
         # randomly change the token to swap
@@ -212,6 +254,7 @@ class AutoPrompt(HotFlip):
 
 
         self._set_prefix_ids(best_prefix)
+        self._prefix_pool.end_step(self._get_resume_state())
         return best_prefix_loss, best_prefix_n_correct
         
     def post_epoch(self, dataloader: torch.utils.data.DataLoader, possible_answer_mask: torch.Tensor) -> None:
@@ -11,7 +11,9 @@ import torch.nn as nn
 import tqdm
 import transformers
 
-from .utils import device, PrefixLoss, PrefixModel
+from ..answer_vocab import AnswerVocab
+from ..lm_head import get_logits_at_positions
+from .utils import device, repeat_past_key_values, PrefixLoss, PrefixModel
 
 
 VERBOSE = False # whether to print grads, etc.
@@ -42,6 +44,10 @@ class HotFlip(PrefixModel):
         self._num_tokens = args.num_learned_tokens # TODO argparse for n_tokens
         self._num_candidates_per_prefix_token = args.hotflip_num_candidates # TODO argparse for this too
         self._swap_token_idx = 0
+        # which tokens we're allowed to swap in: 'all', or 'ascii' to skip special
+        # tokens & tokens that don't decode to printable ascii.
+        self._allowed_tokens = getattr(args, 'hotflip_allowed_tokens', 'all')
+        self._allowed_token_ids, self._allowed_token_embeddings = None, None
 
         self._tested_prefix_ids = collections.defaultdict(lambda: 0)
         # Sort both a version with a preprefix ("The function to compute is") and a version
@@ -65,6 +71,9 @@ class HotFlip(PrefixModel):
         # TODO use some kind of fixed-size data structure
         # if number of tested candidates is growing unboundedly
         self._loss_for_prefix = {}
+        # past_key_values for the (fixed) preprefix, computed once per run
+        # when scoring with prefix_scoring_mode='kv_cache'.
+        self._preprefix_past_key_values = None
 
     def check_early_stop(self) -> bool:
         """Allow prefix models to stop early."""
@@ -105,6 +114,51 @@ class HotFlip(PrefixModel):
     def _prefix_token_grad(self) -> torch.Tensor:
         """Gradient of the prefix tokens wrt the token embedding matrix."""
         return torch.einsum('nd,vd->nv', self.prefix_embedding.grad, self.token_embedding.weight)
+
+    def _get_allowed_token_ids(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """IDs & embeddings of the tokens we're allowed to swap in. Computed once, since
+        the token embedding is frozen.
+        """
+        if self._allowed_token_ids is None:
+            embedding = self.token_embedding.weight
+            if self._allowed_tokens == 'all':
+                self._allowed_token_ids = torch.arange(len(embedding), device=embedding.device)
+                self._allowed_token_embeddings = embedding
+            else:
+                assert self._allowed_tokens == 'ascii', f'unknown allowed tokens {self._allowed_tokens}'
+                vocab_size = min(len(self.tokenizer), len(embedding))
+                token_strs = self.tokenizer.batch_decode([[i] for i in range(vocab_size)])
+                special_ids = set(self.tokenizer.all_special_ids)
+                allowed_ids = [
+                    i for i, s in enumerate(token_strs)
+                    if s.isascii() and s.isprintable() and (i not in special_ids)
+                ]
+                self._allowed_token_ids = torch.tensor(allowed_ids, device=embedding.device)
+                self._allowed_token_embeddings = embedding[self._allowed_token_ids]
+        return self._allowed_token_ids, self._allowed_token_embeddings
+
+    def _swap_token_grad(self, token_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Gradient of the prefix token at `token_idx` wrt the embeddings of the allowed
+        tokens. Same as row `token_idx` of `self._prefix_token_grad`, without computing
+        the other rows or the disallowed tokens.
+
+        Returns:
+            token_ids (int torch.Tensor): allowed token IDs, shape (num_allowed_tokens,)
+            token_grads (float torch.Tensor): grad for each allowed token, shape (num_allowed_tokens,)
+        """
+        token_ids, token_embeddings = self._get_allowed_token_ids()
+        return token_ids, token_embeddings @ self.prefix_embedding.grad[token_idx]
+
+    def _top_swap_tokens(self, token_scores: torch.Tensor, token_ids: torch.Tensor, k: int, offset: int = 0) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Partial selection of the `k` tokens with the lowest scores, skipping the first `offset`.
+
+        Returns:
+            top_token_ids (int torch.Tensor): shape (k,)
+            top_token_idxs (int torch.Tensor): positions of the top tokens in `token_ids`, shape (k,)
+        """
+        k = min(offset + k, len(token_scores))
+        top_token_idxs = token_scores.topk(k=k, largest=False).indices[offset:]
+        return token_ids[top_token_idxs], top_token_idxs
     
     def compute_loss_and_call_backward(
             self,
@@ -138,13 +192,7 @@ class HotFlip(PrefixModel):
         # Get candidate IDs for every position.
         # 
         token_idx = self._swap_token_idx
-        token_grads = self._prefix_token_grad
-        top_tokens_per_position = (
-            token_grads.topk(k=self._num_candidates_per_prefix_token, dim=1, largest=False).indices
-        )
-        assert top_tokens_per_position.shape == (self._num_tokens, self._num_candidates_per_prefix_token)
-
-        top_swap_tokens = top_tokens_per_position[token_idx, :]
+        token_ids, token_grads = self._swap_token_grad(token_idx=token_idx)
         #
         # Get most likely tokens.
         #
@@ -153,68 +201,67 @@ class HotFlip(PrefixModel):
         )[None].to(device)
         with torch.no_grad():
             all_preprefix_logits = self.model(prefix_until_swap_ids)
-            swap_token_logits = all_preprefix_logits.logits[:, -1, :]
-
-        rvocab = {v: k for k,v in self.tokenizer.vocab.items()}
-        # dist_sum = (swap_token_logits.log_softmax(dim=1) * .7 + (-1 * token_grads).log_softmax(dim=1))
-        # for v in (swap_token_logits.log_softmax(dim=1) * .7 + (-1 * token_grads).log_softmax(dim=1)).topk(10).indices.flatten(): print(rvocab[v.item()])
+            swap_token_logits = all_preprefix_logits.logits[0, -1, token_ids]
 
         alpha = 0.0 # TODO argparse for this alpha
         print(f"HotFlip alpha = {alpha}")
-        token_losses = (
-            (swap_token_logits.log_softmax(dim=1) * alpha + (-1 * token_grads).log_softmax(dim=1))
-        )
-        top_swap_tokens = token_losses.argsort(descending=True).flatten()
+        # log_softmax(logits) * alpha + log_softmax(-grads), without the normalizers,
+        # which don't change the order. Lower is better.
+        token_losses = token_grads - (swap_token_logits * alpha)
 
         # if we've already tried this (prefix, swap_token_idx) combo, then let's try the next n candidates.
         _n = self._tested_prefix_ids[tuple(self.prefix_ids.flatten().tolist()), token_idx] - 1
         assert _n >= 0, "something went wrong"
-        top_swap_tokens = top_swap_tokens[(_n * self._num_candidates_per_prefix_token) : (_n+1) * self._num_candidates_per_prefix_token]
+        top_swap_tokens, top_swap_token_idxs = self._top_swap_tokens(
+            token_scores=token_losses, token_ids=token_ids,
+            k=self._num_candidates_per_prefix_token,
+            offset=(_n * self._num_candidates_per_prefix_token)
+        )
+        top_swap_token_grads = token_grads[top_swap_token_idxs]
         # 
         # Evaluate candidates.
         # 
-        all_candidate_losses = torch.zeros(self._num_candidates_per_prefix_token, dtype=float).to(device)
-        all_n_correct = torch.zeros(self._num_candidates_per_prefix_token, dtype=int).to(device)
+        num_candidates = len(top_swap_tokens)
+        all_candidate_losses = torch.zeros(num_candidates, dtype=float).to(device)
+        all_n_correct = torch.zeros(num_candidates, dtype=int).to(device)
         best_loss = self._min_loss
 
         mask = torch.nn.functional.one_hot(
             torch.tensor(token_idx), num_classes=self._num_tokens
         ).bool().to(device)
+        candidate_prefix_ids = torch.where(
+            mask, top_swap_tokens[:, None], self.prefix_ids[None].to(device)
+        )
 
-        # Evaluate each prefix.
+        # Evaluate all prefixes together.
         for batch in tqdm.tqdm(dataloader, desc='evaluating HotFlip candidates', colour='red', leave=False):
-            # Loop in this order so we only tokenize each thing once.
-            x_text = [f'. {prompt}' for prompt in batch['input']]
-            y_text = [answer.replace('.', '').rstrip() for answer in batch['output']] # strip newlines and periods.
-            #
-            input_ids = self.tokenizer(x_text, return_tensors='pt', padding='longest')['input_ids'].to(device)
-            next_token_ids = self.tokenizer(y_text, return_tensors='pt', padding='longest')['input_ids'].to(device)
+            if 'x_tokenized' in batch:
+                # batch from a TokenizedDataset, already tokenized
+                input_ids = batch['x_tokenized'].input_ids.to(device)
+                next_token_ids = batch['y_tokenized'].input_ids.to(device)
+            else:
+                # Same labels as the tokenized path, so both score identical targets.
+                x_text, y_text = self.prepare_batch(batch=batch)
+                input_ids = self.tokenizer(x_text, return_tensors='pt', padding='longest')['input_ids'].to(device)
+                next_token_ids = self.tokenizer(y_text, return_tensors='pt', padding='longest')['input_ids'].to(device)
             # only evaluate on single next-token
-            next_token_ids = next_token_ids[:, 0]
-            for candidate_idx in range(self._num_candidates_per_prefix_token):
-                new_token_id = top_swap_tokens[candidate_idx]
-                prefix_ids = torch.where(
-                    mask, new_token_id, self.prefix_ids.to(device)
-                ).to(device)
-                with torch.no_grad():
-                    _input_ids, loss, n_correct = (
-                        self._compute_loss_with_set_prefix(
-                            original_input_ids=input_ids,
-                            next_token_ids=next_token_ids,
-                            possible_answer_mask=possible_answer_mask,
-                            prefix_ids=prefix_ids
-                        )
-                    )
-                all_candidate_losses[candidate_idx] += loss
-                all_n_correct[candidate_idx] += n_correct
+            next_token_ids = next_token_ids[:, 0:1]
+            losses, n_correct = self._compute_loss_with_set_prefixes(
+                original_input_ids=input_ids,
+                next_token_ids=next_token_ids,
+                possible_answer_mask=possible_answer_mask,
+                prefix_ids=candidate_prefix_ids,
+            )
+            all_candidate_losses += losses
+            all_n_correct += n_correct
 
         ##################################################################################################################
         hotflip_out_path = os.path.join(self.args.save_dir_unique, 'hotflip_grads_data.p')
-        for _i in range(self._num_candidates_per_prefix_token):
+        for _i in range(num_candidates):
             token_id = top_swap_tokens[_i].item()
             # rank, prefix, token_id, token_grad, loss_with_this_token, n_correct_with_this_token
             self._data.append(
-                (_i, self.prefix_ids.tolist(), token_id, token_grads.flatten()[token_id].item(), all_candidate_losses[_i].item(), all_n_correct[_i].item())
+                (_i, self.prefix_ids.tolist(), token_id, top_swap_token_grads[_i].item(), all_candidate_losses[_i].item(), all_n_correct[_i].item())
             )
         pickle.dump(self._data, open(hotflip_out_path, 'wb'))
         ##################################################################################################################
@@ -222,7 +269,7 @@ class HotFlip(PrefixModel):
         #
         # Collect losses for all prefixes. Then set prefix to best one we haven't seen before.
         #
-        for candidate_idx in range(self._num_candidates_per_prefix_token):
+        for candidate_idx in range(num_candidates):
             new_token_id = top_swap_tokens[candidate_idx]
             prefix_ids = tuple(
                 torch.where(
@@ -257,6 +304,87 @@ class HotFlip(PrefixModel):
 
         return
 
+    def _get_preprefix_past_key_values(self) -> Tuple[Optional[Tuple], torch.Tensor]:
+        """Encodes the preprefix (BOS + template) once and caches its past_key_values."""
+        preprefix_ids = self.preprefix_ids[None].to(device)
+        preprefix_attention_mask = ~(preprefix_ids == self.tokenizer.pad_token_id)
+        if not preprefix_ids.numel():
+            return None, preprefix_attention_mask
+        if self._preprefix_past_key_values is None:
+            with torch.no_grad():
+                outputs = self.model(
+                    input_ids=preprefix_ids,
+                    attention_mask=preprefix_attention_mask,
+                    use_cache=True,
+                )
+            self._preprefix_past_key_values = outputs.past_key_values
+        return self._preprefix_past_key_values, preprefix_attention_mask
+
+    def _forward_with_cached_prefixes(
+            self,
+            input_ids: torch.Tensor,
+            prefix_ids: torch.Tensor,
+            label_length: int,
+            answer_vocab: Optional[AnswerVocab] = None,
+        ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Runs every prefix in `prefix_ids` on every row of `input_ids`, encoding
+        the preprefix once per run and each prefix once per call, then continuing
+        over the data tokens from the cached past_key_values.
+
+        Args:
+            input_ids (int torch.Tensor) -- IDs for batch of sentences, shape (batch_size, seq_length)
+            prefix_ids (int torch.Tensor) -- IDs for prefixes, shape (num_candidates, num_prefix_tokens)
+            label_length (int) -- number of label tokens at the end of each row of `input_ids`
+            answer_vocab (Optional AnswerVocab) -- only compute logits for these tokens
+
+        Returns:
+            input_ids (int torch.Tensor) -- IDs of data tokens, repeated for each candidate,
+                shape (num_candidates * batch_size, seq_length)
+            label_logits (float torch.Tensor) -- logits at the label positions of the data tokens
+                (see `_get_label_positions`), shape (num_candidates * batch_size, label_length, vocab_size),
+                or (num_candidates * batch_size, 1, len(answer_vocab)) if `answer_vocab` is given
+        """
+        num_candidates = len(prefix_ids)
+        batch_size = len(input_ids)
+        preprefix_past_key_values, preprefix_attention_mask = self._get_preprefix_past_key_values()
+
+        # encode each prefix once, on top of the preprefix.
+        prefix_attention_mask = torch.cat(
+            (
+                preprefix_attention_mask.repeat((num_candidates, 1)),
+                ~(prefix_ids == self.tokenizer.pad_token_id),
+            ), dim=1
+        )
+        # (no LM head here, we only need the past_key_values)
+        prefix_outputs = self.model.base_model(
+            input_ids=prefix_ids,
+            attention_mask=prefix_attention_mask,
+            past_key_values=(
+                repeat_past_key_values(preprefix_past_key_values, num_candidates)
+                if preprefix_past_key_values is not None else None
+            ),
+            use_cache=True,
+        )
+
+        # continue over the data tokens for each (candidate, example) pair.
+        data_input_ids = input_ids.repeat((num_candidates, 1))
+        attention_mask = torch.cat(
+            (
+                prefix_attention_mask.repeat_interleave(batch_size, dim=0),
+                ~(data_input_ids == self.tokenizer.pad_token_id),
+            ), dim=1
+        )
+        label_logits = get_logits_at_positions(
+            self.model,
+            positions=self._get_label_positions(full_input_ids=data_input_ids, label_length=label_length),
+            vocab_ids=(answer_vocab.ids if answer_vocab is not None else None),
+            input_ids=data_input_ids,
+            attention_mask=attention_mask,
+            past_key_values=repeat_past_key_values(prefix_outputs.past_key_values, batch_size),
+            use_cache=False,
+        )
+        return data_input_ids, label_logits
+
     @property
     def prefix_embedding_token_ids(self) -> torch.Tensor:
         return self.prefix_embedding.argmax(dim=-1)
@@ -274,7 +402,8 @@ class HotFlip(PrefixModel):
         Args:
             input_ids (int torch.Tensor) -- IDs for batch of sentences
             prefix_ids (Optional int torch.Tensor) -- IDs for a single prefix
-                to be prepended before each input ID. If not provided,
+                to be prepended before each input ID, or a 2D tensor with
+                one prefix per row of `input_ids`. If not provided,
                 will be overridden with prefix from `self.prefix_ids`.
 
         Returns:
@@ -289,19 +418,22 @@ class HotFlip(PrefixModel):
         else:
             prefix_embedding = self.token_embedding.forward(prefix_ids)
 
+        if prefix_ids.ndim == 1:
+            # same prefix for every example
+            prefix_ids = prefix_ids[None].to(device).repeat((batch_size, 1)).to(device)
+            prefix_embedding = prefix_embedding[None].repeat((batch_size, 1, 1))
+        assert prefix_ids.shape[0] == batch_size
+
         # concatenate preprefix (fixed) + prefix (learned) + example
-        prefix_ids = prefix_ids[None].to(device).repeat((batch_size, 1)).to(device)
         preprefix_ids = self.preprefix_ids[None].to(device).repeat((batch_size, 1)).to(device)
         full_input_ids = torch.cat(
-            (preprefix_ids, prefix_ids, input_ids), dim=1
+            (preprefix_ids, prefix_ids.to(device), input_ids), dim=1
         )
         outputs = torch.cat(
             (
                 self.token_embedding.forward(preprefix_ids),
-                prefix_embedding[None].repeat((batch_size, 1, 1)),
+                prefix_embedding,
                 self.token_embedding.forward(input_ids)
             ), dim=1
         )
         return full_input_ids, outputs
-
-
@@ -2,6 +2,7 @@ from typing import Any, Dict, List, Optional, Tuple
 
 import argparse
 import collections
+import hashlib
 import os
 import random
 
@@ -9,7 +10,7 @@ import torch
 import transformers
 
 from .autoprompt import AutoPrompt
-from .utils import device, PrefixLoss, PrefixModel, PrefixPool
+from .utils import device, LRUCache, PrefixLoss, PrefixModel
 
 
 """
@@ -53,6 +54,15 @@ class iPrompt(AutoPrompt):
         self._generation_temp = 1.0
         self._generation_top_p = 1.0
         self._generation_repetition_penalty = self.args.iprompt_generation_repetition_penalty # 1 means no penalty
+        # conditionals whose lengths differ by at most this much are generated in the same batch
+        self._generation_bucket_length_spread = getattr(args, 'iprompt_generation_bucket_length_spread', 16)
+        # optionally reuse sampled continuations for conditionals we've seen before. reuse
+        # is random (with prob. `_generation_cache_reuse_prob`) to keep some diversity.
+        self._generation_cache = LRUCache(max_size=getattr(args, 'iprompt_generation_cache_size', 0))
+        self._generation_cache_reuse_prob = getattr(args, 'iprompt_generation_cache_reuse_prob', 0.5)
+        # (prefix, batch fingerprint) -> (loss, n_correct), so we never re-score a
+        # prefix on a batch we've already scored it on.
+        self._score_cache = LRUCache(max_size=getattr(args, 'iprompt_score_cache_size', 100_000))
         self._pop_initialized = False
         self._generation_bad_words_ids = [
             self.tokenizer.encode('\n'),
@@ -60,10 +70,6 @@ class iPrompt(AutoPrompt):
             self.tokenizer.encode('\n\n\n')
         ]
         ####################################################################
-        self._prefix_pool = PrefixPool(
-            tokenizer=self.tokenizer,
-            criterion='loss'  # in ['loss', 'acc', 'combined']
-        )
         # Suff to track for early stopping
         self._last_population = None
         self._steps_since_new_population = 0
@@ -86,34 +92,47 @@ class iPrompt(AutoPrompt):
         r["generation_top_p"] = self._generation_top_p
         r["generation_repetition_penalty"] = self._generation_repetition_penalty
         r["generation_bad_words_ids"] = self._generation_bad_words_ids
+        r["generation_bucket_length_spread"] = self._generation_bucket_length_spread
+        r["generation_cache_size"] = self._generation_cache.max_size
+        r["generation_cache_reuse_prob"] = self._generation_cache_reuse_prob
+        r["generation_cache_hits"] = self._generation_cache.num_hits
+        r["generation_cache_misses"] = self._generation_cache.num_misses
+        r["score_cache_size"] = self._score_cache.max_size
+        r["score_cache_hits"] = self._score_cache.num_hits
+        r["score_cache_misses"] = self._score_cache.num_misses
         r["pre_data_prompt_str"] = self.tokenizer.decode(self._pre_data_token_ids.flatten())
         r["post_data_prompt_str"] = self.tokenizer.decode(self._post_data_token_ids.flatten())
         return r
     
-    def _initialize_pop_once(self, full_text_ids: torch.Tensor):
+    def _initialize_pop_once(self, full_text_ids: List[torch.Tensor]):
         if self._pop_initialized: return
 
+        # generate all the missing prefixes in one batch; duplicates are
+        # collapsed by the pool, so keep topping up until it's full.
         while len(self._prefix_pool) < self._pop_size:
-            conditional_input_ids = random.choice(full_text_ids)[None]
-            num_conditional_tokens = conditional_input_ids.numel()
-            input_ids = self._generate(
-                input_ids=conditional_input_ids,
-                num_conditional_tokens=num_conditional_tokens
+            num_missing = self._pop_size - len(self._prefix_pool)
+            random_idxs = torch.randint(low=0, high=len(full_text_ids), size=(num_missing,))
+            input_ids = self._generate_from_conditionals(
+                conditional_input_ids=[full_text_ids[i] for i in random_idxs],
+                num_new_tokens=self._num_tokens,
             )
-            input_ids = input_ids[0, num_conditional_tokens:]
-            assert input_ids.numel() == self._num_tokens
-            self._prefix_pool.initialize_prefix(input_ids)
+            assert input_ids.shape == (num_missing, self._num_tokens)
+            for prefix_ids in input_ids:
+                self._prefix_pool.initialize_prefix(prefix_ids)
 
         self._pop_initialized = True
     
-    def _generate(self, input_ids: torch.Tensor, num_conditional_tokens: int) -> torch.Tensor:
+    def _generate(self, input_ids: torch.Tensor, num_conditional_tokens: int, attention_mask: Optional[torch.Tensor] = None, num_new_tokens: Optional[int] = None) -> torch.Tensor:
         """Generates some text using the model and preset hparams.
 
         If `num_conditional_tokens` > 0, generates extra text because there was an additional
-        prefix set.
+        prefix set. Generates `num_new_tokens` new tokens (`self._num_tokens` by default).
         """
-        output_length = self._num_tokens + num_conditional_tokens
-        attention_mask = ~(input_ids == self.tokenizer.pad_token_id)
+        if num_new_tokens is None:
+            num_new_tokens = self._num_tokens
+        output_length = num_new_tokens + num_conditional_tokens
+        if attention_mask is None:
+            attention_mask = ~(input_ids == self.tokenizer.pad_token_id)
         assert attention_mask.shape == input_ids.shape
         
         g = self.model.generate(
@@ -139,6 +158,26 @@ class iPrompt(AutoPrompt):
 
         return g
     
+    def _get_resume_state(self) -> Dict[str, Any]:
+        state = super()._get_resume_state()
+        state['step'] = self._step
+        state['pop_initialized'] = self._pop_initialized
+        state['steps_since_new_population'] = self._steps_since_new_population
+        state['last_population'] = (
+            sorted(self._last_population) if self._last_population is not None else None
+        )
+        return state
+
+    def _set_resume_state(self, state: Dict[str, Any]) -> None:
+        if not state: return
+        super()._set_resume_state(state)
+        self._step = state['step']
+        self._pop_initialized = state['pop_initialized']
+        self._steps_since_new_population = state['steps_since_new_population']
+        self._last_population = (
+            set(map(tuple, state['last_population'])) if state['last_population'] is not None else None
+        )
+
     def _select_pop_topk(self, k: int, min_occurrences: int = None) -> List[Tuple[int]]:
         return self._prefix_pool.topk(k=k, min_occurrences=min_occurrences)
 
@@ -162,67 +201,194 @@ class iPrompt(AutoPrompt):
             return False
         return self._steps_since_new_population >= self.args.early_stopping_steps
     
-    def _get_population_and_random_generations(self, full_text_ids: torch.Tensor) -> torch.Tensor:
+    def _get_population(self) -> torch.Tensor:
+        """Samples the next population from the top prefixes in the pool."""
         population_pool = self._select_pop_topk(k=self._topk_pop_sample)
         if self._verbose:
             print("population_pool:", [self.tokenizer.decode(p) for p in population_pool])
         population = random.sample(population_pool, self._pop_size)
-        population = torch.tensor(population).to(device)
+        return torch.tensor(population).to(device)
 
-        random_idxs = torch.randint(
-            low=0, high=len(full_text_ids), size=(self._num_random_generations,)
-        )
-        random_full_text_ids = full_text_ids[random_idxs]
-        num_conditional_tokens = full_text_ids.shape[1]
-        random_population = self._generate(
-            input_ids=random_full_text_ids,
-            num_conditional_tokens=num_conditional_tokens
-        )[:, num_conditional_tokens:]
-
-        full_population = torch.cat((population, random_population), dim=0)
-        assert full_population.shape == (
-            self._pop_size + self._num_random_generations,
-            self._num_tokens
+    def _bucket_by_length(self, lengths: List[int]) -> List[List[int]]:
+        """Groups indices into buckets of similar length, so that short
+        conditionals aren't padded all the way up to the longest one.
+        """
+        sorted_idxs = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        buckets = []
+        for i in sorted_idxs:
+            if len(buckets) and (lengths[i] - lengths[buckets[-1][0]] <= self._generation_bucket_length_spread):
+                buckets[-1].append(i)
+            else:
+                buckets.append([i])
+        return buckets
+
+    def _generate_from_conditionals(self, conditional_input_ids: List[torch.Tensor], num_new_tokens: int) -> torch.Tensor:
+        """Generates `num_new_tokens` tokens after each of a list of variable-length
+        conditionals.
+
+        Conditionals are bucketed by length, and each bucket is left-padded
+        so that every row starts generating at the same position. Since
+        conditionals contain no padding of their own, the attention mask
+        (and the position IDs that `generate` derives from it) only skip
+        the left-padding. If the generation cache is enabled, continuations
+        sampled earlier for the same conditional may be reused instead.
+
+        Returns:
+            new_input_ids (int torch.Tensor): only the generated tokens, shape
+                (len(conditional_input_ids), num_new_tokens)
+        """
+        new_input_ids = torch.zeros(
+            (len(conditional_input_ids), num_new_tokens), dtype=int
+        ).to(device)
+
+        # look up continuations we've already sampled
+        cache_keys = [self._generation_cache_key(ids, num_new_tokens=num_new_tokens) for ids in conditional_input_ids]
+        idxs_to_generate = []
+        for i, key in enumerate(cache_keys):
+            cached_ids = None
+            if (self._generation_cache.max_size > 0) and (random.random() < self._generation_cache_reuse_prob):
+                cached_ids = self._generation_cache.get(key)
+            if cached_ids is None:
+                idxs_to_generate.append(i)
+            else:
+                new_input_ids[i] = cached_ids
+
+        lengths = [len(ids) for ids in conditional_input_ids]
+        for bucket in self._bucket_by_length([lengths[i] for i in idxs_to_generate]):
+            bucket = [idxs_to_generate[i] for i in bucket]
+            max_length = max(lengths[i] for i in bucket)
+            input_ids = torch.full(
+                (len(bucket), max_length), self.tokenizer.pad_token_id, dtype=int
+            ).to(device)
+            attention_mask = torch.zeros_like(input_ids, dtype=bool)
+            for j, i in enumerate(bucket):
+                if not lengths[i]: continue
+                input_ids[j, -lengths[i]:] = conditional_input_ids[i]
+                attention_mask[j, -lengths[i]:] = True
+
+            new_input_ids[bucket] = self._generate(
+                input_ids=input_ids,
+                num_conditional_tokens=max_length,
+                attention_mask=attention_mask,
+                num_new_tokens=num_new_tokens,
+            )[:, max_length:]
+            for i in bucket:
+                self._generation_cache.put(cache_keys[i], new_input_ids[i].clone())
+        return new_input_ids
+
+    def _generation_cache_key(self, conditional_input_ids: torch.Tensor, num_new_tokens: int) -> Tuple:
+        """Key for the generation cache: the conditional (which includes any truncated
+        prefix) plus every hparam that changes what would be sampled.
+        """
+        return (
+            tuple(conditional_input_ids.tolist()),
+            num_new_tokens,
+            self._generation_temp,
+            self._generation_top_p,
+            self._generation_repetition_penalty,
         )
-        return full_population
-    
-    def _mutate(self, population_input_ids: torch.Tensor, full_text_ids: torch.Tensor) -> List[torch.Tensor]:
-        """Mutates a population of prefixes.
 
-        Truncates to a random place and then generates new options
-        to try.
+    def _get_mutation_conditionals(
+            self, prefix_input_ids: torch.Tensor, truncate_position: int, full_text_ids: List[torch.Tensor]
+        ) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """Conditionals for mutating each prefix `self._num_mutations_per_ex` times: a random
+        data item followed by the prefix truncated at `truncate_position`.
 
-        Args:
-            population_input_ids (int torch.Tensor): input IDs for each prefix in population
-            full_text_ids (int torch.Tensor): input IDs for each data item in the batch. Intended
-                be used to do prefix generation conditioned on data
+        Returns:
+            truncated_input_ids (int torch.Tensor): the truncated prefixes, repeated
+                (mutation-major, like `prefix_input_ids.repeat(...)`)
+            conditional_input_ids (List[int torch.Tensor]): conditional for each truncated prefix
         """
-        assert population_input_ids.shape[1] == self._num_tokens
-        input_ids = population_input_ids.repeat((self._num_mutations_per_ex, 1))
+        input_ids = prefix_input_ids.repeat((self._num_mutations_per_ex, 1))
 
         self._roll_before_truncation = False
         if self._roll_before_truncation:
             roll_amount = random.randint(0, self._num_tokens-1)
             input_ids = torch.roll(input_ids, roll_amount, dims=[1])
 
-        truncate_position = random.randint(0, self._num_tokens-1)
         truncated_input_ids = input_ids[:, :truncate_position]
-
         random_idxs = torch.randint(low=0, high=len(full_text_ids), size=(len(input_ids), ))
-        random_full_text_ids = full_text_ids[random_idxs]
-        conditional_input_ids = torch.cat((random_full_text_ids, truncated_input_ids), dim=1)
+        conditional_input_ids = [
+            torch.cat((full_text_ids[i], truncated_input_ids[j]), dim=0)
+            for j, i in enumerate(random_idxs)
+        ]
+        return truncated_input_ids, conditional_input_ids
+
+    def _get_random_generations_and_mutations(self, population_input_ids: torch.Tensor, full_text_ids: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Generates random new prefixes, then mutates both the population and those
+        random prefixes.
+
+        Mutations truncate each prefix to a random place and then generate
+        new options to try. Mutations of the population don't depend on the
+        random generations, so both are packed into one batch (which decodes
+        `self._num_tokens` tokens for every row); only the mutations of the
+        random generations need a second, smaller decode of just the tokens
+        after the truncation.
 
-        num_conditional_tokens = full_text_ids.shape[1]
-        new_input_ids = self._generate(
-            input_ids=conditional_input_ids,
-            num_conditional_tokens=num_conditional_tokens
+        Args:
+            population_input_ids (int torch.Tensor): input IDs for each prefix in population
+            full_text_ids (List[int torch.Tensor]): unpadded input IDs for each data item in the batch.
+                Intended be used to do prefix generation conditioned on data
+
+        Returns:
+            random_population_input_ids (int torch.Tensor): prefixes generated from just data
+            mutated_population_input_ids (int torch.Tensor): mutations of the population and the
+                random prefixes, in the same order as mutating
+                `torch.cat((population_input_ids, random_population_input_ids)).repeat(...)`
+        """
+        assert population_input_ids.shape[1] == self._num_tokens
+        pop_size = len(population_input_ids)
+        truncate_position = random.randint(0, self._num_tokens-1)
+        num_new_tokens = self._num_tokens - truncate_position
+
+        # random generations are conditioned on a random data item
+        random_idxs = torch.randint(
+            low=0, high=len(full_text_ids), size=(self._num_random_generations,)
+        )
+        random_conditional_input_ids = [full_text_ids[i] for i in random_idxs]
+
+        # mutations are conditioned on a random data item plus a truncated prefix
+        pop_truncated_input_ids, pop_conditional_input_ids = self._get_mutation_conditionals(
+            prefix_input_ids=population_input_ids, truncate_position=truncate_position, full_text_ids=full_text_ids
+        )
+        new_input_ids = self._generate_from_conditionals(
+            conditional_input_ids=(random_conditional_input_ids + pop_conditional_input_ids),
+            num_new_tokens=self._num_tokens,
+        )
+        # Split the batch back up. Mutations only keep as many new tokens as they
+        # need to fill out the truncated prefix.
+        random_population_input_ids = new_input_ids[:self._num_random_generations]
+        pop_mutations = torch.cat(
+            (pop_truncated_input_ids, new_input_ids[self._num_random_generations:, :num_new_tokens]), dim=1
+        )
+
+        # mutate the random generations too
+        random_truncated_input_ids, random_mutation_conditional_input_ids = self._get_mutation_conditionals(
+            prefix_input_ids=random_population_input_ids, truncate_position=truncate_position, full_text_ids=full_text_ids
+        )
+        random_mutations = torch.cat(
+            (
+                random_truncated_input_ids,
+                self._generate_from_conditionals(
+                    conditional_input_ids=random_mutation_conditional_input_ids,
+                    num_new_tokens=num_new_tokens,
+                )
+            ), dim=1
+        )
+
+        # put rows in the same order as mutating (population + random generations)
+        mutated_population_input_ids = torch.cat(
+            (
+                pop_mutations.reshape((self._num_mutations_per_ex, pop_size, self._num_tokens)),
+                random_mutations.reshape((self._num_mutations_per_ex, self._num_random_generations, self._num_tokens)),
+            ), dim=1
+        ).reshape((-1, self._num_tokens))
+        assert mutated_population_input_ids.shape == (
+            (pop_size + self._num_random_generations) * self._num_mutations_per_ex, self._num_tokens
         )
-        # Split off the conditional part, we only want the prefix part, which
-        # starts after the conditional part.
-        new_input_ids = new_input_ids[:, num_conditional_tokens:]
         
         # TODO consider adding crossover (combining spans?) here.
-        return new_input_ids
+        return random_population_input_ids, mutated_population_input_ids
     
     def _score_population(
             self, 
@@ -231,25 +397,43 @@ class iPrompt(AutoPrompt):
             population_input_ids: torch.Tensor,
             possible_answer_mask: torch.Tensor
         ) -> Tuple[torch.Tensor, torch.Tensor]:
-        """Scores a population of prefixes and updates `self._genetic_pool`."""
+        """Scores a population of prefixes and updates `self._genetic_pool`.
+
+        Scores for (prefix, batch) pairs we've seen before come from `self._score_cache`.
+        """
         pop_size = len(population_input_ids)
         all_candidate_losses = torch.zeros(pop_size, dtype=float).to(device)
-        all_accuracy = torch.zeros(pop_size, dtype=float).to(device)
         all_candidate_n_correct = torch.zeros(pop_size, dtype=int).to(device)
-        for i in range(pop_size):
-            with torch.no_grad():
-                _cand_input_ids, cand_loss, cand_n_correct = (
-                    self._compute_loss_with_set_prefix(
-                        original_input_ids=x_tokenized.input_ids,
-                        next_token_ids=y_tokenized.input_ids,
-                        possible_answer_mask=possible_answer_mask,
-                        prefix_ids=population_input_ids[i],
-                    )
-                )
-                cand_accuracy = cand_n_correct / len(x_tokenized.input_ids)
-            all_candidate_n_correct[i] += cand_n_correct
-            all_candidate_losses[i] += cand_loss
-            all_accuracy[i] += cand_accuracy
+
+        batch_fingerprint = self._batch_fingerprint(
+            x_tokenized=x_tokenized, y_tokenized=y_tokenized, possible_answer_mask=possible_answer_mask
+        )
+        cache_keys = [(tuple(p), batch_fingerprint) for p in population_input_ids.tolist()]
+        keys_to_score = {} # dict instead of set to keep population order
+        for i, key in enumerate(cache_keys):
+            cached_score = self._score_cache.get(key) if self._score_cache.max_size > 0 else None
+            if cached_score is not None:
+                all_candidate_losses[i], all_candidate_n_correct[i] = cached_score
+            else:
+                keys_to_score[key] = None
+
+        if len(keys_to_score):
+            losses, n_correct = self._compute_loss_with_set_prefixes(
+                original_input_ids=x_tokenized.input_ids,
+                next_token_ids=y_tokenized.input_ids,
+                possible_answer_mask=possible_answer_mask,
+                prefix_ids=torch.tensor([p for p, _ in keys_to_score]).to(device),
+            )
+            scores = {
+                key: (losses[j].item(), n_correct[j].item())
+                for j, key in enumerate(keys_to_score)
+            }
+            for key, score in scores.items():
+                self._score_cache.put(key, score)
+            for i, key in enumerate(cache_keys):
+                if key in scores:
+                    all_candidate_losses[i], all_candidate_n_correct[i] = scores[key]
+        all_accuracy = all_candidate_n_correct / len(x_tokenized.input_ids)
         
         for i in range(pop_size):
             new_pop_input_ids = tuple(population_input_ids[i].cpu().tolist())
@@ -259,19 +443,41 @@ class iPrompt(AutoPrompt):
             )
         return all_candidate_losses, all_candidate_n_correct
     
+    def _batch_fingerprint(
+            self,
+            x_tokenized: transformers.BatchEncoding,
+            y_tokenized: transformers.BatchEncoding,
+            possible_answer_mask: Optional[torch.Tensor]
+        ) -> str:
+        """Hash of the tokenized batch (input IDs, attention mask & next-token IDs, plus the
+        possible-answer mask), so we can tell when we see the same batch again."""
+        h = hashlib.sha1()
+        for ids in (x_tokenized.input_ids, x_tokenized.attention_mask, y_tokenized.input_ids):
+            h.update(str(tuple(ids.shape)).encode())
+            h.update(ids.long().cpu().numpy().tobytes())
+        if possible_answer_mask is None:
+            h.update(b'unmasked')
+        else:
+            h.update(possible_answer_mask.bool().cpu().numpy().tobytes())
+        return h.hexdigest()
+
     def _create_full_text_ids(
-        self, full_text_input_ids: torch.Tensor) -> torch.Tensor:
+        self, full_text_tokenized: transformers.BatchEncoding) -> List[torch.Tensor]:
         """Creates input for generating explanation.
 
         Takes tokenized inputs (like: "Input: 7 8 Output: 15")
         and makes a full string that looks like "Data:\n\n Input: .... 15 \n\nExplanation:\n\n",
         using whatever template is defined by pre-data and post-data.
+
+        Padding is stripped from each example, so the outputs have different lengths.
         """
-        B = len(full_text_input_ids)
-        pre_data = self._pre_data_token_ids.repeat((B, 1)).to(device)
-        post_data = self._post_data_token_ids.repeat((B, 1)).to(device)
-        output = torch.cat((pre_data, full_text_input_ids, post_data), dim=1)
-        return output
+        pre_data = self._pre_data_token_ids.flatten().to(device)
+        post_data = self._post_data_token_ids.flatten().to(device)
+        attention_mask = full_text_tokenized.attention_mask.bool()
+        return [
+            torch.cat((pre_data, input_ids[mask], post_data), dim=0)
+            for input_ids, mask in zip(full_text_tokenized.input_ids, attention_mask)
+        ]
 
     def compute_loss_and_call_backward(
             self,
@@ -295,26 +501,21 @@ class iPrompt(AutoPrompt):
         num_min_occurrences = 2
 
         full_text_ids = self._create_full_text_ids(
-            full_text_input_ids=full_text_tokenized.input_ids,
+            full_text_tokenized=full_text_tokenized,
         )
         self._initialize_pop_once(full_text_ids=full_text_ids)
 
-        prefix_save_folder = os.path.join(self.args.save_dir_unique, 'prefix')
+        # (every prefix we score is logged to disk by the pool, along with the top ones at every step)
         df_to_print = self._prefix_pool.print(topk=10, min_occurrences=num_min_occurrences)
-        os.makedirs(prefix_save_folder, exist_ok=True)
-        prefix_out_file = os.path.join(prefix_save_folder, f'prefix_{self._step}.p')
-        df_to_print.to_pickle(prefix_out_file)
-        print(f'wrote {len(df_to_print)} prefixes to {prefix_out_file}')
+        self._prefix_pool.log_topk(df_to_print)
 
         # Grab new population
-        population_input_ids = self._get_population_and_random_generations(
-            full_text_ids=full_text_ids,
-        )
-        mutated_population_input_ids = self._mutate(
+        population_input_ids = self._get_population()
+        random_population_input_ids, mutated_population_input_ids = self._get_random_generations_and_mutations(
             population_input_ids=population_input_ids, full_text_ids=full_text_ids
         )
         full_population_input_ids = torch.cat(
-            (population_input_ids, mutated_population_input_ids), dim=0
+            (population_input_ids, random_population_input_ids, mutated_population_input_ids), dim=0
         )
         # Re-score new guys
         all_candidate_losses, all_candidate_n_correct = self._score_population(
@@ -328,11 +529,12 @@ class iPrompt(AutoPrompt):
         self._track_early_stopping()
 
         # Reset prefix IDs so that the model can be readily used for eval.
-        best_prefix_ids = min(self._prefix_pool._avg_loss, key=self._prefix_pool._avg_loss.get)
+        best_prefix_ids = self._prefix_pool.topk_all(k=1)[0]
         self._set_prefix_ids(torch.tensor(best_prefix_ids).to(device))
         self.prefix_embedding.requires_grad = False
 
         self._step += 1
+        self._prefix_pool.end_step(self._get_resume_state())
         return all_candidate_losses.min(), all_candidate_n_correct.max()
         
     def post_epoch(self, dataloader: torch.utils.data.DataLoader, possible_answer_mask: torch.Tensor) -> None:
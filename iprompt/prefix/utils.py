@@ -3,11 +3,18 @@ from typing import Any, Dict, List, Iterable, Optional, Tuple, Union
 import abc
 import argparse
 import collections
+import copy
 import dataclasses
 import functools
+import hashlib
 import heapq
+import json
+import math
+import os
+import pickle
 import random
 
+import numpy as np
 import pandas as pd
 import transformers
 import torch
@@ -15,6 +22,9 @@ from torch.utils.data import DataLoader
 from torch import nn
 import tqdm
 
+from ..answer_vocab import AnswerVocab
+from ..lm_head import get_logits_at_positions
+
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 DEBUG_VERBOSE = False
 
@@ -66,6 +76,22 @@ def get_prefix_from_mlm(
     return candidates
 
 
+def repeat_past_key_values(past_key_values: Any, repeats: int) -> Any:
+    """Repeats each row of `past_key_values` `repeats` times along the batch dimension.
+
+    Works both for legacy tuples of (key, value) tensors and for `transformers`
+    Cache objects (which are copied, since the model appends to them in place).
+    """
+    if hasattr(past_key_values, 'batch_repeat_interleave'):
+        past_key_values = copy.deepcopy(past_key_values)
+        past_key_values.batch_repeat_interleave(repeats)
+        return past_key_values
+    return tuple(
+        tuple(t.repeat_interleave(repeats, dim=0) for t in layer_past)
+        for layer_past in past_key_values
+    )
+
+
 def compute_log_ppl_loss(logits: torch.Tensor, input_ids: torch.Tensor) -> torch.Tensor:
     """Computes LM perplexity loss given logits for next tokens and original input IDs.
     Exponentiate this quantity if you want the actual perplexity.
@@ -177,6 +203,26 @@ class PrefixModel(nn.Module, abc.ABC):
         self.loss_func = loss_func
         self.model = model
         self.tokenizer = tokenizer
+        # max number of tokens to put through the model at once when scoring many prefixes
+        self._scoring_max_tokens = getattr(args, 'scoring_max_tokens', 2**14)
+        # how to score many prefixes: 'full' recomputes every token, 'kv_cache'
+        # encodes each prefix once and reuses its past_key_values for the data.
+        self._prefix_scoring_mode = getattr(args, 'prefix_scoring_mode', 'full')
+        assert self._prefix_scoring_mode in ['full', 'kv_cache'], f'unknown prefix scoring mode {self._prefix_scoring_mode}'
+        assert (self._prefix_scoring_mode != 'kv_cache') or (
+            type(self)._forward_with_cached_prefixes is not PrefixModel._forward_with_cached_prefixes
+        ), f'{self.__class__.__name__} does not support kv-cached prefix scoring'
+        # how to evaluate a final list of prefixes: 'full' scores every prefix on
+        # every batch, 'racing' drops prefixes as soon as they're clearly worse.
+        self._prefix_eval_mode = getattr(args, 'prefix_eval_mode', 'full')
+        assert self._prefix_eval_mode in ['full', 'racing'], f'unknown prefix eval mode {self._prefix_eval_mode}'
+        self._prefix_eval_racing_delta = getattr(args, 'prefix_eval_racing_delta', 0.05)
+        self._prefix_eval_racing_min_examples = getattr(args, 'prefix_eval_racing_min_examples', 64)
+        # how to score single-token answers when there's a possible-answer mask: 'full'
+        # computes logits for the whole vocab, 'restricted' only for the possible answers.
+        self._answer_head = getattr(args, 'answer_head', 'full')
+        assert self._answer_head in ['full', 'restricted'], f'unknown answer head {self._answer_head}'
+        self._answer_vocab_cache = (None, None)
 
     @property
     def id_to_word(self) -> Dict[int, str]:
@@ -234,6 +280,59 @@ class PrefixModel(nn.Module, abc.ABC):
             attention_mask=attention_mask,
         )
     
+    def _get_answer_vocab(self, possible_answer_mask: Optional[torch.Tensor], label_length: int) -> Optional[AnswerVocab]:
+        """The possible answers when using the restricted answer head (only for
+        single-token labels, since later label tokens need the whole vocab), else None.
+        """
+        if (self._answer_head != 'restricted') or (possible_answer_mask is None) or (label_length != 1):
+            return None
+        mask, answer_vocab = self._answer_vocab_cache
+        if mask is not possible_answer_mask:
+            answer_vocab = AnswerVocab(
+                possible_answer_mask.nonzero().flatten(), vocab_size=len(possible_answer_mask)
+            ).to(possible_answer_mask.device)
+            self._answer_vocab_cache = (possible_answer_mask, answer_vocab)
+        return answer_vocab
+
+    def _forward_label_logits(
+            self,
+            input_ids: torch.Tensor,
+            prefix_ids: Optional[torch.Tensor],
+            label_length: int,
+            answer_vocab: Optional[AnswerVocab] = None,
+        ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Like `forward`, but only computes logits at the positions that predict the
+        label tokens (see `_get_label_positions`), not at every position.
+
+        Returns:
+            full_input_ids (int torch.Tensor): IDs of the prefix & inputs, shape (batch_size, seq_length)
+            label_logits (float torch.Tensor): shape (batch_size, label_length, vocab_size),
+                or (batch_size, 1, len(answer_vocab)) if `answer_vocab` is given
+        """
+        new_input_ids, embeddings = self.embed_input_ids(
+            input_ids=input_ids, prefix_ids=prefix_ids
+        )
+        attention_mask = ~(new_input_ids == self.tokenizer.pad_token_id)
+        assert new_input_ids.shape == embeddings.shape[0:2]
+        label_logits = get_logits_at_positions(
+            self.model,
+            positions=self._get_label_positions(full_input_ids=new_input_ids, label_length=label_length),
+            vocab_ids=(answer_vocab.ids if answer_vocab is not None else None),
+            inputs_embeds=embeddings,
+            attention_mask=attention_mask,
+        )
+        return new_input_ids, label_logits
+
+    def _forward_with_cached_prefixes(
+            self,
+            input_ids: torch.Tensor,
+            prefix_ids: torch.Tensor,
+            label_length: int,
+            answer_vocab: Optional[AnswerVocab] = None,
+        ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """To be implemented by subclasses that support `prefix_scoring_mode='kv_cache'`."""
+        raise NotImplementedError(f'{self.__class__.__name__} does not support kv-cached prefix scoring')
+
     def pre_epoch(self) -> None:
         return
     
@@ -271,58 +370,115 @@ class PrefixModel(nn.Module, abc.ABC):
             print(f"start_word_id = {start_word_id}")
             return start_word_id.repeat((num_tokens,))
 
-    def _compute_loss_with_set_prefix(
+    def _append_next_token_ids(
             self,
             original_input_ids: torch.Tensor,
             next_token_ids: torch.Tensor,
-            possible_answer_mask: torch.Tensor,
-            prefix_ids: Optional[torch.Tensor] = None
         ) -> torch.Tensor:
-        # roll tensors together to put padding at the end. slow but I know it's right. (TODO: tensorize)
-        input_ids = []
+        """Puts `next_token_ids` directly after the last non-pad token of each row
+        of `original_input_ids`, so that padding ends up at the end of each row.
+        """
+        batch_size, input_length = original_input_ids.shape
+        label_length = next_token_ids.shape[1]
         num_pad_tokens = (original_input_ids == self.tokenizer.eos_token_id).sum(dim=1)
-        for i in range(len(original_input_ids)):
-            if num_pad_tokens[i] == 0:
-                next_tensor = torch.cat((original_input_ids[i], next_token_ids[i]), dim=0)
-            else:
-                num_non_pad_tokens = original_input_ids.shape[1] - num_pad_tokens[i]
-                padding = torch.full(size=(num_pad_tokens[i], ), fill_value=self.tokenizer.eos_token_id).to(device)
-                next_tensor = torch.cat((original_input_ids[i][:num_non_pad_tokens], next_token_ids[i], padding), dim=0)
-            input_ids.append(
-                next_tensor
-            )
+        num_non_pad_tokens = (input_length - num_pad_tokens)[:, None]
 
-        input_ids = torch.stack(input_ids)
+        # for every output position, figure out whether it comes from the input,
+        # the label or the padding, and gather from the right place.
+        positions = torch.arange(
+            input_length + label_length, device=original_input_ids.device
+        )[None].repeat((batch_size, 1))
+        label_positions = positions - num_non_pad_tokens
+        is_input = positions < num_non_pad_tokens
+        is_label = (label_positions >= 0) & (label_positions < label_length)
+        input_tokens = original_input_ids.gather(1, positions.clamp(max=input_length-1))
+        label_tokens = next_token_ids.to(original_input_ids.device).gather(
+            1, label_positions.clamp(min=0, max=label_length-1)
+        )
+        input_ids = torch.where(
+            is_input,
+            input_tokens,
+            torch.where(
+                is_label,
+                label_tokens,
+                torch.full_like(input_tokens, self.tokenizer.eos_token_id)
+            )
+        )
         assert input_ids.shape == (original_input_ids.shape[0], original_input_ids.shape[1] + next_token_ids.shape[1])
+        return input_ids
 
-        # feed into the model. prefix-handling is implemented in PrefixModel::forward.
-        full_input_ids, outputs = self.forward(
-            input_ids=input_ids,
-            prefix_ids=prefix_ids,
-        )
-        # make sure we have same number of predictions as tokens
-        assert full_input_ids.shape == outputs.logits.shape[:2]
+    def _get_label_positions(self, full_input_ids: torch.Tensor, label_length: int) -> torch.Tensor:
+        """Positions whose logits we need to score the labels in `full_input_ids`: the one
+        just before the first label token, then the last `label_length - 1` positions
+        (minus the final one) for multi-token labels.
 
-        # get first predicted token logits
+        Returns: int torch.Tensor of shape (batch_size, label_length)
+        """
+        batch_size, seq_length = full_input_ids.shape
         next_token_idx = (~(full_input_ids == self.tokenizer.eos_token_id)).cumsum(dim=1).argmax(dim=1)
-        next_token_logits = outputs.logits[torch.arange(len(original_input_ids)), next_token_idx-1]
+        other_positions = torch.arange(
+            seq_length - label_length, seq_length - 1, device=full_input_ids.device
+        )[None].repeat((batch_size, 1))
+        return torch.cat(((next_token_idx - 1)[:, None], other_positions), dim=1)
+
+    def _compute_example_losses(
+            self,
+            label_logits: torch.Tensor,
+            next_token_ids: torch.Tensor,
+            possible_answer_mask: Optional[torch.Tensor],
+            answer_vocab: Optional[AnswerVocab] = None,
+        ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Computes the loss and first-token correctness for every row of a batch.
+
+        Args:
+            label_logits (float torch.Tensor): logits at the positions from `_get_label_positions`,
+                shape (batch_size, label_length, vocab_size)
+            answer_vocab (Optional AnswerVocab): the possible answers, if `label_logits`
+                only has their columns (see `_get_answer_vocab`)
+
+        Returns:
+            losses (float torch.Tensor): loss for each example, shape (batch_size,)
+            correct (bool torch.Tensor): whether the first token was predicted
+                correctly for each example, shape (batch_size,)
+        """
+        b, label_sequence_length = next_token_ids.shape
+        assert label_logits.shape[:2] == (b, label_sequence_length)
+
+        # get first predicted token logits
+        next_token_logits = label_logits[:, 0]
+
+        if answer_vocab is not None:
+            # logits are only for the possible answers, so index labels by their column
+            # (-100, which cross_entropy ignores, for labels that aren't possible answers)
+            assert label_sequence_length == 1
+            targets = next_token_ids[:, 0]
+            compact_targets = answer_vocab.to_compact(targets)
+            correct = (next_token_logits.argmax(dim=-1) == compact_targets)
+            losses = torch.nn.functional.cross_entropy(
+                input=next_token_logits, target=compact_targets, reduction='none'
+            )
+            # same as masking the full vocab: labels that aren't possible answers get
+            # infinite loss, and padding is ignored
+            losses = torch.where(compact_targets != -100, losses, torch.full_like(losses, float('inf')))
+            losses = torch.where(targets == self.tokenizer.pad_token_id, torch.zeros_like(losses), losses)
+            return losses, correct
 
         # compute first-token acc
         if possible_answer_mask is None:
-            n_correct = (
+            correct = (
                 next_token_logits.argmax(dim=-1) == next_token_ids[:, 0]
-            ).int().sum()
+            )
         else:
             # apply possible answer mask for single-token
             next_token_logits = torch.where(
                 possible_answer_mask[None],
                 next_token_logits, torch.tensor(float('-inf')).to(device)
             )
-            n_correct = (
+            correct = (
                 (next_token_logits.exp() * possible_answer_mask).argmax(dim=-1)
                     ==
                 next_token_ids[:, 0]
-            ).int().sum()
+            )
 
         # compute loss from first token
         original_losses = torch.nn.functional.cross_entropy(
@@ -333,10 +489,9 @@ class PrefixModel(nn.Module, abc.ABC):
         )
 
         # add loss from other tokens
-        b, label_sequence_length = next_token_ids.shape
         if label_sequence_length > 1:
             other_next_token_logits = (
-                outputs.logits[:, -label_sequence_length:-1]
+                label_logits[:, 1:]
                     .reshape((b * (label_sequence_length-1), -1))
             )
             other_next_token_ids = (
@@ -349,23 +504,183 @@ class PrefixModel(nn.Module, abc.ABC):
                 ignore_index=self.tokenizer.pad_token_id,
                 reduction='none'
             )
-            # take the mean of losses on the batch level, and normalize for length
+            # normalize for length
             all_losses = torch.cat(
                 (original_losses[:, None], other_losses.reshape((b, -1))), dim=1
             )
             num_tokens_per_output = (
                 ~(next_token_ids == self.tokenizer.bos_token_id)).sum(dim=1)
-            all_losses = all_losses.sum(dim=1) / num_tokens_per_output
-            assert all_losses.shape == (b,)
-            loss = all_losses.mean()
+            losses = all_losses.sum(dim=1) / num_tokens_per_output
         else:
-            loss = original_losses.mean()
+            losses = original_losses
+        assert losses.shape == (b,)
+        return losses, correct
+
+    def _compute_loss_with_set_prefix(
+            self,
+            original_input_ids: torch.Tensor,
+            next_token_ids: torch.Tensor,
+            possible_answer_mask: torch.Tensor,
+            prefix_ids: Optional[torch.Tensor] = None
+        ) -> torch.Tensor:
+        input_ids = self._append_next_token_ids(
+            original_input_ids=original_input_ids, next_token_ids=next_token_ids
+        )
+
+        # feed into the model. prefix-handling is implemented in PrefixModel::embed_input_ids.
+        answer_vocab = self._get_answer_vocab(possible_answer_mask, label_length=next_token_ids.shape[1])
+        full_input_ids, label_logits = self._forward_label_logits(
+            input_ids=input_ids,
+            prefix_ids=prefix_ids,
+            label_length=next_token_ids.shape[1],
+            answer_vocab=answer_vocab,
+        )
+        losses, correct = self._compute_example_losses(
+            label_logits=label_logits,
+            next_token_ids=next_token_ids,
+            possible_answer_mask=possible_answer_mask,
+            answer_vocab=answer_vocab,
+        )
+        # take the mean of losses on the batch level
+        loss = losses.mean()
+        n_correct = correct.int().sum()
         
         if DEBUG_VERBOSE: 
             print(f">> loss for input string: {self.tokenizer.decode(full_input_ids[0])}")
             print(f"\tLoss = {loss:.3f}")
 
         return full_input_ids, loss, n_correct
+
+    @torch.no_grad()
+    def _compute_loss_with_set_prefixes(
+            self,
+            original_input_ids: torch.Tensor,
+            next_token_ids: torch.Tensor,
+            possible_answer_mask: Optional[torch.Tensor],
+            prefix_ids: torch.Tensor,
+        ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Scores many candidate prefixes on the same batch of data.
+
+        Every (candidate, example) pair is stacked into one big batch, which is
+        split into chunks of at most `self._scoring_max_tokens` tokens so that
+        a step costs a few large forward passes instead of one per candidate.
+
+        Args:
+            original_input_ids (int torch.Tensor): input IDs for the batch, shape (batch_size, seq_length)
+            next_token_ids (int torch.Tensor): label IDs for the batch, shape (batch_size, label_length)
+            possible_answer_mask (Optional bool torch.Tensor): mask over vocab of possible answers
+            prefix_ids (int torch.Tensor): one prefix per row, shape (num_candidates, num_prefix_tokens)
+
+        Returns:
+            losses (float torch.Tensor): mean loss for each candidate, shape (num_candidates,)
+            n_correct (int torch.Tensor): number of correct examples for each candidate, shape (num_candidates,)
+        """
+        assert prefix_ids.ndim == 2, "need a 2D tensor of prefix IDs (num_candidates, num_prefix_tokens)"
+        num_candidates = len(prefix_ids)
+        batch_size = len(original_input_ids)
+        if num_candidates == 0:
+            return torch.zeros(0).to(device), torch.zeros(0, dtype=int).to(device)
+        input_ids = self._append_next_token_ids(
+            original_input_ids=original_input_ids, next_token_ids=next_token_ids
+        )
+
+        # figure out how many candidates fit in a single forward pass
+        num_tokens_per_candidate = batch_size * (input_ids.shape[1] + prefix_ids.shape[1])
+        num_candidates_per_chunk = max(1, self._scoring_max_tokens // num_tokens_per_candidate)
+        answer_vocab = self._get_answer_vocab(possible_answer_mask, label_length=next_token_ids.shape[1])
+
+        all_losses = []
+        all_n_correct = []
+        for start_idx in range(0, num_candidates, num_candidates_per_chunk):
+            chunk_prefix_ids = prefix_ids[start_idx : start_idx + num_candidates_per_chunk]
+            n = len(chunk_prefix_ids)
+            # rows are ordered candidate-major: (cand_0, ex_0), (cand_0, ex_1), ...
+            if self._prefix_scoring_mode == 'kv_cache':
+                _full_input_ids, label_logits = self._forward_with_cached_prefixes(
+                    input_ids=input_ids, prefix_ids=chunk_prefix_ids,
+                    label_length=next_token_ids.shape[1],
+                    answer_vocab=answer_vocab,
+                )
+            else:
+                _full_input_ids, label_logits = self._forward_label_logits(
+                    input_ids=input_ids.repeat((n, 1)),
+                    prefix_ids=chunk_prefix_ids.repeat_interleave(batch_size, dim=0),
+                    label_length=next_token_ids.shape[1],
+                    answer_vocab=answer_vocab,
+                )
+            losses, correct = self._compute_example_losses(
+                label_logits=label_logits,
+                next_token_ids=next_token_ids.repeat((n, 1)),
+                possible_answer_mask=possible_answer_mask,
+                answer_vocab=answer_vocab,
+            )
+            all_losses.append(losses.reshape((n, batch_size)).mean(dim=1))
+            all_n_correct.append(correct.reshape((n, batch_size)).int().sum(dim=1))
+
+        return torch.cat(all_losses, dim=0), torch.cat(all_n_correct, dim=0)
+    
+    @torch.no_grad()
+    def _race_prefixes(
+            self,
+            prefix_ids: torch.Tensor,
+            batches: Iterable[Tuple[torch.Tensor, torch.Tensor]],
+            num_batches: int,
+            possible_answer_mask: Optional[torch.Tensor],
+        ) -> Tuple[List[float], List[float], List[int]]:
+        """Evaluates prefixes by racing: every surviving prefix is scored on each batch,
+        and once it has seen `self._prefix_eval_racing_min_examples` examples, a prefix
+        is dropped when the upper confidence bound on its accuracy falls below the best
+        lower bound. Bounds are Hoeffding bounds, union-bounded over prefixes and batches
+        so that the best prefix survives with prob. at least 1 - `self._prefix_eval_racing_delta`.
+
+        Prefixes are ranked by accuracy first (see `AutoPrompt.serialize`), so we only
+        race on accuracy; loss is just a tiebreaker and can't safely knock anything out.
+
+        Args:
+            prefix_ids (int torch.Tensor): one prefix per row, shape (num_prefixes, num_prefix_tokens)
+            batches: iterable of (input_ids, next_token_ids) pairs
+            num_batches (int): number of batches in `batches`, used for the union bound
+            possible_answer_mask (Optional bool torch.Tensor): mask over vocab of possible answers
+
+        Returns:
+            losses (List[float]): mean loss per example for each prefix
+            accuracies (List[float]): accuracy for each prefix
+            num_examples (List[int]): number of examples each prefix was scored on
+        """
+        num_prefixes = len(prefix_ids)
+        sum_loss = torch.zeros(num_prefixes, dtype=torch.float64)
+        n_correct = torch.zeros(num_prefixes, dtype=torch.float64)
+        num_examples = torch.zeros(num_prefixes, dtype=torch.int64)
+        alive = torch.ones(num_prefixes, dtype=torch.bool)
+        log_term = math.log(2 * num_prefixes * max(num_batches, 1) / self._prefix_eval_racing_delta)
+
+        for input_ids, next_token_ids in batches:
+            alive_idxs = alive.nonzero().flatten()
+            batch_size = len(input_ids)
+            losses, cand_n_correct = self._compute_loss_with_set_prefixes(
+                original_input_ids=input_ids,
+                next_token_ids=next_token_ids,
+                possible_answer_mask=possible_answer_mask,
+                prefix_ids=prefix_ids[alive_idxs.to(prefix_ids.device)],
+            )
+            sum_loss[alive_idxs] += losses.double().cpu() * batch_size
+            n_correct[alive_idxs] += cand_n_correct.double().cpu()
+            num_examples[alive_idxs] += batch_size
+
+            n = num_examples[alive_idxs]
+            if (len(alive_idxs) <= 1) or (n.min() < self._prefix_eval_racing_min_examples):
+                continue
+            accuracy = n_correct[alive_idxs] / n
+            radius = torch.sqrt(log_term / (2 * n))
+            best_lower_bound = (accuracy - radius).max()
+            alive[alive_idxs[(accuracy + radius) < best_lower_bound]] = False
+
+        denom = num_examples.clamp(min=1)
+        return (
+            (sum_loss / denom).tolist(),
+            (n_correct / denom).tolist(),
+            num_examples.tolist()
+        )
     
     def compute_loss_and_call_backward(
             self,
@@ -407,34 +722,252 @@ class PrefixModel(nn.Module, abc.ABC):
         return False
 
 
-def mean(_list: List[Union[int, float]]) -> float:
-    return sum(_list) / len(_list)
+class LRUCache:
+    """Bounded mapping that evicts the least-recently-used key, and counts hits and misses."""
+    max_size: int
+    num_hits: int
+    num_misses: int
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.num_hits = 0
+        self.num_misses = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.num_hits += 1
+            return self._data[key]
+        self.num_misses += 1
+        return default
+
+    def put(self, key: Any, value: Any) -> None:
+        if self.max_size <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class TokenizedDataset(torch.utils.data.Dataset):
+    """Dataset that tokenizes every example once, instead of once per batch per epoch.
+
+    Token IDs for the model inputs (`x`), answers (`y`) and full text (`text`) are
+    stored as flat int32 arrays with per-example lengths, and `collate` pads each
+    batch to its own longest example. If `cache_dir` is set, the arrays are saved
+    there, keyed by `cache_name` plus a hash of the text, so that sweeps over the
+    same (checkpoint, task, template) skip tokenization altogether.
+    """
+    fields = ('x', 'y', 'text')
+
+    def __init__(
+            self,
+            dset: Any, # datasets.Dataset
+            tokenizer: transformers.PreTrainedTokenizer,
+            prepare_batch,
+            max_length: int,
+            input_column: str = 'input',
+            cache_dir: Optional[str] = None,
+            cache_name: str = 'dset',
+        ):
+        self.dset = dset
+        self.tokenizer = tokenizer
+        self.input_column = input_column
+        batch = dset[:]
+        x_text, y_text = prepare_batch(batch={'input': batch[input_column], 'output': batch['output']})
+        texts = {'x': x_text, 'y': y_text, 'text': batch['text']}
+
+        cache_path = None
+        if cache_dir is not None:
+            h = hashlib.sha1(f'{type(tokenizer).__name__}/{tokenizer.name_or_path}/{max_length}'.encode())
+            for field in self.fields:
+                h.update(json.dumps(texts[field]).encode())
+            cache_name = cache_name.replace('/', '_').replace(os.sep, '_')
+            cache_path = os.path.join(cache_dir, f'{cache_name}__{h.hexdigest()[:16]}.npz')
+
+        if (cache_path is not None) and os.path.exists(cache_path):
+            arrays = np.load(cache_path)
+            self._ids = {field: arrays[f'{field}_ids'] for field in self.fields}
+            self._lengths = {field: arrays[f'{field}_lengths'] for field in self.fields}
+        else:
+            self._ids, self._lengths = {}, {}
+            for field in self.fields:
+                encoded = tokenizer(texts[field], truncation=True, max_length=max_length)['input_ids']
+                self._lengths[field] = np.array([len(ids) for ids in encoded], dtype=np.int32)
+                self._ids[field] = np.fromiter(
+                    (i for ids in encoded for i in ids), dtype=np.int32, count=self._lengths[field].sum()
+                )
+            if cache_path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = cache_path + '.tmp.npz'
+                np.savez(tmp_path, **{
+                    f'{field}_{name}': arrays[field]
+                    for field in self.fields
+                    for name, arrays in (('ids', self._ids), ('lengths', self._lengths))
+                })
+                os.replace(tmp_path, cache_path)
+        self._offsets = {
+            field: np.concatenate(([0], np.cumsum(self._lengths[field])))
+            for field in self.fields
+        }
+
+    def __len__(self) -> int:
+        return len(self._lengths['x'])
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        example = dict(self.dset[idx])
+        example['_idx'] = idx
+        return example
+
+    def token_ids(self, field: str, idx: int) -> np.ndarray:
+        offset = self._offsets[field][idx]
+        return self._ids[field][offset : offset + self._lengths[field][idx]]
+
+    def lengths(self, field: str = 'x') -> np.ndarray:
+        return self._lengths[field]
+
+    @property
+    def first_answer_token_ids(self) -> torch.Tensor:
+        """First token of every answer, shape (len(self),)."""
+        return torch.tensor(self._ids['y'][self._offsets['y'][:-1]], dtype=torch.int64)
+
+    def _pad(self, field: str, idxs: List[int]) -> transformers.BatchEncoding:
+        lengths = self._lengths[field][idxs]
+        input_ids = torch.full((len(idxs), max(lengths.max(initial=0), 1)), self.tokenizer.pad_token_id, dtype=torch.int64)
+        attention_mask = torch.zeros(input_ids.shape, dtype=torch.int64)
+        for row, (idx, length) in enumerate(zip(idxs, lengths)):
+            # match the tokenizer's padding side, same as padding='longest'
+            cols = slice(0, length) if (self.tokenizer.padding_side == 'right') else slice(input_ids.shape[1] - length, None)
+            input_ids[row, cols] = torch.from_numpy(self.token_ids(field, idx).astype(np.int64))
+            attention_mask[row, cols] = 1
+        return transformers.BatchEncoding({'input_ids': input_ids, 'attention_mask': attention_mask})
+
+    def collate(self, examples: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Collates raw text fields into lists (like the default collate) and adds
+        `x_tokenized`, `y_tokenized` and `text_tokenized`, dynamically padded."""
+        idxs = [example.pop('_idx') for example in examples]
+        batch = {key: [example[key] for example in examples] for key in examples[0]}
+        for field in self.fields:
+            batch[f'{field}_tokenized'] = self._pad(field=field, idxs=idxs)
+        return batch
+
+
+class LengthBucketedBatchSampler(torch.utils.data.Sampler):
+    """Shuffled batch sampler that puts examples of similar length in the same batch,
+    so that dynamic padding (see `TokenizedDataset.collate`) wastes fewer tokens.
+
+    Every epoch, examples are shuffled and split into pools of
+    `batch_size * bucket_size_multiplier` examples; each pool is sorted by length
+    and cut into batches, and the order of the batches is shuffled. Batches either
+    have a fixed `batch_size`, or, if `max_tokens` is set, are as large as possible
+    while keeping (num_examples * longest_example) <= `max_tokens`.
+    """
+    def __init__(
+            self,
+            lengths: np.ndarray,
+            batch_size: int,
+            max_tokens: Optional[int] = None,
+            bucket_size_multiplier: int = 50,
+            seed: int = 0,
+        ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.seed = seed
+        self.epoch = 0
+        self._batches = None
+
+    def _make_batches(self) -> List[List[int]]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        idxs = rng.permutation(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_size_multiplier
+        batches = []
+        for start_idx in range(0, len(idxs), pool_size):
+            pool = idxs[start_idx : start_idx + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            if self.max_tokens is None:
+                batches.extend(pool[i : i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size))
+                continue
+            batch = []
+            for idx in pool.tolist():
+                # pool is sorted, so the new example is always the longest
+                if batch and (len(batch) + 1) * self.lengths[idx] > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                batch.append(idx)
+            if batch:
+                batches.append(batch)
+        rng.shuffle(batches)
+        return batches
+
+    def __len__(self) -> int:
+        if self._batches is None:
+            self._batches = self._make_batches()
+        return len(self._batches)
+
+    def __iter__(self):
+        if self._batches is None:
+            self._batches = self._make_batches()
+        batches, self._batches = self._batches, None
+        self.epoch += 1
+        return iter(batches)
 
 
 class PrefixPool:
-    """Tracks a pool of candidate prefixes and their associated metrics over time."""
+    """Tracks a pool of candidate prefixes and their associated metrics over time.
+
+    Keeps running count/sum/sum-of-squares stats for each prefix, so an update
+    is O(1), and a lazily-invalidated heap of (score, prefix) per `min_occurrences`
+    threshold, so `topk` only touches the top of the heap.
+    """
     criterion: str
     tokenizer: transformers.PreTrainedTokenizer
     # 
-    _all_losses: Dict[Tuple[int], List[float]]
+    _num_occurrences: Dict[Tuple[int], int]
+    _sum_loss: Dict[Tuple[int], float]
+    _sumsq_loss: Dict[Tuple[int], float]
     _avg_loss: Dict[Tuple[int], float]
-    _all_accuracy: Dict[Tuple[int], List[float]]
+    _sum_accuracy: Dict[Tuple[int], float]
     _avg_accuracy: Dict[Tuple[int], float]
     _best_prefix_by_start_token: Dict[int, Tuple[Tuple[int], float]]
+    _heaps: Dict[int, List[Tuple[Tuple[float], Tuple[int]]]]
 
     def __init__(self, tokenizer: transformers.PreTrainedTokenizer, criterion: str):
         self.tokenizer = tokenizer
         self.criterion = criterion
+        # tuple (input_ids) -> int (number of times scored)
+        self._num_occurrences = collections.defaultdict(int)
         # tuple (input_ids) -> float (loss)
         self._avg_loss = {}
-        self._all_losses = collections.defaultdict(list)
-        # tuple (input_ids) -> int (n_correct)
+        self._sum_loss = collections.defaultdict(float)
+        self._sumsq_loss = collections.defaultdict(float)
+        # tuple (input_ids) -> float (accuracy)
         self._avg_accuracy = {}
-        self._all_accuracy = collections.defaultdict(list)
+        self._sum_accuracy = collections.defaultdict(float)
         # 
         self._best_prefix_by_start_token = {}
+        # min_occurrences -> heap of (score, prefix). entries go stale when a prefix
+        # is updated, and are dropped when they reach the top of the heap.
+        self._heaps = {}
         # 
         self._topk_strategy = 'different_start_token' # ['different_start_token', 'all']
+        # on-disk log of observations + checkpoints (see `open_log`)
+        self.step = 0
+        self._log_dir = None
+        self._log_file = None
+        self._num_checkpoints = 0
+        self._checkpoint_interval = 50
+        self._state = {}
+        self._loaded_log_path = None
     
     @property
     def prefixes(self) -> List[Tuple[int]]:
@@ -444,24 +977,34 @@ class PrefixPool:
     def num_start_tokens(self) -> int:
         """Number of different start tokens seen across all prefixes."""
         return len(self._best_prefix_by_start_token.keys())
+
+    def num_occurrences(self, prefix: Tuple[int]) -> int:
+        """Number of times `prefix` has been scored."""
+        return self._num_occurrences.get(prefix, 0)
+
+    def avg_loss(self, prefix: Tuple[int]) -> float:
+        return self._avg_loss[prefix]
+
+    def avg_accuracy(self, prefix: Tuple[int]) -> float:
+        return self._avg_accuracy[prefix]
+
+    def std_loss(self, prefix: Tuple[int]) -> float:
+        """Standard deviation of the losses observed for `prefix`."""
+        n = self.num_occurrences(prefix)
+        if n < 2:
+            return 0.0
+        variance = (self._sumsq_loss[prefix] - (self._sum_loss[prefix] ** 2) / n) / (n - 1)
+        return max(variance, 0.0) ** 0.5
     
     def print(self, topk: int, min_occurrences: int = 2) -> pd.DataFrame:
         top_token_ids = self.topk(k=topk, min_occurrences=min_occurrences)
-        ########################### Debugging code ##########################
-        # import pandas as pd
-        # vd = pd.DataFrame(self._avg_loss.items(), columns=['prefix', 'loss'])
-        # vd['prefix_str'] = vd['prefix'].map(self.tokenizer.decode)
-        # vd['n'] = vd['prefix'].map(lambda p: len(self._all_losses[p]))
-        # vd.sort_values(by='loss')["prefix_str"].iloc[:25]
-        # vd.sort_values(by=['n', 'loss'], ascending=[False, True])[["n", "prefix_str"]].iloc[:25]
-        #####################################################################
         if not len(top_token_ids): return
         print((" " * 45), ("*" * 20), "Population", ("*" * 20))
         output_rows = []
         for idx, token_ids in enumerate(top_token_ids):
             prefix = self.tokenizer.decode(list(token_ids))
-            loss = self._avg_loss[token_ids]
-            acc = self._avg_accuracy[token_ids]
+            loss = self.avg_loss(token_ids)
+            acc = self.avg_accuracy(token_ids)
             prefix_str = "{:>65}".format(prefix.replace("\n", "\\\\n"))
             loss_str = f"{loss:.3f}"
             acc_str = f"{acc*100:.1f}"
@@ -472,9 +1015,14 @@ class PrefixPool:
     
     def initialize_prefix(self, prefix: torch.Tensor):
         prefix = tuple(prefix.cpu().tolist())
+        self._initialize_prefix(prefix)
+        self._log({'type': 'init', 'prefix': prefix})
+
+    def _initialize_prefix(self, prefix: Tuple[int]):
         self._avg_loss[prefix] = 10_000.0
         self._avg_accuracy[prefix] = 0
         self._best_prefix_by_start_token.setdefault(prefix[0], (prefix, (10_000.0,)))
+        self._push(prefix)
 
     def topk(self, *args, **kwargs) -> List[Tuple[int]]:
         if self._topk_strategy == 'different_start_token':
@@ -501,12 +1049,7 @@ class PrefixPool:
         n_so_far = len(top_prefixes)
         if n_so_far < k:
             # fallback if we don't have enough first-tokens yet
-            # more_prefixes = (
-            #     set(self.topk_all(k=k, min_occurrences=min_occurrences))
-            #     - set(top_prefixes)
-            # )
             num_prefixes_to_add = k - len(top_prefixes)
-            # num_prefixes_to_add = min(len(more_prefixes), num_prefixes_to_add)
             more_prefixes = [
                 random.choice(top_prefixes) for _ in range(num_prefixes_to_add)
             ]
@@ -515,20 +1058,53 @@ class PrefixPool:
         return top_prefixes
 
     def topk_all(self, k: int, min_occurrences: Optional[int] = None) -> List[Tuple[int]]:
-        all_prefixes = self._avg_loss.keys()
-        return self._topk_from_prefixes(
-            all_prefixes, k=k, min_occurrences=min_occurrences
-        )
+        min_occurrences = min_occurrences or 0
+        heap = self._get_heap(min_occurrences)
+        # pop until we have k live entries, then put the live ones back.
+        top_entries = []
+        seen = set()
+        while heap and len(top_entries) < k:
+            score, prefix = heapq.heappop(heap)
+            if (prefix in seen) or (score != self._score(prefix)):
+                continue # stale or duplicate entry
+            seen.add(prefix)
+            top_entries.append((score, prefix))
+        for entry in top_entries:
+            heapq.heappush(heap, entry)
+        return [prefix_ids for _, prefix_ids in top_entries]
     
     def _score(self, prefix: Tuple[int]) -> Tuple[float]:
         criterion = self.criterion
         if criterion == 'loss':
             # sort by min loss
-            return (self._avg_loss[prefix], )
+            return (self.avg_loss(prefix), )
         elif criterion == 'combined':
-            return (-1 * round(self._avg_accuracy[prefix], 2), self._avg_loss[prefix])
+            return (-1 * round(self.avg_accuracy(prefix), 2), self.avg_loss(prefix))
         else:
-            return (-1 * self._avg_accuracy[prefix], 2)
+            return (-1 * self.avg_accuracy(prefix), 2)
+
+    def _is_eligible(self, prefix: Tuple[int], min_occurrences: int) -> bool:
+        return (not min_occurrences) or (self.num_occurrences(prefix) > min_occurrences)
+
+    def _get_heap(self, min_occurrences: int) -> List[Tuple[Tuple[float], Tuple[int]]]:
+        """Heap for a `min_occurrences` threshold. Built once the first time it's queried,
+        then kept up-to-date by `update`. Compacted when it fills up with stale entries.
+        """
+        heap = self._heaps.get(min_occurrences)
+        if (heap is None) or (len(heap) > 2 * len(self) + 1024):
+            heap = [
+                (self._score(p), p) for p in self.prefixes
+                if self._is_eligible(p, min_occurrences)
+            ]
+            heapq.heapify(heap)
+            self._heaps[min_occurrences] = heap
+        return heap
+
+    def _push(self, prefix: Tuple[int]) -> None:
+        score = self._score(prefix)
+        for min_occurrences, heap in self._heaps.items():
+            if self._is_eligible(prefix, min_occurrences):
+                heapq.heappush(heap, (score, prefix))
     
     def _topk_from_prefixes(
         self,
@@ -539,7 +1115,7 @@ class PrefixPool:
         if min_occurrences:
             prefixes = {
                 prefix for prefix in prefixes
-                if len(self._all_accuracy[prefix]) > min_occurrences
+                if self.num_occurrences(prefix) > min_occurrences
             }
 
         population = [(self._score(p), p) for p in prefixes]
@@ -548,19 +1124,336 @@ class PrefixPool:
         return [prefix_ids for _, prefix_ids in topk_pop]
 
     def update(self, prefix: torch.Tensor, loss: torch.Tensor, accuracy: torch.Tensor):
-        # todo abstract these data strcutures into a class
         prefix = tuple(prefix.cpu().flatten().tolist())
-        self._all_losses[prefix].append(loss.item())
-        self._avg_loss[prefix] = mean(self._all_losses[prefix])
-        self._all_accuracy[prefix].append(accuracy.item())
-        self._avg_accuracy[prefix] = mean(self._all_accuracy[prefix])
+        loss = loss.item()
+        accuracy = accuracy.item()
+        self._add_observation(prefix, loss, accuracy)
+        self._log({'type': 'update', 'prefix': prefix, 'loss': loss, 'accuracy': accuracy, 'step': self.step})
 
+    def _add_observation(self, prefix: Tuple[int], loss: float, accuracy: float):
+        self._num_occurrences[prefix] += 1
+        n = self._num_occurrences[prefix]
+        self._sum_loss[prefix] += loss
+        self._sumsq_loss[prefix] += loss ** 2
+        self._avg_loss[prefix] = self._sum_loss[prefix] / n
+        self._sum_accuracy[prefix] += accuracy
+        self._avg_accuracy[prefix] = self._sum_accuracy[prefix] / n
+        self._push(prefix)
+        self._update_best_prefix_by_start_token(prefix)
+
+    def _update_best_prefix_by_start_token(self, prefix: Tuple[int]):
         # track best score for each starting token
         self._best_prefix_by_start_token.setdefault(prefix[0], (prefix, (1000.0,)))
         score = self._score(prefix)
         best_prefix, best_score = self._best_prefix_by_start_token[prefix[0]]
         if score < best_score:
             self._best_prefix_by_start_token[prefix[0]] = (prefix, score)
+
+    def _export_stats(self) -> List[Tuple]:
+        """Stats for every prefix, as rows of
+        (prefix, n, sum_loss, sumsq_loss, avg_loss, sum_accuracy, avg_accuracy).
+        """
+        return [
+            (
+                p, self._num_occurrences.get(p, 0), self._sum_loss.get(p, 0.0), self._sumsq_loss.get(p, 0.0),
+                self._avg_loss[p], self._sum_accuracy.get(p, 0.0), self._avg_accuracy[p]
+            )
+            for p in self._avg_loss.keys()
+        ]
+
+    def _import_stats(self, rows: List[Tuple]):
+        for p, n, sum_loss, sumsq_loss, avg_loss, sum_accuracy, avg_accuracy in rows:
+            if n:
+                self._num_occurrences[p] = n
+            self._sum_loss[p] = sum_loss
+            self._sumsq_loss[p] = sumsq_loss
+            self._avg_loss[p] = avg_loss
+            self._sum_accuracy[p] = sum_accuracy
+            self._avg_accuracy[p] = avg_accuracy
+        self._heaps = {}
+
+    ############################################################################
+    # Persistence. Every observation is appended to a log, and every
+    # `_checkpoint_interval` steps all the stats are written to a compact
+    # checkpoint and a new log is started. The top prefixes at every step are
+    # also appended to `topk.jsonl`, which is never truncated.
+    ############################################################################
+    def open_log(self, log_dir: str, checkpoint_interval: int = 50):
+        """Starts logging to `log_dir`, so that the pool can be rebuilt with `load`."""
+        os.makedirs(log_dir, exist_ok=True)
+        self._log_dir = log_dir
+        self._checkpoint_interval = checkpoint_interval
+        self.save_checkpoint()
+
+    def _log(self, record: Dict[str, Any]):
+        if self._log_file is None:
+            return
+        self._log_file.write(json.dumps(record) + '\n')
+
+    def log_topk(self, df: Optional[pd.DataFrame]):
+        """Appends the top prefixes at this step (as returned by `print`) to `topk.jsonl`."""
+        if (self._log_dir is None) or (df is None):
+            return
+        record = {'step': self.step, **{column: df[column].tolist() for column in ['prefix', 'loss', 'accuracy']}}
+        with open(os.path.join(self._log_dir, 'topk.jsonl'), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def end_step(self, state: Dict[str, Any]):
+        """Records the end of a training step, along with any state (like early-stopping
+        counters) needed to resume from here. Checkpoints if it's time to.
+        """
+        self._state = state
+        self._log({'type': 'state', 'step': self.step, 'state': state})
+        if self._log_file is not None:
+            self._log_file.flush()
+        self.step += 1
+        if (self._log_dir is not None) and (self.step % self._checkpoint_interval == 0):
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        """Writes all stats to a checkpoint, then switches to a fresh log."""
+        old_log_path = self._log_file.name if self._log_file is not None else None
+        self._num_checkpoints += 1
+        log_name = f'log_{self._num_checkpoints}.jsonl'
+        checkpoint = {
+            'stats': self._export_stats(),
+            'best_prefix_by_start_token': self._best_prefix_by_start_token,
+            'step': self.step,
+            'state': self._state,
+            'num_checkpoints': self._num_checkpoints,
+            'log_name': log_name,
+        }
+        checkpoint_path = os.path.join(self._log_dir, 'checkpoint.p')
+        with open(checkpoint_path + '.tmp', 'wb') as f:
+            pickle.dump(checkpoint, f)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+        if self._log_file is not None:
+            self._log_file.close()
+        self._log_file = open(os.path.join(self._log_dir, log_name), 'a')
+        if old_log_path is not None and os.path.exists(old_log_path):
+            os.remove(old_log_path)
+
+    def load(self, log_dir: str) -> Dict[str, Any]:
+        """Rebuilds the pool from the checkpoint and log in `log_dir`.
+
+        Returns: the state passed to the last `end_step` call.
+        """
+        with open(os.path.join(log_dir, 'checkpoint.p'), 'rb') as f:
+            checkpoint = pickle.load(f)
+        self._import_stats(checkpoint['stats'])
+        self._best_prefix_by_start_token.update(checkpoint['best_prefix_by_start_token'])
+        self.step = checkpoint['step']
+        self._state = checkpoint['state']
+        self._num_checkpoints = max(self._num_checkpoints, checkpoint['num_checkpoints'])
+
+        log_path = os.path.join(log_dir, checkpoint['log_name'])
+        if os.path.exists(log_path):
+            self._loaded_log_path = log_path
+            with open(log_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break # partially-written last line
+                    if record['type'] == 'init':
+                        self._initialize_prefix(tuple(record['prefix']))
+                    elif record['type'] == 'update':
+                        self._add_observation(tuple(record['prefix']), record['loss'], record['accuracy'])
+                    elif record['type'] == 'state':
+                        self._state = record['state']
+                        self.step = record['step'] + 1
+
+        # carry over the top-k history up to the step we resume from
+        topk_path = os.path.join(log_dir, 'topk.jsonl')
+        if (self._log_dir is not None) and (self._log_dir != log_dir) and os.path.exists(topk_path):
+            with open(topk_path, 'r') as f, open(os.path.join(self._log_dir, 'topk.jsonl'), 'a') as out_f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break # partially-written last line
+                    if record['step'] < self.step:
+                        out_f.write(line)
+        return self._state
+
+    def remove_loaded_log(self):
+        """Removes the log replayed by `load`, once its observations are in a checkpoint of ours."""
+        if (self._loaded_log_path is not None) and os.path.exists(self._loaded_log_path):
+            os.remove(self._loaded_log_path)
+        self._loaded_log_path = None
     
     def __len__(self) -> int:
         return len(self._avg_loss)
+
+
+class CompactPrefixPool(PrefixPool):
+    """PrefixPool that stores prefixes and their stats in preallocated NumPy arrays
+    instead of dicts keyed by tuples.
+
+    Each prefix is interned into a row of an int32 matrix of token IDs, and its
+    stats live at the same row of contiguous float arrays. Prefixes are found
+    through an open-addressing hash table from the packed token bytes to the row.
+    """
+    num_tokens: int
+
+    def __init__(self, tokenizer: transformers.PreTrainedTokenizer, criterion: str, num_tokens: int, initial_capacity: int = 1024):
+        super().__init__(tokenizer=tokenizer, criterion=criterion)
+        self.num_tokens = num_tokens
+        self._num_rows = 0
+        self._ids = np.zeros((initial_capacity, num_tokens), dtype=np.int32)
+        self._row_num_occurrences = np.zeros(initial_capacity, dtype=np.int32)
+        self._row_sum_loss = np.zeros(initial_capacity, dtype=np.float64)
+        self._row_sumsq_loss = np.zeros(initial_capacity, dtype=np.float64)
+        self._row_avg_loss = np.zeros(initial_capacity, dtype=np.float64)
+        self._row_sum_accuracy = np.zeros(initial_capacity, dtype=np.float64)
+        self._row_avg_accuracy = np.zeros(initial_capacity, dtype=np.float64)
+        # hash table of row indices (-1 means empty), kept at most half full.
+        self._table = np.full(2 * initial_capacity, -1, dtype=np.int64)
+
+    def _slot(self, key: bytes) -> int:
+        """Slot in the hash table where `key` is, or where it would go."""
+        mask = len(self._table) - 1
+        slot = hash(key) & mask
+        while True:
+            row = self._table[slot]
+            if (row == -1) or (self._ids[row].tobytes() == key):
+                return slot
+            slot = (slot + 1) & mask
+
+    def _find_row(self, prefix: Tuple[int]) -> int:
+        """Row for `prefix`, or -1 if we haven't seen it."""
+        return int(self._table[self._slot(np.asarray(prefix, dtype=np.int32).tobytes())])
+
+    def _grow(self) -> None:
+        capacity = 2 * len(self._ids)
+        ids = np.zeros((capacity, self.num_tokens), dtype=self._ids.dtype)
+        ids[:self._num_rows] = self._ids[:self._num_rows]
+        self._ids = ids
+        for name in ['_row_num_occurrences', '_row_sum_loss', '_row_sumsq_loss', '_row_avg_loss', '_row_sum_accuracy', '_row_avg_accuracy']:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self._num_rows] = old[:self._num_rows]
+            setattr(self, name, new)
+        # rehash
+        self._table = np.full(2 * capacity, -1, dtype=np.int64)
+        for row in range(self._num_rows):
+            self._table[self._slot(self._ids[row].tobytes())] = row
+
+    def _get_or_add_row(self, prefix: Tuple[int]) -> int:
+        key = np.asarray(prefix, dtype=np.int32).tobytes()
+        slot = self._slot(key)
+        row = int(self._table[slot])
+        if row != -1:
+            return row
+        if self._num_rows == len(self._ids):
+            self._grow()
+            slot = self._slot(key)
+        row = self._num_rows
+        self._ids[row] = prefix
+        self._table[slot] = row
+        self._num_rows += 1
+        return row
+
+    @property
+    def prefixes(self) -> List[Tuple[int]]:
+        return [tuple(ids) for ids in self._ids[:self._num_rows].tolist()]
+
+    def num_occurrences(self, prefix: Tuple[int]) -> int:
+        row = self._find_row(prefix)
+        return 0 if row == -1 else int(self._row_num_occurrences[row])
+
+    def std_loss(self, prefix: Tuple[int]) -> float:
+        row = self._find_row(prefix)
+        n = self._row_num_occurrences[row] if row != -1 else 0
+        if n < 2:
+            return 0.0
+        variance = (self._row_sumsq_loss[row] - (self._row_sum_loss[row] ** 2) / n) / (n - 1)
+        return max(variance, 0.0) ** 0.5
+
+    def _get_row(self, prefix: Tuple[int]) -> int:
+        """Row for `prefix`, raising KeyError (like the dicts of PrefixPool) if we haven't seen it."""
+        row = self._find_row(prefix)
+        if row == -1:
+            raise KeyError(prefix)
+        return row
+
+    def avg_loss(self, prefix: Tuple[int]) -> float:
+        return float(self._row_avg_loss[self._get_row(prefix)])
+
+    def avg_accuracy(self, prefix: Tuple[int]) -> float:
+        return float(self._row_avg_accuracy[self._get_row(prefix)])
+
+    def _initialize_prefix(self, prefix: Tuple[int]):
+        row = self._get_or_add_row(prefix)
+        self._row_avg_loss[row] = 10_000.0
+        self._row_avg_accuracy[row] = 0
+        self._best_prefix_by_start_token.setdefault(prefix[0], (prefix, (10_000.0,)))
+
+    def _add_observation(self, prefix: Tuple[int], loss: float, accuracy: float):
+        row = self._get_or_add_row(prefix)
+        self._row_num_occurrences[row] += 1
+        n = self._row_num_occurrences[row]
+        self._row_sum_loss[row] += loss
+        self._row_sumsq_loss[row] += loss ** 2
+        self._row_avg_loss[row] = self._row_sum_loss[row] / n
+        self._row_sum_accuracy[row] += accuracy
+        self._row_avg_accuracy[row] = self._row_sum_accuracy[row] / n
+        self._update_best_prefix_by_start_token(prefix)
+
+    def _export_stats(self) -> List[Tuple]:
+        n = self._num_rows
+        return list(zip(
+            self.prefixes,
+            self._row_num_occurrences[:n].tolist(), self._row_sum_loss[:n].tolist(),
+            self._row_sumsq_loss[:n].tolist(), self._row_avg_loss[:n].tolist(),
+            self._row_sum_accuracy[:n].tolist(), self._row_avg_accuracy[:n].tolist(),
+        ))
+
+    def _import_stats(self, rows: List[Tuple]):
+        for p, n, sum_loss, sumsq_loss, avg_loss, sum_accuracy, avg_accuracy in rows:
+            row = self._get_or_add_row(p)
+            self._row_num_occurrences[row] = n
+            self._row_sum_loss[row] = sum_loss
+            self._row_sumsq_loss[row] = sumsq_loss
+            self._row_avg_loss[row] = avg_loss
+            self._row_sum_accuracy[row] = sum_accuracy
+            self._row_avg_accuracy[row] = avg_accuracy
+
+    def topk_all(self, k: int, min_occurrences: Optional[int] = None) -> List[Tuple[int]]:
+        rows = np.arange(self._num_rows)
+        if min_occurrences:
+            rows = rows[self._row_num_occurrences[:self._num_rows] > min_occurrences]
+        if k <= 0:
+            return []
+        # same ordering as PrefixPool._score, with ties broken by the prefix (like its heap)
+        if self.criterion == 'loss':
+            keys = [self._row_avg_loss[rows]]
+        elif self.criterion == 'combined':
+            keys = [-1 * np.round(self._row_avg_accuracy[rows], 2), self._row_avg_loss[rows]]
+        else:
+            keys = [-1 * self._row_avg_accuracy[rows]]
+        if k < len(rows):
+            # only sort the rows that can make the top k (ties on the first key included)
+            kth_value = keys[0][np.argpartition(keys[0], k - 1)[k - 1]]
+            is_candidate = keys[0] <= kth_value
+            rows = rows[is_candidate]
+            keys = [key[is_candidate] for key in keys]
+        ids = self._ids[rows]
+        # (np.lexsort sorts by the last key first)
+        order = np.lexsort([ids[:, j] for j in reversed(range(self.num_tokens))] + keys[::-1])
+        return [tuple(prefix_ids) for prefix_ids in ids[order[:k]].tolist()]
+
+    def __len__(self) -> int:
+        return self._num_rows
+
+
+def create_prefix_pool(args: argparse.Namespace, tokenizer: transformers.PreTrainedTokenizer, criterion: str, num_tokens: int) -> PrefixPool:
+    """Creates a PrefixPool with the storage backend given by `args.prefix_pool_backend`."""
+    backend = getattr(args, 'prefix_pool_backend', 'dict')
+    if backend == 'dict':
+        return PrefixPool(tokenizer=tokenizer, criterion=criterion)
+    elif backend == 'array':
+        return CompactPrefixPool(tokenizer=tokenizer, criterion=criterion, num_tokens=num_tokens)
+    else:
+        raise ValueError(f'Unknown prefix pool backend {backend}')
@@ -3,12 +3,15 @@ from typing import List
 import abc
 import argparse
 import datasets
+import hashlib
 import numpy as np
 import os
 import torch
 import string
 import transformers
 from iprompt import suffix
+from iprompt.answer_vocab import AnswerVocab
+from iprompt.openai_client import AsyncCompletionClient
 
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -44,6 +47,11 @@ class Model:
         self.model.to(device)
         
 
+    @property
+    def vocab_size(self) -> int:
+        """Number of columns in the model's logits (can be more than len(tokenizer))."""
+        return self.model.get_output_embeddings().weight.shape[0]
+
     def get_logits(self, x_text: List[str]) -> torch.Tensor:
         x_tokenized = self.tokenizer(
             x_text, return_tensors='pt', padding='longest'
@@ -52,26 +60,28 @@ class Model:
 
 
 class Gpt3Model(Model):
-    def __init__(self):
-        assert 'OPENAI_API_KEY' in os.environ, 'need to set OPENAI_API_KEY in env to use GPT-3 API'
-        import openai
-        openai.api_key = os.environ['OPENAI_API_KEY']
-        self._num_requests = 0
+    def __init__(self, client: AsyncCompletionClient = None):
+        if client is None:
+            assert 'OPENAI_API_KEY' in os.environ, 'need to set OPENAI_API_KEY in env to use GPT-3 API'
+            client = AsyncCompletionClient(model='text-davinci-002')
+        self.client = client
         self.tokenizer = transformers.AutoTokenizer.from_pretrained('gpt2')
         self.tokenizer.pad_token = self.tokenizer.eos_token
-        self._api_kwargs = {"model": "text-davinci-002",
-                            "temperature": 0.0, "max_tokens": 1, "logprobs": 5}
+        self._api_kwargs = {"temperature": 0.0, "max_tokens": 1, "logprobs": 5}
         print("Initializing for calls to GPT-3 API")
 
+    @property
+    def vocab_size(self) -> int:
+        return self.tokenizer.vocab_size
+
     def get_logits(self, x_text: List[str]) -> torch.Tensor:
         # all negative logits
         logits = np.zeros((len(x_text), self.tokenizer.vocab_size)) - 1e4
 
-        for i, prompt in enumerate(x_text):
-            response = openai.Completion.create(
-                prompt=prompt, **self._api_kwargs)
-            token_logprobs = response.choices[0]['logprobs']['top_logprobs'][0].to_dict(
-            )
+        # query all prompts at once (batched & concurrent, see AsyncCompletionClient)
+        choices = self.client.complete(x_text, **self._api_kwargs)
+        for i, choice in enumerate(choices):
+            token_logprobs = choice['logprobs']['top_logprobs'][0]
             for token, prob in token_logprobs.items():
                 token_id = self.tokenizer.encode(token)
                 assert len(
@@ -89,25 +99,30 @@ def create_model(model_name: str, parallelize=False) -> Model:
         return Model(model_name=model_name, parallelize=parallelize)
 
 
-def test_gpt_model_on_task_with_prefix(dset, prefix, verbose=True, multi_token=True):
-    import openai
-    total_n_correct = 0
-    for i in range(dset.shape[0]):
-        x_text = prefix + dset[i]['input']
-        y_text = dset[i]['output']
+def test_gpt_model_on_task_with_prefix(dset, prefix, verbose=True, multi_token=True,
+                                       client: AsyncCompletionClient = None):
+    """Tests GPT-3 on a dataset (all examples are queried at once through `client`,
+    which defaults to a new AsyncCompletionClient) and returns (nan, acc).
+    """
+    if client is None:
+        client = AsyncCompletionClient(model='text-davinci-002')
+    x_text = [prefix + dset[i]['input'] for i in range(dset.shape[0])]
+    y_text = [dset[i]['output'] for i in range(dset.shape[0])]
+
+    # call GPT3
+    if multi_token:
+        api_kwargs = {"temperature": 0.0, "max_tokens": 5}
+    else:
+        api_kwargs = {"temperature": 0.0, "max_tokens": 1}
+    choices = client.complete(x_text, **api_kwargs)
 
-        # call GPT3
-        if multi_token:
-            api_kwargs = {"model": "text-davinci-002", "temperature": 0.0, "max_tokens": 5}
-        else:
-            api_kwargs = {"model": "text-davinci-002", "temperature": 0.0, "max_tokens": 1}
-        response = openai.Completion.create(
-                prompt=x_text, **api_kwargs)
-        y_decoded = response.choices[0].text
+    total_n_correct = 0
+    for i, choice in enumerate(choices):
+        y_decoded = choice['text']
         y_decoded = y_decoded.rstrip(string.punctuation + string.whitespace)
 
         # check acc 
-        y_gt = y_text.rstrip(string.punctuation + string.whitespace)
+        y_gt = y_text[i].rstrip(string.punctuation + string.whitespace)
         total_n_correct += int(y_gt.strip() in y_decoded)        
     percent_correct = total_n_correct * 100.0 / dset.shape[0]
     if verbose:
@@ -116,9 +131,32 @@ def test_gpt_model_on_task_with_prefix(dset, prefix, verbose=True, multi_token=T
 
 
 
+_ANSWER_VOCABS = {}
+
+
+def get_answer_vocab(dset: datasets.Dataset, tokenizer, vocab_size: int) -> AnswerVocab:
+    """Possible answers (the first token of each output) for a dataset, to compute loss only
+    over possible answers to make task easier.
+    Cached per (dataset outputs, tokenizer, vocab_size), so repeated evals on the same
+    dataset (e.g. for different prefixes) only tokenize the outputs once.
+    """
+    outputs = list(dset['output'])
+    outputs_hash = hashlib.sha1('\x00'.join(outputs).encode('utf-8')).hexdigest()
+    key = (outputs_hash, tokenizer.name_or_path, len(tokenizer), vocab_size)
+    if key not in _ANSWER_VOCABS:
+        # only test on the single next token
+        possible_answer_ids = [
+            (ids[0] if len(ids) else tokenizer.pad_token_id)
+            for ids in tokenizer(outputs)['input_ids']
+        ]
+        _ANSWER_VOCABS[key] = AnswerVocab(possible_answer_ids, vocab_size)
+    return _ANSWER_VOCABS[key]
+
+
 def test_model_on_task_with_prefix(dset: datasets.Dataset, model: transformers.PreTrainedModel,
                                    prefix: str = '', batch_size: int = 16,
                                    restrict_to_valid_answers=True,
+                                   restricted_answer_head=False,
                                    multi_token=False,
                                    max_new_tokens=7,
                                    max_length=256,
@@ -137,6 +175,11 @@ def test_model_on_task_with_prefix(dset: datasets.Dataset, model: transformers.P
     restrict_to_valid_answers (bool):
         Whether to restrict evaluation over all tokens present in the answers.
         Only applied when multi_token is false.
+    restricted_answer_head (bool):
+        Whether to only compute logits for the possible answers (hidden state @ W_unembed[answer_ids])
+        rather than computing the whole vocab's logits and keeping the answers' columns.
+        Same results, but much cheaper for tasks with a few answers.
+        Only applied when restrict_to_valid_answers is true.
     multi_token (bool):
         Whether to allow multiple tokens (uses beam search)
     max_length (int):
@@ -149,30 +192,6 @@ def test_model_on_task_with_prefix(dset: datasets.Dataset, model: transformers.P
         acc (float)
     """
 
-    def get_possible_answer_mask(dataloader, model, vocab_size):
-        """Compute loss only over possible answers to make task easier
-        """
-        possible_answer_ids = []
-        for batch in dataloader:
-            y_text = [answer for answer in batch['output']]
-            # print(y_text)
-            y_tokenized = model.tokenizer(
-                y_text, return_tensors='pt', padding='longest')
-            # only test on the single next token
-            true_next_token_ids = y_tokenized['input_ids'][:, 0]
-            possible_answer_ids.extend(true_next_token_ids.tolist())
-        assert len(
-            possible_answer_ids) > 0, "need multiple answers for multiple choice"
-
-        # set up possible answers
-        possible_answer_ids = torch.tensor(possible_answer_ids)
-        possible_answer_mask = (
-            torch.arange(start=0, end=vocab_size)[:, None]
-            ==
-            possible_answer_ids[None, :]
-        ).any(dim=1).to(device)
-        return possible_answer_mask
-
     # initialize
     np.random.seed(42)
     torch.manual_seed(42)
@@ -182,6 +201,10 @@ def test_model_on_task_with_prefix(dset: datasets.Dataset, model: transformers.P
     dataloader = torch.utils.data.DataLoader(
         dset, batch_size=batch_size, shuffle=False, drop_last=False)
 
+    # set up possible answers once for the whole dataset
+    if restrict_to_valid_answers and not multi_token:
+        answer_vocab = get_answer_vocab(
+            dset, model.tokenizer, model.vocab_size).to(device)
 
     for idx, batch in enumerate(dataloader):
         x_text = [(prefix + prompt) for prompt in batch['input']]
@@ -203,30 +226,24 @@ def test_model_on_task_with_prefix(dset: datasets.Dataset, model: transformers.P
             # just decode a single token
             if not multi_token:
                 # this function ensures that padded tokens are properly dealt with
+                use_restricted_head = restrict_to_valid_answers and restricted_answer_head
                 pred_next_token_logits = suffix.get_next_token_logits(
-                    ex_inputs, model.model)  # note, this will break for gpt-3
+                    ex_inputs, model.model,
+                    vocab_ids=(answer_vocab.ids if use_restricted_head else None),
+                )  # note, this will break for gpt-3
                 # all_token_logits = model.get_logits(x_text)
                 # pred_next_token_logits = all_token_logits[:, -1, :]
 
-                # set up mask for possible answers
-                # vocab_size = model.tokenizer.vocab_size
-                vocab_size = model.get_logits(['dummy text']).shape[-1]
-                if restrict_to_valid_answers:
-                    possible_answer_mask = get_possible_answer_mask(
-                        dataloader, model, vocab_size)
-                else:
-                    possible_answer_mask = torch.ones(vocab_size).bool().to(device)
-
-
-                # optionally take a mask over some tokens
-                pred_next_token_logits = torch.where(
-                    possible_answer_mask, pred_next_token_logits, torch.tensor(
-                        float('-inf')).to(device)
-                )
-
                 # only test on the single next token
                 true_next_token_ids = y_tokenized['input_ids'][:, 0]
 
+                # optionally only keep logits of possible answers
+                # (and index targets by their column in those)
+                if restrict_to_valid_answers:
+                    if not use_restricted_head:
+                        pred_next_token_logits = answer_vocab.gather(pred_next_token_logits)
+                    true_next_token_ids = answer_vocab.to_compact(true_next_token_ids)
+
                 # compute loss
                 loss = torch.nn.functional.nll_loss(
                     input=pred_next_token_logits, target=true_next_token_ids, reduction='sum')
@@ -1,12 +1,17 @@
+import collections
 import logging
+import os
+import pickle as pkl
 import string
 
 import numpy as np
 import torch
 
 import iprompt.data as data
+import iprompt.lm_head as lm_head
 import iprompt.parallel as parallel
 import iprompt.utils as utils
+from iprompt.prefix.utils import repeat_past_key_values
 
 
 def get_stopwords():
@@ -18,71 +23,326 @@ def get_stopwords():
     return set(stopwords.words('english'))
 
 
-def get_next_token_logits(ex_inputs, model):
+_VOCAB_TABLES = {}
+
+
+def get_vocab_table(tokenizer, stopwords=None, cache_dir=None):
+    """Decoded strings and filter masks for every token in the vocab, so the suffix
+    search doesn't need to decode (and filter) the whole vocab on every query.
+    Computed once per tokenizer and cached in memory and on disk (in `cache_dir`,
+    default ~/.cache/iprompt)
+
+    Returns a dict of numpy arrays, indexed by token id:
+        decoded: decoded string for each token
+        lower_stripped: lowercased & stripped decoded string
+        is_whitespace_or_punct: whether the token is only whitespace or punctuation
+        is_stopword: whether the token is in `stopwords` (all False if no stopwords given)
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'iprompt')
+    name = tokenizer.name_or_path.lower().replace('/', '___')
+    fname = os.path.join(
+        cache_dir, f'vocab_table_{name}_{len(tokenizer)}_{"stopwords" if stopwords else "nostopwords"}.pkl')
+    if fname in _VOCAB_TABLES:
+        return _VOCAB_TABLES[fname]
+    if os.path.exists(fname):
+        _VOCAB_TABLES[fname] = pkl.load(open(fname, 'rb'))
+        return _VOCAB_TABLES[fname]
+
+    decoded = np.array(
+        tokenizer.batch_decode([[i] for i in range(len(tokenizer))]), dtype=object)
+    lower_stripped = np.array([s.lower().strip() for s in decoded], dtype=object)
+    table = {
+        'decoded': decoded,
+        'lower_stripped': lower_stripped,
+        'is_whitespace_or_punct': np.array(
+            [s.isspace() or all(c in string.punctuation for c in s) for s in decoded], dtype=bool),
+        'is_stopword': np.array(
+            [s in (stopwords or ()) for s in lower_stripped], dtype=bool),
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    pkl.dump(table, open(fname, 'wb'))
+    _VOCAB_TABLES[fname] = table
+    return table
+
+
+def get_allowed_token_mask(vocab_table, num_logits: int,
+                           disallow_whitespace_tokens=False, disallow_stopwords=False):
+    """Mask over the model's logits of tokens the suffix search may add.
+    Logits can be wider than the tokenizer (e.g. GPT-J), and those extra
+    tokens are never allowed
+    """
+    num_tokens = min(num_logits, len(vocab_table['decoded']))
+    allowed_mask = np.zeros(num_logits, dtype=bool)
+    allowed_mask[:num_tokens] = True
+    if disallow_whitespace_tokens:
+        allowed_mask[:num_tokens] &= ~vocab_table['is_whitespace_or_punct'][:num_tokens]
+    if disallow_stopwords:
+        allowed_mask[:num_tokens] &= ~vocab_table['is_stopword'][:num_tokens]
+    return allowed_mask
+
+
+def get_top_k_allowed(avg_probs, allowed_mask, k: int):
+    """Indexes of the (at most) `k` allowed tokens with the highest probs, largest first,
+    only sorting those rather than the whole vocab
+    Returns (top_k_inds, avg_probs_allowed), where disallowed tokens have -inf prob
+    """
+    avg_probs_allowed = np.where(allowed_mask, avg_probs, -np.inf)
+    k = min(k, allowed_mask.sum())
+    if k < avg_probs.size:
+        top_k_inds = np.argpartition(-avg_probs_allowed, k - 1)[:k]
+    else:
+        top_k_inds = np.arange(avg_probs.size)
+
+    # sort the topk (largest first)
+    top_k_inds = top_k_inds[np.argsort(avg_probs_allowed[top_k_inds])][::-1][:k]
+    return top_k_inds, avg_probs_allowed
+
+
+def get_next_token_logits(ex_inputs, model, vocab_ids=None):
     """Gets logits for the next token given inputs with appropriate attention mask
+    Only the hidden state at each row's last real token goes through the LM head,
+    rather than computing (batch_size, seq_len, vocab_size) logits
+    If `vocab_ids` is given, only gets logits for those tokens
     """
-    # go through model
-    outputs = model(
+    # get positions of the next-token hidden state
+    positions_next_token = lm_head.get_last_token_positions(ex_inputs['attention_mask'])
+
+    next_token_logits = lm_head.get_logits_at_positions(
+        model, positions_next_token, vocab_ids=vocab_ids,
         input_ids=ex_inputs['input_ids'], attention_mask=ex_inputs['attention_mask'])
-    logits = outputs['logits']  # (batch_size, seq_len, vocab_size)
+    return next_token_logits.float()
 
-    # get positions of the next-token hidden state
-    positions_next_token = ex_inputs['attention_mask'].sum(axis=1) - 1
-
-    # index at correct positions
-    # TODO: smarter torch func to do this
-    next_token_logits = torch.Tensor(
-        size=(logits.shape[0], logits.shape[-1])).to(logits.device)
-    for i in range(logits.shape[0]):
-        next_token_logits[i, :] = logits[i, positions_next_token[i], :]
-    return next_token_logits
+
+class StreamingNextTokenAverager:
+    """Streaming average of next-token probs (or raw logits) for `num_rows` suffixes.
+
+    Probs are accumulated as a running log-sum-exp of next-token log-probs, so nothing
+    overflows or underflows no matter how many examples we average over, and memory is
+    (num_rows, vocab_size) regardless of dataset size. Logits are upcast to `dtype` before
+    the (log-)softmax, so fp16 and fp32 models are reduced in the same precision.
+
+    Optionally only the `top_k` log-probs of each example are kept (the rest count as 0 prob).
+    """
+
+    def __init__(self, num_rows: int, use_softmax: bool = True, dtype=torch.float64, top_k: int = 0):
+        self.num_rows = num_rows
+        self.use_softmax = use_softmax
+        self.dtype = dtype
+        self.top_k = top_k
+        self.num_examples = 0
+        self._acc = None
+
+    def update(self, next_token_logits: torch.Tensor, row_idxs: torch.Tensor):
+        """Adds (num_examples, vocab_size) logits, where example i belongs to row `row_idxs[i]`.
+        Rows of the same suffix should be contiguous (as with the suffix-major batches).
+        """
+        next_token_logits = next_token_logits.detach().to(self.dtype)
+        if self._acc is None:
+            fill_value = -float('inf') if self.use_softmax else 0.
+            self._acc = torch.full(
+                (self.num_rows, next_token_logits.shape[-1]), fill_value,
+                dtype=self.dtype, device=next_token_logits.device)
+        row_idxs = row_idxs.to(self._acc.device)
+        if not self.use_softmax:
+            self._acc.index_add_(0, row_idxs, next_token_logits)
+            return
+
+        log_probs = next_token_logits.log_softmax(dim=-1)
+        if self.top_k and self.top_k < log_probs.shape[-1]:
+            top_log_probs, top_idxs = log_probs.topk(self.top_k, dim=-1)
+            log_probs = torch.full_like(log_probs, -float('inf')).scatter_(-1, top_idxs, top_log_probs)
+        rows, counts = torch.unique_consecutive(row_idxs, return_counts=True)
+        for row, log_probs_row in zip(rows.tolist(), log_probs.split(counts.tolist())):
+            self._acc[row] = torch.logaddexp(self._acc[row], log_probs_row.logsumexp(dim=0))
+
+    def add_examples(self, num_examples: int):
+        self.num_examples += num_examples
+
+    def get_avg(self) -> np.ndarray:
+        """Returns the averaged probs (or logits), shape (num_rows, vocab_size)."""
+        if self.use_softmax:
+            avg = (self._acc - np.log(self.num_examples)).exp()
+        else:
+            avg = self._acc / self.num_examples
+        return avg.cpu().numpy()
+
+
+def _get_averager(args, num_rows: int, use_softmax: bool) -> StreamingNextTokenAverager:
+    return StreamingNextTokenAverager(
+        num_rows, use_softmax=use_softmax,
+        dtype=getattr(torch, getattr(args, 'suffix_accum_dtype', 'float64')),
+        top_k=getattr(args, 'suffix_avg_top_k', 0))
 
 
 def get_probs_avg_next_token(args, suffix_str: str, model, dataloader,
                              tokenizer, use_softmax=True):
     """Get the average probs for the next token across the entire dataset
-    Actually returns logits not probs in case of overflow issues
+    (or the average logits if not use_softmax)
     """
-    num_examples = 0
-    cum_logits = None
+    return get_probs_avg_next_token_for_suffixes(
+        args, [suffix_str], model, dataloader, tokenizer, use_softmax=use_softmax)[0]
+
+
+def get_probs_avg_next_token_for_suffixes(args, suffix_strs, model, dataloader,
+                                          tokenizer, use_softmax=True):
+    """Same as get_probs_avg_next_token, but for many suffixes at once.
+    Each batch of the dataset is stacked for every suffix (suffix x example) and run
+    in forward passes of up to `args.suffix_max_rows_per_forward` rows
+    Returns a list with the averaged logits for each suffix
+    """
+    if len(suffix_strs) == 0:
+        return []
+    max_rows = getattr(args, 'suffix_max_rows_per_forward', 1024)
+    averager = _get_averager(args, len(suffix_strs), use_softmax)
     for idx, batch in enumerate(dataloader):
 
-        # set up inputs
+        # set up inputs (suffix-major, so row i belongs to suffix i // len(text))
         text = batch['text']
         full_text = [text[i] + suffix_str
+                     for suffix_str in suffix_strs
                      for i in range(len(text))]
-        ex_inputs = tokenizer(
-            full_text, padding='longest', return_tensors='pt')
-        ex_inputs = parallel.inputs_to_device(args, ex_inputs)
+        rows_per_forward = max(max_rows, len(text))
+        for start_idx in range(0, len(full_text), rows_per_forward):
+            ex_inputs = tokenizer(
+                full_text[start_idx: start_idx + rows_per_forward], padding='longest', return_tensors='pt')
+            ex_inputs = parallel.inputs_to_device(args, ex_inputs)
 
-        # actually get next-token logits
-        next_token_logits = get_next_token_logits(ex_inputs, model)
+            # actually get next-token logits
+            next_token_logits = get_next_token_logits(ex_inputs, model)
 
-        # apply softmax
-        if use_softmax:
-            next_token_logits = next_token_logits.softmax(axis=-1)
+            # accumulate, averaging over examples for each suffix
+            suffix_idxs = torch.arange(
+                start_idx, start_idx + len(next_token_logits), device=next_token_logits.device) // len(text)
+            averager.update(next_token_logits, suffix_idxs)
+        averager.add_examples(len(text))
 
-        # sum over batch-size
-        next_token_logits = next_token_logits.sum(axis=0)
+    return list(averager.get_avg())
 
-        # take log softmax
-        # next_token_logits = next_token_logits.log_softmax(dim=-1)
 
-        # accumulate logits
-        if cum_logits is None:
-            cum_logits = next_token_logits.detach()
-        else:
-            cum_logits += next_token_logits.detach()
-        num_examples += len(text)
+def get_past_key_values_nbytes(past_key_values) -> int:
+    """Memory used by `past_key_values` (legacy tuples or a `transformers` Cache)."""
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        past_key_values = past_key_values.to_legacy_cache()
+    return sum(t.numel() * t.element_size() for layer_past in past_key_values for t in layer_past)
+
 
-    # use averaged logits
-    avg_logits = cum_logits / num_examples
-    avg_logits = avg_logits.detach().cpu().numpy().squeeze()
+class SuffixKVCache:
+    """Dataset-level past_key_values for the suffix search.
 
-    # convert to probs (TODO: make this less likely to overflow)
-    # avg_probs = np.exp(avg_logits)  # softmax part 1
-    # avg_probs /= np.sum(avg_probs)  # softmax part 2
-    return avg_logits
+    Every candidate suffix extends `text + init_suffix` for each example, and a child
+    suffix extends its parent by one token. So rather than re-encoding `text + suffix_str`
+    for every node, we keep the past_key_values (for every batch of the dataset) of the
+    beam frontier, keyed by the token IDs added to `init_suffix`, and extend a parent's
+    by one token of decoding per example to get its child's.
+
+    Since the search is breadth-first, a parent's children are all expanded one after
+    another, so a parent is evicted as soon as we move on to the next one (and anything
+    more than a level above the node being expanded is evicted too). If `max_bytes` > 0,
+    the least-recently-used entries are also evicted to stay under it. Evicted entries are
+    rebuilt from their closest cached ancestor.
+
+    Inputs are left-padded so the new token always goes at the end of every row.
+    """
+
+    def __init__(self, args, model, dataloader, tokenizer, init_suffix_str: str, max_bytes: int = 0):
+        self.args = args
+        self.model = model
+        self.max_bytes = max_bytes
+        self.num_examples = 0
+        self.num_bytes = 0
+        self._contexts = []
+        for batch in dataloader:
+            # left-pad `text + init_suffix` for each example
+            ids = tokenizer([t + init_suffix_str for t in batch['text']])['input_ids']
+            max_len = max(len(x) for x in ids)
+            input_ids = torch.tensor(
+                [[tokenizer.pad_token_id] * (max_len - len(x)) + x for x in ids])
+            attention_mask = torch.tensor(
+                [[0] * (max_len - len(x)) + [1] * len(x) for x in ids])
+            self._contexts.append((input_ids, attention_mask))
+            self.num_examples += len(ids)
+        self._entries = collections.OrderedDict()
+        self._entry_nbytes = {}
+        self._expanding_parent = None
+
+    def _forward(self, input_ids, attention_mask, past_key_values=None):
+        input_ids = parallel.inputs_to_device(self.args, input_ids)
+        attention_mask = parallel.inputs_to_device(self.args, attention_mask)
+        # positions skip the left padding
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+        if past_key_values is not None:
+            position_ids = position_ids[:, -input_ids.shape[1]:]
+        with torch.no_grad():
+            next_token_logits, past_key_values = lm_head.get_last_logits_and_past(
+                self.model,
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+            )
+        return next_token_logits.float(), past_key_values, attention_mask
+
+    def _evict(self, suffix_token_ids: tuple):
+        if suffix_token_ids in self._entries:
+            del self._entries[suffix_token_ids]
+            self.num_bytes -= self._entry_nbytes.pop(suffix_token_ids)
+
+    def _get(self, suffix_token_ids: tuple, keep: bool = True):
+        """Returns a list with (next_token_logits, past_key_values, attention_mask) for each batch.
+        If not `keep`, the result isn't cached (e.g. when its children will never be expanded).
+        """
+        if suffix_token_ids in self._entries:
+            self._entries.move_to_end(suffix_token_ids)
+            return self._entries[suffix_token_ids]
+
+        if len(suffix_token_ids) == 0:
+            entry = [
+                self._forward(input_ids, attention_mask)
+                for input_ids, attention_mask in self._contexts
+            ]
+        else:
+            parent_token_ids = suffix_token_ids[:-1]
+            parent_entry = self._get(parent_token_ids)
+            # moving on to a new parent means the last one's children are all expanded
+            if parent_token_ids != self._expanding_parent:
+                if self._expanding_parent is not None:
+                    self._evict(self._expanding_parent)
+                self._expanding_parent = parent_token_ids
+            for key in [key for key in self._entries if len(key) < len(parent_token_ids)]:
+                self._evict(key)
+
+            entry = []
+            for _, past_key_values, attention_mask in parent_entry:
+                batch_size = attention_mask.shape[0]
+                new_token_ids = torch.full((batch_size, 1), suffix_token_ids[-1], dtype=torch.long)
+                # copy the parent's cache, since the model appends to Cache objects in place
+                entry.append(self._forward(
+                    input_ids=new_token_ids,
+                    attention_mask=torch.cat(
+                        (attention_mask, attention_mask.new_ones((batch_size, 1))), dim=1),
+                    past_key_values=repeat_past_key_values(past_key_values, 1),
+                ))
+
+        if keep:
+            self._entries[suffix_token_ids] = entry
+            self._entry_nbytes[suffix_token_ids] = sum(
+                get_past_key_values_nbytes(past_key_values) for _, past_key_values, _ in entry)
+            self.num_bytes += self._entry_nbytes[suffix_token_ids]
+            while (self.max_bytes > 0) and (self.num_bytes > self.max_bytes) and (len(self._entries) > 1):
+                self._evict(next(iter(self._entries)))
+        return entry
+
+    def get_probs_avg_next_token(self, suffix_token_ids, use_softmax=True, keep_past=True):
+        """Same as `get_probs_avg_next_token`, for `init_suffix` followed by `suffix_token_ids`.
+        Only keeps the past_key_values if `keep_past` (i.e. if the suffix will be expanded).
+        """
+        averager = _get_averager(self.args, 1, use_softmax)
+        for next_token_logits, _, _ in self._get(tuple(suffix_token_ids), keep=keep_past):
+            averager.update(next_token_logits, torch.zeros(
+                len(next_token_logits), dtype=torch.long, device=next_token_logits.device))
+            averager.add_examples(len(next_token_logits))
+        return averager.get_avg().squeeze()
 
 
 def get_probs_single_query_next_token(args, suffix_str: str, model, dataloader, tokenizer):
@@ -140,130 +400,155 @@ def train_suffix(args, r, model, dataloader, check_answer_func, tokenizer, save_
     # set up BFS beam search
     suffix_str = data.get_init_suffix(args.task_name, args.use_generic_query, args.template_num_init_string)
 
-    suffixes = [{'s': suffix_str, 'num_tokens_added': 0,
-                 'running_prob': 1, 'num_suffixes_checked': 0}]
+    suffixes = collections.deque([{'s': suffix_str, 'num_tokens_added': 0,
+                                   'running_prob': 1, 'num_suffixes_checked': 0,
+                                   'token_ids': []}])
     r['suffix_str_init'] = suffix_str
     r['len_suffix_str_init'] = len(suffix_str)
     num_model_queries = 0
     logging.info(
         f'num batches: {len(dataloader)} batch_size {args.batch_size}')
-    if not args.use_stopwords:
-        STOPWORDS = get_stopwords()
+    # decoded strings & filters for the whole vocab, computed once
+    vocab_table = get_vocab_table(
+        tokenizer,
+        stopwords=(get_stopwords() if not args.use_stopwords else None),
+        cache_dir=getattr(args, 'vocab_cache_dir', None))
+    allowed_mask = None  # sized to the model's logits on the first query
+    # only need to sort & decode as many tokens as we'll look at
+    num_top_k = args.beam_size + args.beam_size_extra
+    if args.use_verbose_saving:
+        num_top_k = max(num_top_k, beam_size_for_saving)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        num_top_k = max(num_top_k, beam_size_printing)
+    if getattr(args, 'use_suffix_kv_cache', 0):
+        kv_cache = SuffixKVCache(
+            args, model, dataloader, tokenizer, init_suffix_str=suffix_str,
+            max_bytes=int(getattr(args, 'suffix_kv_cache_max_gb', 0) * 2**30))
+    else:
+        kv_cache = None
 
     while len(suffixes) > 0:
-        suffix_dict = suffixes.pop()
-        suffix_str = suffix_dict['s']
-        num_suffixes_checked = suffix_dict['num_suffixes_checked']
-
-        # save results for suffix_str
-        r['suffix_str_added'].append(suffix_str[r['len_suffix_str_init']:])
-        r['num_tokens_added'].append(suffix_dict['num_tokens_added'])
-        r['num_model_queries'].append(num_model_queries)
-        r['running_prob'].append(suffix_dict['running_prob'])
+        # everything in the queue is at the same depth (BFS), so take the whole level
+        # and evaluate all of its suffixes together
+        level = [suffixes.popleft() for _ in range(len(suffixes))]
+        if not (args.use_single_query or kv_cache is not None):
+            level_avg_probs = iter(get_probs_avg_next_token_for_suffixes(
+                args, [d['s'] for d in level if d['num_tokens_added'] < args.max_num_tokens],
+                model, dataloader, tokenizer))
+
+        for suffix_dict in level:
+            suffix_str = suffix_dict['s']
+            num_suffixes_checked = suffix_dict['num_suffixes_checked']
+
+            # save results for suffix_str
+            r['suffix_str_added'].append(suffix_str[r['len_suffix_str_init']:])
+            r['num_tokens_added'].append(suffix_dict['num_tokens_added'])
+            r['num_model_queries'].append(num_model_queries)
+            r['running_prob'].append(suffix_dict['running_prob'])
         
-        # break if we've added enough tokens
-        if suffix_dict['num_tokens_added'] >= args.max_num_tokens:
-            continue
-
-        # get avg_probs
-        if args.use_single_query:
-            avg_probs = get_probs_single_query_next_token(
-                args, suffix_str, model, dataloader, tokenizer)
-        else:
-            avg_probs = get_probs_avg_next_token(
-                args, suffix_str, model, dataloader, tokenizer)
-        num_model_queries += 1
-
-        # could also check out top_k_top_p_filtering
-        # (https://huggingface.co/docs/transformers/v4.16.2/en/task_summary)
-        # get the topk indexes and tokens
-        top_k_inds = np.arange(avg_probs.size)
-        # top_k_inds = np.argpartition(avg_probs, -beam_size_for_saving)# [-beam_size_printing:]  # get topk (hardcoded as 500)
-
-        # sort the topk (largest first)
-        top_k_inds = top_k_inds[np.argsort(avg_probs[top_k_inds])][::-1]
-        top_decoded_tokens = np.array(
-            [tokenizer.decode(ind) for ind in top_k_inds])
-
-        # disallow bad tokens
-        if disallow_whitespace_tokens:
-            disallowed_idxs = np.array([s.isspace() or all(c in string.punctuation for c in s)
-                                       for s in top_decoded_tokens], dtype=bool)
-            top_k_inds = top_k_inds[~disallowed_idxs]
-            top_decoded_tokens = top_decoded_tokens[~disallowed_idxs]
-        if not args.use_stopwords:
-            disallowed_idxs = np.array([s.lower().strip() in STOPWORDS
-                                       for s in top_decoded_tokens], dtype=bool)
-            top_k_inds = top_k_inds[~disallowed_idxs]
-            top_decoded_tokens = top_decoded_tokens[~disallowed_idxs]
-
-        # logging
-        logging.info(str(num_model_queries) + ' ' + repr(suffix_str))
-        for i in range(beam_size_printing):
-            logging.debug(
-                '\t ' + repr(top_decoded_tokens[i]) + '\t' + f'{avg_probs[top_k_inds[i]]:.2E}')
-        logging.debug('\t' + 'idxs_correct: ' + str(np.argwhere(
-            [check_answer_func(x) for x in top_decoded_tokens]).flatten().tolist()))
-
-        # if we made it here, we did not find the answer and early stop
-        if args.use_verbose_saving:
-            r['correct'].append(False)
-            r['suffix_str_full'].append(suffix_str)
-            r['decoded_token'].append(top_decoded_tokens[0])
-            r['top_decoded_tokens_dict'].append({
-                top_decoded_tokens[i]: avg_probs[top_k_inds[i]]
-                for i in range(beam_size_for_saving)
-            })
-
-        # find answer rank (only if we're at the first token)
-        # in the best case, it is at position 0 (most likely completion)
-        if suffix_dict['num_tokens_added'] == 0:
-            pos_correct = np.array(
-                list(map(check_answer_func, top_decoded_tokens)))
-            r['final_answer_pos_initial_token'] = np.where(pos_correct)[
-                0].min()
-        utils.save(args, save_dir, r, epoch=None, final=True)
-
-        # check larger than args.beam_size in case the answer was basically right there
-        for beam_num in range(args.beam_size + args.beam_size_extra):
-            suffix_new = suffix_str + top_decoded_tokens[beam_num]
-            if check_answer_func(suffix_new):
-                # save the first answer we find
-                if not 'final_answer_full' in r.keys():
-                    r['final_answer_full'] = suffix_new
-                    r['final_answer_added'] = suffix_new[r['len_suffix_str_init']:]
-                    r['final_model_queries'] = num_model_queries
-                    r['final_num_suffixes_checked'] = num_suffixes_checked + \
-                        beam_num + 1
-                    r['final_answer_depth'] = suffix_dict['num_tokens_added'] + 1
-                    logging.info('successful early stopping :)')
-                    logging.info('\t' + repr(r['suffix_str_init']))
-                    logging.info('\t' + repr(r['final_answer_added']))
-                    logging.info('\t' + 'pos_initial_token: ' +
-                                 repr(r['final_answer_pos_initial_token']))
-                    logging.info(save_dir)
-                    utils.save(args, save_dir, r, final=True)
-                    utils.save_json(r={  # save some key outputs in readable form
-                        k: r[k]
-                        for k in r if isinstance(r[k], str) or isinstance(r[k], int)
-                    }, save_dir=save_dir, fname='final.json')
-
-                # usually we just return after finding the answer
-                if args.use_early_stopping:
-                    return
-
-            # for bfs insert at beginning (dfs would append at end)
-            if beam_num < args.beam_size:
-                suffixes.insert(0, {
-                    's': suffix_new,
-                    'num_tokens_added': suffix_dict['num_tokens_added'] + 1,
-                    'running_prob': suffix_dict['running_prob'] * avg_probs[top_k_inds[beam_num]],
-
-                    # checked beam_size at current suffix + all suffixes before this one (assumes BFS-beam search)
-                    # this is the total number of suffixes checked at the time when this will be opened above
-                    'num_suffixes_checked': num_suffixes_checked + (args.beam_size + args.beam_size_extra) * (beam_num + 1)
+            # break if we've added enough tokens
+            if suffix_dict['num_tokens_added'] >= args.max_num_tokens:
+                continue
+
+            # get avg_probs
+            if args.use_single_query:
+                avg_probs = get_probs_single_query_next_token(
+                    args, suffix_str, model, dataloader, tokenizer)
+            elif kv_cache is not None:
+                avg_probs = kv_cache.get_probs_avg_next_token(
+                    suffix_dict['token_ids'],
+                    keep_past=(suffix_dict['num_tokens_added'] + 1 < args.max_num_tokens))
+            else:
+                # already computed for the whole level (still counts as one query per suffix)
+                avg_probs = next(level_avg_probs)
+            num_model_queries += 1
+
+            # could also check out top_k_top_p_filtering
+            # (https://huggingface.co/docs/transformers/v4.16.2/en/task_summary)
+            # disallow bad tokens (tokens past the end of the tokenizer's vocab are never allowed)
+            if allowed_mask is None:
+                allowed_mask = get_allowed_token_mask(
+                    vocab_table, num_logits=avg_probs.size,
+                    disallow_whitespace_tokens=disallow_whitespace_tokens,
+                    disallow_stopwords=(not args.use_stopwords))
+
+            # get the topk indexes and tokens, only decoding the ones we look at
+            top_k_inds, avg_probs_allowed = get_top_k_allowed(avg_probs, allowed_mask, num_top_k)
+            k = len(top_k_inds)
+            top_decoded_tokens = vocab_table['decoded'][top_k_inds]
+
+            # logging
+            logging.info(str(num_model_queries) + ' ' + repr(suffix_str))
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                for i in range(min(beam_size_printing, k)):
+                    logging.debug(
+                        '\t ' + repr(top_decoded_tokens[i]) + '\t' + f'{avg_probs[top_k_inds[i]]:.2E}')
+                logging.debug('\t' + 'idxs_correct: ' + str(np.argwhere(
+                    [check_answer_func(x) for x in top_decoded_tokens]).flatten().tolist()))
+
+            # if we made it here, we did not find the answer and early stop
+            if args.use_verbose_saving:
+                r['correct'].append(False)
+                r['suffix_str_full'].append(suffix_str)
+                r['decoded_token'].append(top_decoded_tokens[0])
+                r['top_decoded_tokens_dict'].append({
+                    top_decoded_tokens[i]: avg_probs[top_k_inds[i]]
+                    for i in range(beam_size_for_saving)
                 })
 
+            # find answer rank (only if we're at the first token)
+            # in the best case, it is at position 0 (most likely completion)
+            # (rank among allowed tokens = number of allowed tokens with higher prob)
+            if suffix_dict['num_tokens_added'] == 0:
+                allowed_ids = np.where(allowed_mask)[0]
+                pos_correct = np.array(
+                    list(map(check_answer_func, vocab_table['decoded'][allowed_ids])), dtype=bool)
+                allowed_probs = avg_probs_allowed[allowed_ids]
+                ranks = (allowed_probs[None, :] > allowed_probs[pos_correct][:, None]).sum(axis=1)
+                r['final_answer_pos_initial_token'] = ranks.min()
+            utils.save(args, save_dir, r, epoch=None, final=True)
+
+            # check larger than args.beam_size in case the answer was basically right there
+            for beam_num in range(args.beam_size + args.beam_size_extra):
+                suffix_new = suffix_str + top_decoded_tokens[beam_num]
+                if check_answer_func(suffix_new):
+                    # save the first answer we find
+                    if not 'final_answer_full' in r.keys():
+                        r['final_answer_full'] = suffix_new
+                        r['final_answer_added'] = suffix_new[r['len_suffix_str_init']:]
+                        r['final_model_queries'] = num_model_queries
+                        r['final_num_suffixes_checked'] = num_suffixes_checked + \
+                            beam_num + 1
+                        r['final_answer_depth'] = suffix_dict['num_tokens_added'] + 1
+                        logging.info('successful early stopping :)')
+                        logging.info('\t' + repr(r['suffix_str_init']))
+                        logging.info('\t' + repr(r['final_answer_added']))
+                        logging.info('\t' + 'pos_initial_token: ' +
+                                     repr(r['final_answer_pos_initial_token']))
+                        logging.info(save_dir)
+                        utils.save(args, save_dir, r, final=True)
+                        utils.save_json(r={  # save some key outputs in readable form
+                            k: r[k]
+                            for k in r if isinstance(r[k], str) or isinstance(r[k], int)
+                        }, save_dir=save_dir, fname='final.json')
+
+                    # usually we just return after finding the answer
+                    if args.use_early_stopping:
+                        return
+
+                # for bfs append to the queue (the next level)
+                if beam_num < args.beam_size:
+                    suffixes.append({
+                        's': suffix_new,
+                        'num_tokens_added': suffix_dict['num_tokens_added'] + 1,
+                        'running_prob': suffix_dict['running_prob'] * avg_probs[top_k_inds[beam_num]],
+                        'token_ids': suffix_dict['token_ids'] + [int(top_k_inds[beam_num])],
+
+                        # checked beam_size at current suffix + all suffixes before this one (assumes BFS-beam search)
+                        # this is the total number of suffixes checked at the time when this will be opened above
+                        'num_suffixes_checked': num_suffixes_checked + (args.beam_size + args.beam_size_extra) * (beam_num + 1)
+                    })
+
     if args.max_num_tokens > 1:
         candidates, probs = get_top_candidates_and_probs_suff(r)    
         r['top_prompt'] = candidates[0]
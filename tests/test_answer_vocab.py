@@ -0,0 +1,25 @@
+import torch
+
+from iprompt.answer_vocab import AnswerVocab
+
+
+def test_answer_vocab_matches_comparison_mask():
+    answer_ids = torch.tensor([7, 3, 7, 42, 3, 7])
+    answer_vocab = AnswerVocab(answer_ids, vocab_size=50)
+    expected_mask = (torch.arange(50)[:, None] == answer_ids[None, :]).any(dim=1)
+    assert torch.equal(answer_vocab.mask, expected_mask)
+    assert answer_vocab.ids.tolist() == [3, 7, 42]
+    assert len(answer_vocab) == 3
+    assert answer_vocab.majority_count == 3
+
+    # gathered logits give the same predictions & losses as masking the full vocab
+    logits = torch.randn(4, 50)
+    targets = torch.tensor([7, 42, 3, 7])
+    masked_logits = torch.where(expected_mask, logits, torch.tensor(float('-inf')))
+    gathered_logits = answer_vocab.gather(logits)
+    compact_targets = answer_vocab.to_compact(targets)
+    assert torch.equal(answer_vocab.ids[gathered_logits.argmax(dim=-1)], masked_logits.argmax(dim=-1))
+    assert torch.allclose(
+        torch.nn.functional.cross_entropy(gathered_logits, compact_targets),
+        torch.nn.functional.cross_entropy(masked_logits, targets))
+    assert answer_vocab.to_compact(torch.tensor([5, 42])).tolist() == [-100, 2]
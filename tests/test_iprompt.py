@@ -0,0 +1,211 @@
+from types import SimpleNamespace
+import random
+
+import torch
+import transformers
+
+from iprompt.prefix.iprompt import iPrompt
+from iprompt.prefix.utils import LRUCache
+
+
+NUM_TOKENS = 4
+PAD_TOKEN_ID = 0
+
+
+def fake_continuation(conditional_input_ids):
+    """Deterministic 'sampled' tokens for a conditional (ignoring padding)."""
+    return (conditional_input_ids.sum() * torch.arange(1, NUM_TOKENS + 1) + len(conditional_input_ids)) % 1000 + 1
+
+
+def fake_generate(input_ids, num_conditional_tokens, attention_mask, num_new_tokens=NUM_TOKENS):
+    new_tokens = torch.stack([
+        fake_continuation(ids[mask.bool()])[:num_new_tokens] for ids, mask in zip(input_ids, attention_mask)
+    ])
+    return torch.cat((input_ids, new_tokens), dim=1)
+
+
+def make_iprompt(generate=fake_generate, **kwargs):
+    """iPrompt with just what generation needs, and no model (unless `generate` uses one)."""
+    model = iPrompt.__new__(iPrompt)
+    torch.nn.Module.__init__(model)
+    model.tokenizer = SimpleNamespace(pad_token_id=PAD_TOKEN_ID)
+    model._num_tokens = NUM_TOKENS
+    model._num_random_generations = 3
+    model._num_mutations_per_ex = 2
+    model._generation_temp = 1.0
+    model._generation_top_p = 1.0
+    model._generation_repetition_penalty = 1.0
+    model._generation_bucket_length_spread = 2
+    model._generation_cache = LRUCache(max_size=0)
+    model._generation_cache_reuse_prob = 1.0
+    model._verbose = False
+    if generate is not None:
+        model._generate = generate
+    for key, value in kwargs.items():
+        setattr(model, key, value)
+    return model
+
+
+def test_fused_generations_and_mutations_match_unfused():
+    num_new_tokens_per_row = []
+
+    def generate(input_ids, num_conditional_tokens, attention_mask, num_new_tokens):
+        num_new_tokens_per_row.extend([num_new_tokens] * len(input_ids))
+        return fake_generate(input_ids, num_conditional_tokens, attention_mask, num_new_tokens=num_new_tokens)
+
+    model = make_iprompt(generate=generate)
+    population_input_ids = torch.randint(low=1, high=1000, size=(5, NUM_TOKENS))
+    # a single data item, so every conditional uses it
+    full_text_ids = [torch.tensor([11, 12, 13, 14, 15])]
+
+    random.seed(0)
+    random_population_input_ids, mutated_population_input_ids = model._get_random_generations_and_mutations(
+        population_input_ids=population_input_ids, full_text_ids=full_text_ids
+    )
+    random.seed(0)
+    truncate_position = random.randint(0, NUM_TOKENS - 1)
+
+    # unfused: random generations first, then mutate them along with the population
+    expected_random = fake_continuation(full_text_ids[0])[None].repeat((3, 1))
+    expected_mutated = torch.stack([
+        torch.cat((
+            prefix[:truncate_position],
+            fake_continuation(torch.cat((full_text_ids[0], prefix[:truncate_position])))[:NUM_TOKENS - truncate_position]
+        ))
+        for prefix in torch.cat((population_input_ids, expected_random)).repeat((2, 1))
+    ])
+    assert random_population_input_ids.shape == (3, NUM_TOKENS)
+    assert mutated_population_input_ids.shape == ((5 + 3) * 2, NUM_TOKENS)
+    assert torch.equal(random_population_input_ids, expected_random)
+    assert torch.equal(mutated_population_input_ids, expected_mutated)
+    # random generations & population mutations are decoded together, then the
+    # mutations of the random generations only decode the tokens they need
+    assert sorted(num_new_tokens_per_row) == [NUM_TOKENS - truncate_position] * (3 * 2) + [NUM_TOKENS] * (3 + 5 * 2)
+
+
+def test_score_cache_hits_repeated_batches_only():
+    num_scored = []
+
+    def compute_loss_with_set_prefixes(original_input_ids, next_token_ids, possible_answer_mask, prefix_ids):
+        num_scored.append(len(prefix_ids))
+        losses = (prefix_ids.sum(dim=1) + next_token_ids.sum()).double()
+        return losses, torch.zeros(len(prefix_ids), dtype=int)
+
+    model = make_iprompt(
+        _score_cache=LRUCache(max_size=100),
+        _compute_loss_with_set_prefixes=compute_loss_with_set_prefixes,
+        _prefix_pool=SimpleNamespace(update=lambda prefix, loss, accuracy: None),
+    )
+    population_input_ids = torch.randint(low=1, high=1000, size=(3, NUM_TOKENS))
+    input_ids = torch.randint(low=1, high=1000, size=(2, 5))
+    x_tokenized = transformers.BatchEncoding({'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids)})
+    y_tokenized = transformers.BatchEncoding({'input_ids': torch.tensor([[7], [8]]), 'attention_mask': torch.ones((2, 1), dtype=int)})
+
+    def score(x_tokenized, y_tokenized):
+        losses, _ = model._score_population(
+            x_tokenized=x_tokenized, y_tokenized=y_tokenized,
+            population_input_ids=population_input_ids, possible_answer_mask=None,
+        )
+        return losses
+
+    losses = score(x_tokenized, y_tokenized)
+    assert num_scored == [3]
+    # same prefixes on the same batch come from the cache
+    assert torch.equal(score(x_tokenized, y_tokenized), losses)
+    assert num_scored == [3]
+    assert model._score_cache.num_hits == 3
+
+    # a different label is a different batch
+    changed_y_tokenized = transformers.BatchEncoding({'input_ids': torch.tensor([[7], [9]]), 'attention_mask': y_tokenized.attention_mask})
+    assert not torch.equal(score(x_tokenized, changed_y_tokenized), losses)
+    assert num_scored == [3, 3]
+
+    # so is a different attention mask
+    changed_x_tokenized = transformers.BatchEncoding({'input_ids': input_ids, 'attention_mask': torch.tril(torch.ones_like(input_ids))})
+    score(changed_x_tokenized, y_tokenized)
+    assert num_scored == [3, 3, 3]
+
+
+class FakeModel:
+    """Stands in for `model.generate`, checking that inputs are left-padded."""
+
+    def __init__(self):
+        self.input_shapes = []
+        self.num_new_tokens = []
+
+    def generate(self, input_ids, attention_mask, min_length, max_length, **kwargs):
+        self.input_shapes.append(tuple(input_ids.shape))
+        assert min_length == max_length
+        self.num_new_tokens.append(max_length - input_ids.shape[1])
+        # padding only on the left, so every row starts generating at the same position
+        assert torch.equal(attention_mask, attention_mask.int().cummax(dim=1).values.bool())
+        assert (input_ids[~attention_mask] == PAD_TOKEN_ID).all()
+        return fake_generate(
+            input_ids, num_conditional_tokens=input_ids.shape[1], attention_mask=attention_mask,
+            num_new_tokens=self.num_new_tokens[-1])
+
+
+def test_generation_left_pads_buckets_and_returns_new_tokens():
+    model = make_iprompt(generate=None, model=FakeModel(), _generation_bad_words_ids=None)
+    conditional_input_ids = [torch.randint(low=1, high=1000, size=(length,)) for length in [3, 7, 4, 8, 3]]
+    new_input_ids = model._generate_from_conditionals(conditional_input_ids, num_new_tokens=NUM_TOKENS)
+
+    # lengths (3, 3, 4) and (7, 8) are bucketed, each padded to its longest conditional
+    assert sorted(model.model.input_shapes) == [(2, 8), (3, 4)]
+    assert model.model.num_new_tokens == [NUM_TOKENS, NUM_TOKENS]
+    assert new_input_ids.shape == (5, NUM_TOKENS)
+    for ids, new_ids in zip(conditional_input_ids, new_input_ids):
+        assert torch.equal(new_ids, fake_continuation(ids))
+
+    # fewer new tokens are only decoded that far
+    assert torch.equal(
+        model._generate_from_conditionals(conditional_input_ids, num_new_tokens=2), new_input_ids[:, :2])
+    assert model.model.num_new_tokens[2:] == [2, 2]
+
+
+def test_generation_cache_hit_skips_generate():
+    model = make_iprompt(
+        generate=None, model=FakeModel(), _generation_bad_words_ids=None,
+        _generation_cache=LRUCache(max_size=10),
+    )
+    conditional_input_ids = [torch.randint(low=1, high=1000, size=(length,)) for length in [3, 7]]
+    new_input_ids = model._generate_from_conditionals(conditional_input_ids, num_new_tokens=NUM_TOKENS)
+    num_generate_calls = len(model.model.input_shapes)
+
+    # every continuation comes from the cache
+    assert torch.equal(model._generate_from_conditionals(conditional_input_ids, num_new_tokens=NUM_TOKENS), new_input_ids)
+    assert len(model.model.input_shapes) == num_generate_calls
+    assert model._generation_cache.num_hits == 2
+
+    # only the new conditional is generated
+    model._generate_from_conditionals(conditional_input_ids + [torch.tensor([5, 6])], num_new_tokens=NUM_TOKENS)
+    assert model.model.input_shapes[num_generate_calls:] == [(1, 2)]
+
+
+class PrefixSet(set):
+    """Just enough of a prefix pool to initialize a population (duplicates collapse)."""
+
+    def initialize_prefix(self, prefix_ids):
+        self.add(tuple(prefix_ids.tolist()))
+
+
+def test_initial_population_is_generated_in_batches():
+    num_generated = []
+
+    def generate(input_ids, num_conditional_tokens, attention_mask, num_new_tokens):
+        num_generated.append(len(input_ids))
+        new_tokens = torch.arange(len(input_ids) * NUM_TOKENS).reshape((-1, NUM_TOKENS)) + 1000 * len(num_generated)
+        if len(num_generated) == 1:
+            # the first batch is all duplicates
+            new_tokens[:] = new_tokens[0]
+        return torch.cat((input_ids, new_tokens), dim=1)
+
+    pool = PrefixSet()
+    model = make_iprompt(generate=generate, _pop_size=5, _pop_initialized=False, _prefix_pool=pool)
+    full_text_ids = [torch.tensor([11, 12, 13]), torch.tensor([14, 15, 16])]
+    model._initialize_pop_once(full_text_ids=full_text_ids)
+    # one batch for the whole population, then one to top up the duplicates
+    assert num_generated == [5, 4]
+    assert len(pool) == 5
+    model._initialize_pop_once(full_text_ids=full_text_ids)
+    assert num_generated == [5, 4]
@@ -0,0 +1,35 @@
+import torch
+import transformers
+
+from iprompt.lm_head import get_last_token_positions, get_logits_at_positions
+
+
+def test_logits_at_positions_match_full_logits():
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=100, n_positions=32, n_embd=16, n_layer=2, n_head=2)
+    model = transformers.GPT2LMHeadModel(config).eval()
+    input_ids = torch.randint(low=0, high=100, size=(4, 10))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 6:] = 0
+    attention_mask[3, 2:] = 0
+    with torch.no_grad():
+        full_logits = model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+        # one position per row
+        positions = get_last_token_positions(attention_mask)
+        logits = get_logits_at_positions(model, positions, input_ids=input_ids, attention_mask=attention_mask)
+        assert logits.shape == (4, 100)
+        assert torch.allclose(logits, full_logits[torch.arange(4), positions], atol=1e-5)
+
+        # several positions per row, e.g. for multi-token labels
+        positions = torch.tensor([[0, 8, 9], [5, 3, 4], [1, 1, 2], [1, 0, 9]])
+        logits = get_logits_at_positions(model, positions, input_ids=input_ids, attention_mask=attention_mask)
+        assert logits.shape == (4, 3, 100)
+        assert torch.allclose(logits, full_logits[torch.arange(4)[:, None], positions], atol=1e-5)
+
+        # only some tokens, e.g. the possible answers
+        vocab_ids = torch.tensor([3, 17, 99])
+        logits = get_logits_at_positions(
+            model, positions, vocab_ids=vocab_ids, input_ids=input_ids, attention_mask=attention_mask)
+        assert logits.shape == (4, 3, 3)
+        assert torch.allclose(logits, full_logits[torch.arange(4)[:, None], positions][..., vocab_ids], atol=1e-5)
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from iprompt.openai_client import AsyncCompletionClient, MockCompletionServer
+
+# needs the (pre-1.0) openai package
+pytest.importorskip('openai.error')
+
+
+def test_client_batches_retries_and_caches(tmp_path):
+    prompts = [f'{i} + {i} =' for i in range(10)] + ['0 + 0 =']
+    with MockCompletionServer(num_failures=1) as server:
+        client = AsyncCompletionClient(
+            max_prompts_per_request=4, initial_backoff=0.01,
+            api_base=server.api_base, api_key='mock', cache_dir=str(tmp_path))
+        choices = client.complete(prompts, max_tokens=2, logprobs=5)
+        assert len(choices) == len(prompts)
+        assert choices[0] == choices[-1]
+        # 10 unique prompts in batches of 4 = 3 requests, plus 1 failed request that was retried
+        assert server.num_requests == 4
+        assert client.num_retries == 1
+        assert server.num_prompts == 10
+        assert all(len(choice['logprobs']['top_logprobs'][0]) == 5 for choice in choices)
+
+        # everything is cached now, even for a new client
+        client = AsyncCompletionClient(
+            api_base=server.api_base, api_key='mock', cache_dir=str(tmp_path))
+        assert client.complete(prompts, max_tokens=2, logprobs=5) == choices
+        assert server.num_requests == 4
+        # but different kwargs are new queries
+        client.complete(prompts[:2], max_tokens=1)
+        assert server.num_requests == 5
+
+
+def test_client_can_be_reused_across_calls_and_event_loops():
+    with MockCompletionServer(latency=0.05) as server:
+        client = AsyncCompletionClient(
+            max_concurrency=2, max_prompts_per_request=1, requests_per_minute=6000,
+            api_base=server.api_base, api_key='mock', cache_dir='')
+
+        async def complete_concurrently():
+            return await asyncio.gather(
+                client.acomplete(['a', 'b'], max_tokens=1), client.acomplete(['c'], max_tokens=1))
+
+        first_choices, second_choices = asyncio.run(complete_concurrently())
+        assert (len(first_choices), len(second_choices)) == (2, 1)
+        # a new event loop
+        assert len(client.complete(['d'], max_tokens=1)) == 1
+        assert server.num_requests == 4
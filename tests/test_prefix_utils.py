@@ -0,0 +1,388 @@
+from types import SimpleNamespace
+import argparse
+import json
+import os
+import random
+
+import pandas as pd
+import pytest
+import torch
+import transformers
+
+from iprompt.answer_vocab import AnswerVocab
+from iprompt.prefix.hotflip import HotFlip
+from iprompt.prefix.prompt_tune import PromptTunedModel
+from iprompt.prefix.utils import (
+    CompactPrefixPool, LengthBucketedBatchSampler, PrefixModel, PrefixPool, TokenizedDataset
+)
+
+
+EOS_TOKEN_ID = 50256
+# tiny random GPT-2, where (like GPT-2) BOS, EOS and padding are all the last token
+TINY_VOCAB_SIZE = 100
+TINY_EOS_TOKEN_ID = TINY_VOCAB_SIZE - 1
+
+
+def append_next_token_ids_loop(original_input_ids, next_token_ids, eos_token_id):
+    """Reference row-by-row version of PrefixModel._append_next_token_ids."""
+    input_ids = []
+    num_pad_tokens = (original_input_ids == eos_token_id).sum(dim=1)
+    for i in range(len(original_input_ids)):
+        if num_pad_tokens[i] == 0:
+            next_tensor = torch.cat((original_input_ids[i], next_token_ids[i]), dim=0)
+        else:
+            num_non_pad_tokens = original_input_ids.shape[1] - num_pad_tokens[i]
+            padding = torch.full(size=(num_pad_tokens[i], ), fill_value=eos_token_id)
+            next_tensor = torch.cat((original_input_ids[i][:num_non_pad_tokens], next_token_ids[i], padding), dim=0)
+        input_ids.append(next_tensor)
+    return torch.stack(input_ids)
+
+
+def test_append_next_token_ids_matches_loop():
+    torch.manual_seed(0)
+    model = SimpleNamespace(tokenizer=SimpleNamespace(eos_token_id=EOS_TOKEN_ID))
+    for batch_size, input_length, label_length in [(1, 1, 1), (7, 12, 1), (500, 30, 3)]:
+        original_input_ids = torch.randint(low=0, high=EOS_TOKEN_ID, size=(batch_size, input_length))
+        # right-pad each row by a random amount (first row is never padded)
+        num_pad_tokens = torch.randint(low=0, high=input_length, size=(batch_size,))
+        num_pad_tokens[0] = 0
+        for i in range(batch_size):
+            if num_pad_tokens[i] > 0:
+                original_input_ids[i, -num_pad_tokens[i]:] = EOS_TOKEN_ID
+        next_token_ids = torch.randint(low=0, high=EOS_TOKEN_ID, size=(batch_size, label_length))
+
+        expected = append_next_token_ids_loop(original_input_ids, next_token_ids, EOS_TOKEN_ID)
+        actual = PrefixModel._append_next_token_ids(
+            model, original_input_ids=original_input_ids, next_token_ids=next_token_ids
+        )
+        assert actual.dtype == expected.dtype
+        assert torch.equal(actual, expected)
+
+
+def test_prefix_pool_topk_matches_brute_force():
+    random.seed(0)
+    pool = PrefixPool(tokenizer=None, criterion='loss')
+    all_losses = {}
+    prefixes = [tuple(random.randint(0, 100) for _ in range(3)) for _ in range(200)]
+    for step in range(2000):
+        prefix = random.choice(prefixes)
+        loss = random.random()
+        all_losses.setdefault(prefix, []).append(loss)
+        pool.update(torch.tensor(prefix), torch.tensor(loss), torch.tensor(0.5))
+        if step % 100 == 0:
+            for min_occurrences in [None, 1, 3]:
+                expected = sorted(
+                    (
+                        (sum(l) / len(l), p) for p, l in all_losses.items()
+                        if (not min_occurrences) or (len(l) > min_occurrences)
+                    )
+                )[:10]
+                actual = pool.topk_all(k=10, min_occurrences=min_occurrences)
+                assert actual == [p for _, p in expected]
+    assert pool.num_occurrences(prefixes[0]) == len(all_losses[prefixes[0]])
+
+
+@pytest.mark.parametrize('criterion', ['loss', 'combined'])
+def test_compact_prefix_pool_matches_prefix_pool(criterion):
+    random.seed(0)
+    pool = PrefixPool(tokenizer=None, criterion=criterion)
+    # small initial capacity, so the arrays grow & the hash table is rehashed several times
+    compact_pool = CompactPrefixPool(tokenizer=None, criterion=criterion, num_tokens=3, initial_capacity=4)
+    prefixes = [tuple(random.randint(0, 100) for _ in range(3)) for _ in range(300)]
+    # initialized prefixes all tie, so they're ordered by their token IDs
+    for prefix in prefixes[:20]:
+        for p in [pool, compact_pool]:
+            p.initialize_prefix(torch.tensor(prefix))
+    assert compact_pool.topk_all(k=30) == pool.topk_all(k=30)
+    for step in range(3000):
+        prefix = random.choice(prefixes)
+        loss, accuracy = random.random(), random.random()
+        for p in [pool, compact_pool]:
+            p.update(torch.tensor(prefix), torch.tensor(loss), torch.tensor(accuracy))
+        if step % 250 == 0:
+            assert len(compact_pool) == len(pool)
+            for min_occurrences in [None, 1, 3]:
+                assert compact_pool.topk_all(k=10, min_occurrences=min_occurrences) == pool.topk_all(k=10, min_occurrences=min_occurrences)
+                # (topk pads with random choices when there are too few start tokens)
+                random_state = random.getstate()
+                expected = pool.topk(k=5, min_occurrences=min_occurrences)
+                random.setstate(random_state)
+                assert compact_pool.topk(k=5, min_occurrences=min_occurrences) == expected
+    assert len(compact_pool._ids) > 4
+    # growing copies the used rows, and leaves the rest empty
+    assert sorted(compact_pool.prefixes) == sorted(pool.prefixes)
+    assert not compact_pool._ids[len(compact_pool):].any()
+    for prefix in pool.prefixes:
+        assert compact_pool.num_occurrences(prefix) == pool.num_occurrences(prefix)
+        assert compact_pool.avg_loss(prefix) == pytest.approx(pool.avg_loss(prefix))
+        assert compact_pool.avg_accuracy(prefix) == pytest.approx(pool.avg_accuracy(prefix))
+        assert compact_pool.std_loss(prefix) == pytest.approx(pool.std_loss(prefix))
+
+    # unknown prefixes are errors, rather than reading an unused row
+    unknown_prefix = (101, 101, 101)
+    for p in [pool, compact_pool]:
+        assert p.num_occurrences(unknown_prefix) == 0
+        with pytest.raises(KeyError):
+            p.avg_loss(unknown_prefix)
+        with pytest.raises(KeyError):
+            p.avg_accuracy(unknown_prefix)
+
+
+def test_prefix_pool_resumes_from_log(tmp_path):
+    random.seed(0)
+    log_dir = str(tmp_path / 'run_1')
+    pool = PrefixPool(tokenizer=None, criterion='loss')
+    pool.open_log(log_dir, checkpoint_interval=3)
+    prefixes = [tuple(random.randint(0, 100) for _ in range(3)) for _ in range(20)]
+    pool.initialize_prefix(torch.tensor(prefixes[0]))
+    for step in range(10):
+        for prefix in random.sample(prefixes, 5):
+            pool.update(torch.tensor(prefix), torch.tensor(random.random()), torch.tensor(random.random()))
+        top_prefixes = pool.topk_all(k=2)
+        pool.log_topk(pd.DataFrame({
+            'prefix': [str(p) for p in top_prefixes],
+            'loss': [pool.avg_loss(p) for p in top_prefixes],
+            'accuracy': [pool.avg_accuracy(p) for p in top_prefixes],
+        }))
+        pool.end_step({'step': step})
+
+    resumed_log_dir = str(tmp_path / 'run_2')
+    resumed_pool = PrefixPool(tokenizer=None, criterion='loss')
+    resumed_pool.open_log(resumed_log_dir)
+    state = resumed_pool.load(log_dir)
+    assert state == {'step': 9}
+    assert resumed_pool.step == pool.step
+    assert len(resumed_pool) == len(pool)
+    assert resumed_pool.topk_all(k=10) == pool.topk_all(k=10)
+    for prefix in pool.prefixes:
+        assert resumed_pool.num_occurrences(prefix) == pool.num_occurrences(prefix)
+        assert abs(resumed_pool.avg_loss(prefix) - pool.avg_loss(prefix)) < 1e-12
+
+    # the per-step top prefixes carry over, and the old run's log is removed once checkpointed
+    with open(os.path.join(resumed_log_dir, 'topk.jsonl')) as f:
+        assert [json.loads(line)['step'] for line in f] == list(range(10))
+    resumed_pool.save_checkpoint()
+    resumed_pool.remove_loaded_log()
+    assert not any(name.startswith('log_') for name in os.listdir(log_dir))
+
+
+def test_race_prefixes_keeps_best_and_stops_early_on_worst():
+    def compute_loss_with_set_prefixes(original_input_ids, next_token_ids, possible_answer_mask, prefix_ids):
+        # prefix [k] gets accuracy k/100 on every batch
+        accuracy = prefix_ids[:, 0].double() / 100
+        return (1 - accuracy), (accuracy * len(original_input_ids)).round().long()
+
+    model = SimpleNamespace(
+        _compute_loss_with_set_prefixes=compute_loss_with_set_prefixes,
+        _prefix_eval_racing_delta=0.05,
+        _prefix_eval_racing_min_examples=64,
+    )
+    prefix_ids = torch.tensor([[k] for k in range(0, 101, 5)])
+    batch = (torch.zeros((100, 4), dtype=int), torch.zeros((100, 1), dtype=int))
+    num_batches = 50
+    losses, accuracies, num_examples = PrefixModel._race_prefixes(
+        model, prefix_ids=prefix_ids, batches=[batch] * num_batches,
+        num_batches=num_batches, possible_answer_mask=None,
+    )
+    assert accuracies[-1] == 1.0
+    assert num_examples[-1] == 100 * num_batches
+    assert num_examples[0] < 100 * num_batches
+    assert sum(num_examples) < len(prefix_ids) * 100 * num_batches
+    assert max(range(len(prefix_ids)), key=lambda i: (accuracies[i], -losses[i])) == len(prefix_ids) - 1
+
+
+def test_restricted_answer_losses_match_masked_full_vocab():
+    torch.manual_seed(0)
+    model = SimpleNamespace(tokenizer=SimpleNamespace(pad_token_id=EOS_TOKEN_ID, bos_token_id=EOS_TOKEN_ID))
+    vocab_size = 100
+    answer_ids = torch.tensor([4, 20, 63])
+    possible_answer_mask = torch.zeros(vocab_size, dtype=torch.bool)
+    possible_answer_mask[answer_ids] = True
+    label_logits = torch.randn(8, 1, vocab_size)
+    next_token_ids = answer_ids[torch.randint(len(answer_ids), size=(8, 1))]
+    next_token_ids[0] = 5  # not a possible answer, so infinite loss
+
+    losses, correct = PrefixModel._compute_example_losses(
+        model, label_logits=label_logits, next_token_ids=next_token_ids,
+        possible_answer_mask=possible_answer_mask,
+    )
+    restricted_losses, restricted_correct = PrefixModel._compute_example_losses(
+        model, label_logits=label_logits[..., answer_ids], next_token_ids=next_token_ids,
+        possible_answer_mask=possible_answer_mask,
+        answer_vocab=AnswerVocab(answer_ids, vocab_size=vocab_size),
+    )
+    assert torch.isinf(restricted_losses[0])
+    assert torch.allclose(losses, restricted_losses)
+    assert torch.equal(correct, restricted_correct)
+
+
+def test_swap_token_selection_matches_full_argsort():
+    torch.manual_seed(0)
+    num_tokens, vocab_size, emb_dim, k = 3, 1000, 16, 10
+    model = SimpleNamespace(
+        token_embedding=torch.nn.Embedding(vocab_size, emb_dim),
+        prefix_embedding=SimpleNamespace(grad=torch.randn(num_tokens, emb_dim)),
+        _allowed_tokens='all', _allowed_token_ids=None, _allowed_token_embeddings=None,
+    )
+    model._get_allowed_token_ids = lambda: HotFlip._get_allowed_token_ids(model)
+    full_token_grads = torch.einsum('nd,vd->nv', model.prefix_embedding.grad, model.token_embedding.weight)
+    with torch.no_grad():
+        for token_idx in range(num_tokens):
+            token_ids, token_grads = HotFlip._swap_token_grad(model, token_idx=token_idx)
+            assert torch.allclose(token_grads, full_token_grads[token_idx], atol=1e-5)
+            for offset in [0, k, 2 * k]:
+                top_token_ids, _ = HotFlip._top_swap_tokens(
+                    model, token_scores=token_grads, token_ids=token_ids, k=k, offset=offset
+                )
+                expected = full_token_grads[token_idx].argsort()[offset : offset + k]
+                assert torch.equal(top_token_ids, expected)
+
+
+class ListDataset:
+    """Minimal stand-in for a `datasets.Dataset` (supports `dset[:]` and `dset[i]`)."""
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return {key: [row[key] for row in self.rows[idx]] for key in self.rows[0]}
+        return self.rows[idx]
+
+
+class WhitespaceTokenizer:
+    name_or_path = 'whitespace'
+    pad_token_id = 0
+    padding_side = 'right'
+
+    def __init__(self):
+        self.num_calls = 0
+
+    def __call__(self, texts, truncation=False, max_length=None):
+        self.num_calls += 1
+        input_ids = [[len(word) for word in text.split()][:max_length] for text in texts]
+        return {'input_ids': input_ids}
+
+
+def test_tokenized_dataset_collate_and_cache(tmp_path):
+    rows = [
+        {'input': 'a bb ccc', 'output': 'dd.', 'text': 'a bb ccc dd'},
+        {'input': 'eeee', 'output': 'f g', 'text': 'eeee f g'},
+        {'input': 'hh i j kk lll', 'output': 'mmm', 'text': 'hh i j kk lll mmm'},
+    ]
+    prepare_batch = lambda batch: (batch['input'], [y.rstrip('.') for y in batch['output']])
+    tokenizer = WhitespaceTokenizer()
+    dset = TokenizedDataset(
+        dset=ListDataset(rows), tokenizer=tokenizer, prepare_batch=prepare_batch,
+        max_length=4, cache_dir=str(tmp_path), cache_name='ckpt/task__0',
+    )
+    batch = dset.collate([dset[i] for i in range(len(dset))])
+    assert batch['input'] == [row['input'] for row in rows]
+    assert batch['x_tokenized'].input_ids.tolist() == [[1, 2, 3, 0], [4, 0, 0, 0], [2, 1, 1, 2]]
+    assert batch['x_tokenized'].attention_mask.tolist() == [[1, 1, 1, 0], [1, 0, 0, 0], [1, 1, 1, 1]]
+    assert batch['y_tokenized'].input_ids.tolist() == [[2, 0], [1, 1], [3, 0]]
+    assert dset.first_answer_token_ids.tolist() == [2, 1, 3]
+
+    # second time around, everything comes from the cache
+    num_calls = tokenizer.num_calls
+    cached_dset = TokenizedDataset(
+        dset=ListDataset(rows), tokenizer=tokenizer, prepare_batch=prepare_batch,
+        max_length=4, cache_dir=str(tmp_path), cache_name='ckpt/task__0',
+    )
+    assert tokenizer.num_calls == num_calls
+    cached_batch = cached_dset.collate([cached_dset[i] for i in range(len(cached_dset))])
+    for field in TokenizedDataset.fields:
+        assert torch.equal(cached_batch[f'{field}_tokenized'].input_ids, batch[f'{field}_tokenized'].input_ids)
+
+
+def test_length_bucketed_batch_sampler():
+    random.seed(0)
+    lengths = [random.randint(1, 200) for _ in range(1000)]
+    for max_tokens in [None, 1000]:
+        sampler = LengthBucketedBatchSampler(lengths=lengths, batch_size=16, max_tokens=max_tokens, bucket_size_multiplier=8)
+        epochs = []
+        for _ in range(2):
+            num_batches = len(sampler)
+            batches = list(sampler)
+            assert len(batches) == num_batches
+            assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+            if max_tokens is None:
+                assert all(len(batch) <= 16 for batch in batches)
+            else:
+                assert all(len(batch) * max(lengths[i] for i in batch) <= max_tokens for batch in batches)
+            epochs.append(batches)
+        # still shuffled across epochs
+        assert epochs[0] != epochs[1]
+
+
+def make_tiny_hotflip(preprefix: str = '', **kwargs) -> HotFlip:
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=TINY_VOCAB_SIZE, n_positions=64, n_embd=16, n_layer=2, n_head=2)
+    model = transformers.GPT2LMHeadModel(config).eval()
+    tokenizer = SimpleNamespace(
+        bos_token_id=TINY_EOS_TOKEN_ID, eos_token_id=TINY_EOS_TOKEN_ID, pad_token_id=TINY_EOS_TOKEN_ID,
+        vocab_size=TINY_EOS_TOKEN_ID, encode=lambda text: [(ord(c) % TINY_EOS_TOKEN_ID) for c in text],
+    )
+    args = argparse.Namespace(
+        num_learned_tokens=3, hotflip_num_candidates=5, autoprompt_init_strategy='random',
+        early_stopping_steps=-1, **kwargs
+    )
+    return HotFlip(args=args, loss_func=None, model=model, tokenizer=tokenizer, preprefix=preprefix)
+
+
+def make_tiny_batch(label_length: int):
+    """Right-padded inputs and labels, with padding in some rows of each."""
+    original_input_ids = torch.randint(low=0, high=TINY_EOS_TOKEN_ID, size=(4, 6))
+    original_input_ids[1, 4:] = TINY_EOS_TOKEN_ID
+    original_input_ids[3, 2:] = TINY_EOS_TOKEN_ID
+    next_token_ids = torch.randint(low=0, high=TINY_EOS_TOKEN_ID, size=(4, label_length))
+    next_token_ids[2, 1:] = TINY_EOS_TOKEN_ID
+    return original_input_ids, next_token_ids
+
+
+def test_batched_prefix_scoring_matches_loop():
+    # few enough tokens per forward pass that the candidates get split into chunks
+    model = make_tiny_hotflip(scoring_max_tokens=64)
+    prefix_ids = torch.randint(low=0, high=TINY_EOS_TOKEN_ID, size=(5, 3))
+    for label_length in [1, 3]:
+        original_input_ids, next_token_ids = make_tiny_batch(label_length=label_length)
+        with torch.no_grad():
+            losses, n_correct = model._compute_loss_with_set_prefixes(
+                original_input_ids=original_input_ids, next_token_ids=next_token_ids,
+                possible_answer_mask=None, prefix_ids=prefix_ids,
+            )
+            expected = [
+                model._compute_loss_with_set_prefix(
+                    original_input_ids=original_input_ids, next_token_ids=next_token_ids,
+                    possible_answer_mask=None, prefix_ids=prefix,
+                )
+                for prefix in prefix_ids
+            ]
+        assert losses.shape == n_correct.shape == (5,)
+        assert torch.allclose(losses, torch.stack([loss for _, loss, _ in expected]), atol=1e-5)
+        assert n_correct.tolist() == [n.item() for _, _, n in expected]
+
+
+def test_kv_cached_prefix_scoring_matches_full():
+    prefix_ids = torch.randint(low=0, high=TINY_EOS_TOKEN_ID, size=(5, 3))
+    for label_length in [1, 3]:
+        original_input_ids, next_token_ids = make_tiny_batch(label_length=label_length)
+        results = []
+        for prefix_scoring_mode in ['full', 'kv_cache']:
+            model = make_tiny_hotflip(preprefix='the answer is', prefix_scoring_mode=prefix_scoring_mode)
+            results.append(model._compute_loss_with_set_prefixes(
+                original_input_ids=original_input_ids, next_token_ids=next_token_ids,
+                possible_answer_mask=None, prefix_ids=prefix_ids,
+            ))
+        (losses, n_correct), (kv_cache_losses, kv_cache_n_correct) = results
+        assert torch.allclose(losses, kv_cache_losses, atol=1e-5)
+        assert torch.equal(n_correct, kv_cache_n_correct)
+
+    # models without a kv-cached forward fail as soon as they're built
+    with pytest.raises(AssertionError, match='kv-cached'):
+        PromptTunedModel(
+            args=argparse.Namespace(prefix_scoring_mode='kv_cache', num_learned_tokens=3),
+            loss_func=None, model=make_tiny_hotflip().model, tokenizer=None, preprefix='',
+        )
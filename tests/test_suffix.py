@@ -0,0 +1,104 @@
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import transformers
+
+from iprompt.suffix import StreamingNextTokenAverager, SuffixKVCache, get_allowed_token_mask, get_top_k_allowed
+
+
+def test_streaming_averager_matches_mean_of_softmax():
+    torch.manual_seed(0)
+    logits = torch.randn(10, 50) * 5
+    suffix_idxs = torch.tensor([0] * 5 + [1] * 5)
+    averager = StreamingNextTokenAverager(num_rows=2)
+    # in two chunks, like a dataloader
+    averager.update(logits[:7], suffix_idxs[:7])
+    averager.update(logits[7:], suffix_idxs[7:])
+    averager.add_examples(5)
+    avg_probs = averager.get_avg()
+    probs = logits.double().softmax(dim=-1)
+    expected = torch.stack((probs[:5].mean(dim=0), probs[5:].mean(dim=0)))
+    assert np.allclose(avg_probs, expected.numpy())
+
+    # fp16 logits are upcast before the softmax, so they reduce the same way
+    averager = StreamingNextTokenAverager(num_rows=1)
+    averager.update(logits.half(), torch.zeros(10, dtype=torch.long))
+    averager.add_examples(10)
+    expected = logits.half().double().softmax(dim=-1).mean(dim=0)
+    assert np.allclose(averager.get_avg()[0], expected.numpy())
+
+    # top-k keeps only the largest probs of each example
+    averager = StreamingNextTokenAverager(num_rows=1, top_k=3)
+    averager.update(logits, torch.zeros(10, dtype=torch.long))
+    averager.add_examples(10)
+    assert (averager.get_avg()[0] > 0).sum() <= 30
+
+
+def test_top_k_allowed_with_logits_wider_than_tokenizer():
+    # e.g. GPT-J has 50400 logits but 50257 tokens
+    vocab_table = {
+        'decoded': np.array(['a', ' ', 'the', 'b', '.', 'c'], dtype=object),
+        'is_whitespace_or_punct': np.array([False, True, False, False, True, False]),
+        'is_stopword': np.array([False, False, True, False, False, False]),
+    }
+    allowed_mask = get_allowed_token_mask(
+        vocab_table, num_logits=9, disallow_whitespace_tokens=True, disallow_stopwords=True)
+    assert allowed_mask.tolist() == [True, False, False, True, False, True, False, False, False]
+
+    avg_probs = np.array([0.1, 0.3, 0.05, 0.2, 0.05, 0.01, 0.1, 0.09, 0.1])
+    top_k_inds, avg_probs_allowed = get_top_k_allowed(avg_probs, allowed_mask, k=5)
+    assert top_k_inds.tolist() == [3, 0, 5]
+    assert np.isneginf(avg_probs_allowed[~allowed_mask]).all()
+    assert vocab_table['decoded'][top_k_inds].tolist() == ['b', 'a', 'c']
+
+    # narrower logits than the tokenizer work too
+    assert get_allowed_token_mask(vocab_table, num_logits=4).tolist() == [True] * 4
+
+
+class CharTokenizer:
+    """One token per character, with the last token of a 100-token vocab as padding."""
+    pad_token_id = 99
+
+    def __call__(self, texts):
+        return {'input_ids': [[ord(c) % 99 for c in text] for text in texts]}
+
+
+def test_suffix_kv_cache_keeps_only_the_frontier():
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=100, n_positions=32, n_embd=16, n_layer=2, n_head=2)
+    model = transformers.GPT2LMHeadModel(config).eval()
+    tokenizer = CharTokenizer()
+    dataloader = [{'text': ['ab', 'cdef']}, {'text': ['g']}]
+    args = SimpleNamespace(use_cpu_only=1)
+
+    def expected_probs(suffix_token_ids):
+        probs = []
+        for text in ['ab', 'cdef', 'g']:
+            input_ids = torch.tensor([tokenizer([text + ' =>'])['input_ids'][0] + list(suffix_token_ids)])
+            with torch.no_grad():
+                probs.append(model(input_ids=input_ids).logits[0, -1].double().softmax(dim=-1))
+        return torch.stack(probs).mean(dim=0).numpy()
+
+    kv_cache = SuffixKVCache(args, model, dataloader, tokenizer, init_suffix_str=' =>')
+    # breadth-first: every node's children are expanded one after another
+    levels = [[()], [(5,), (7,)], [(5, 1), (5, 2), (7, 1), (7, 2)]]
+    for level in levels:
+        for suffix_token_ids in level:
+            avg_probs = kv_cache.get_probs_avg_next_token(suffix_token_ids)
+            assert np.allclose(avg_probs, expected_probs(suffix_token_ids), atol=1e-5)
+            # never more than the parents left to expand plus the children so far
+            assert len(kv_cache._entries) <= len(level) + 1
+    assert set(kv_cache._entries) == {(7,)} | set(levels[-1])
+
+    # with a byte budget, evicted entries are rebuilt from their ancestors
+    max_bytes = kv_cache._entry_nbytes[(5, 1)]
+    small_kv_cache = SuffixKVCache(args, model, dataloader, tokenizer, init_suffix_str=' =>', max_bytes=max_bytes)
+    for suffix_token_ids in [(), (5,), (5, 1), (7, 2)]:
+        avg_probs = small_kv_cache.get_probs_avg_next_token(suffix_token_ids)
+        assert np.allclose(avg_probs, expected_probs(suffix_token_ids), atol=1e-5)
+        assert small_kv_cache.num_bytes <= max_bytes
+
+    # suffixes that won't be expanded aren't kept
+    small_kv_cache.get_probs_avg_next_token((7, 2, 3), keep_past=False)
+    assert (7, 2, 3) not in small_kv_cache._entries